@@ -4,32 +4,102 @@ Main app file.
 
 __author__ = "Kevin Dougherty"
 
-from flask import Flask, render_template, url_for, request, redirect
+from flask import Flask, render_template, url_for, request, redirect, jsonify, send_file, abort, g
 from flask_sqlalchemy import SQLAlchemy
-from flask_login import UserMixin, login_user, LoginManager, login_required, logout_user
-from datetime import datetime
-from receipt import Receipt
+from flask_login import UserMixin, login_user, LoginManager, login_required, logout_user, current_user
+from datetime import datetime, date
+from receipt import CATEGORIES, STORES
 import os
-import pandas as pd
-import plotly.express as px
-import plotly.io as pio
+import plotly
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField
 from wtforms.validators import InputRequired, Length, ValidationError
 from flask_bcrypt import Bcrypt
-from preprocessing import Preprocessing
-from db_calculations import index_calculations, items_calculations
-import cv2
+from db_calculations import items_calculations, spending_over_time, receipt_page, FREQUENCIES
+from classifier import classifier_registry, BACKENDS
+from category_cache import category_cache, SQLCategoryBackend
+from ingestion import IngestionQueue
+from bulk_import import iter_images, read_receipts, classify_results
+from migrations import migrate
+import database
+from blob_store import BlobStore, UploadTooLarge, content_hash, perceptual_hash, hamming_distance, ensure_thumbnail
+import json
+import hashlib
+import time
+import click
+from money import to_cents, format_cents
+import rollups
+from charts import chart_cache, bar_chart, pie_chart, stacked_bar_chart
+from metrics import metrics
+import cProfile
+import sys
+import threading
+from export import ExportJobs, export_receipts, write_export, iter_chunks, csv_chunks, FORMATS
 
 app = Flask(__name__)
 bcrypt = Bcrypt(app)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
-image_uploads = 'static/image_uploads'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL", 'sqlite:///test.db')
+# Pragmas every SQLite connection starts with, see database.py. WAL lets pages keep reading while an upload is written.
+app.config["SQLITE_PRAGMAS"] = dict(
+    database.DEFAULT_PRAGMAS,
+    journal_mode = os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    synchronous = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    cache_size = -int(os.environ.get("SQLITE_CACHE_SIZE_KB", "20000")),
+    mmap_size = int(os.environ.get("SQLITE_MMAP_SIZE_MB", "256")) * 1024 * 1024,
+    busy_timeout = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+)
+# Database connections each app process keeps open, and how many more it may open when they are all busy.
+app.config["DB_POOL_SIZE"] = int(os.environ.get("DB_POOL_SIZE", "5"))
+app.config["DB_MAX_OVERFLOW"] = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+app.config["DB_POOL_TIMEOUT"] = int(os.environ.get("DB_POOL_TIMEOUT", "30"))
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = database.engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'],
+    pool_size = app.config["DB_POOL_SIZE"],
+    max_overflow = app.config["DB_MAX_OVERFLOW"],
+    pool_timeout = app.config["DB_POOL_TIMEOUT"],
+    busy_timeout = app.config["SQLITE_PRAGMAS"]["busy_timeout"],
+)
+image_uploads = os.environ.get("UPLOAD_PATH", 'static/image_uploads')
 app.config["UPLOAD_PATH"] = image_uploads
+# Largest image accepted, and how many images one upload may hold (the pages of a receipt, or a batch of receipts).
+app.config["MAX_IMAGE_MB"] = int(os.environ.get("MAX_IMAGE_MB", "20"))
+app.config["MAX_UPLOAD_FILES"] = int(os.environ.get("MAX_UPLOAD_FILES", "20"))
+# Werkzeug answers 413 as soon as a request body grows past this, before reading the rest of it.
+app.config["MAX_CONTENT_LENGTH"] = (app.config["MAX_IMAGE_MB"] * app.config["MAX_UPLOAD_FILES"] + 1) * 1024 * 1024
+# Width, in pixels, of the receipt thumbnails on the home page. They are made once, when a receipt is read.
+app.config["THUMBNAIL_WIDTH"] = int(os.environ.get("THUMBNAIL_WIDTH", "240"))
 app.config["SECRET_KEY"] = "secret_key"
-
-# TODO: Create a monthly spending chart that displays how much a person has spent that month
-# TODO: Add a check where if the stores name is in a receipt explicitly we use that as the stores name.
+# Load BART when the server starts instead of on the first upload.
+app.config["WARM_UP_MODELS"] = os.environ.get("WARM_UP_MODELS", "0") == "1"
+app.config["CLASSIFIER_BATCH_SIZE"] = int(os.environ.get("CLASSIFIER_BATCH_SIZE", "32"))
+# "zero-shot" classifies items and stores with BART, "embedding" with a small sentence encoder
+# (see embedding_classifier.py). CLASSIFIER_MODEL replaces the backend's default model.
+app.config["CLASSIFIER_BACKEND"] = os.environ.get("CLASSIFIER_BACKEND", "zero-shot")
+app.config["CLASSIFIER_MODEL"] = os.environ.get("CLASSIFIER_MODEL", "")
+app.config["CATEGORY_CACHE_SIZE"] = int(os.environ.get("CATEGORY_CACHE_SIZE", "4096"))
+# Receipts per page on the home page and in the receipts API, and the most a client may ask for.
+app.config["PAGE_SIZE"] = int(os.environ.get("PAGE_SIZE", "50"))
+app.config["MAX_PAGE_SIZE"] = int(os.environ.get("MAX_PAGE_SIZE", "200"))
+# Record per-stage timings and counters for /metrics.
+app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "1") == "1"
+# Directory that requests made with ?profile=1 write a cProfile dump to. Profiling is off when unset.
+app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", "")
+# Number of chart payloads each app process keeps in memory.
+app.config["CHART_CACHE_SIZE"] = int(os.environ.get("CHART_CACHE_SIZE", "1024"))
+# Tall receipts are split into up to this many strips that are OCRed in parallel. 1 reads them in one pass.
+app.config["OCR_STRIPS"] = int(os.environ.get("OCR_STRIPS", str(os.cpu_count() or 1)))
+# Character height, in pixels, that uploads are scaled down to before preprocessing. 0 keeps the camera's resolution.
+app.config["OCR_TEXT_HEIGHT"] = int(os.environ.get("OCR_TEXT_HEIGHT", "30"))
+# Reuse the OCR result of an earlier upload whose perceptual hash is at most this many bits away (up to 3).
+# 0 only reuses results for byte-identical uploads.
+app.config["NEAR_DUPLICATE_DISTANCE"] = int(os.environ.get("NEAR_DUPLICATE_DISTANCE", "0"))
+# Number of worker processes that OCR and classify uploads. 0 processes uploads inside the request.
+app.config["INGEST_WORKERS"] = int(os.environ.get("INGEST_WORKERS", "2"))
+# Directory Parquet and Arrow exports are written to, and the rows an export reads and writes at a time.
+app.config["EXPORT_PATH"] = os.environ.get("EXPORT_PATH", os.path.join(app.instance_path, "exports"))
+app.config["EXPORT_CHUNK_SIZE"] = int(os.environ.get("EXPORT_CHUNK_SIZE", "5000"))
+# Hours an export file is kept for download before it is deleted.
+app.config["EXPORT_MAX_AGE_HOURS"] = int(os.environ.get("EXPORT_MAX_AGE_HOURS", "24"))
 
 db = SQLAlchemy(app)
 
@@ -37,12 +107,17 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "login"
 
-preprocessing = Preprocessing()
-
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+def require_owner(user_id):
+    """
+    Stops a request for another user's data with a 404, so it does not even reveal that the user exists.
+    """
+    if current_user.id != user_id:
+        abort(404)
+
 class User(db.Model, UserMixin):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
@@ -54,18 +129,278 @@ class ReceiptTable(db.Model):
     __tablename__ = 'receipt_table'
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.String(200), nullable = False)
-    total = db.Column(db.String(200), nullable = False)
+    total_cents = db.Column(db.Integer, nullable = False, default = 0)
     date_created = db.Column(db.DateTime, default = datetime.utcnow)
+    status = db.Column(db.String(20), nullable = False, default = "done")
+    image = db.Column(db.String(500))
+    # JSON list of the image paths of a receipt uploaded as several pages, image is the first of them.
+    pages = db.Column(db.Text)
+    content_hash = db.Column(db.String(64))
     receipt_items = db.relationship('ItemTable', backref='receipt_table', cascade="all, delete-orphan")
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete="CASCADE"))
+    __table_args__ = (
+        db.Index('ix_receipt_table_user_id_date_created', 'user_id', 'date_created'),
+        db.Index('ix_receipt_table_user_id_content', 'user_id', 'content'),
+    )
+
+    @property
+    def images(self):
+        """
+        Paths of the receipt's images: its pages in order, or its one image.
+        """
+        if self.pages:
+            return json.loads(self.pages)
+        return [self.image] if self.image else []
+
+    @property
+    def total(self):
+        """
+        The total in dollars, e.g. "12.99". Assigning a dollar amount stores it in total_cents.
+        """
+        return format_cents(self.total_cents or 0)
+
+    @total.setter
+    def total(self, amount):
+        self.total_cents = to_cents(amount)
 
 class ItemTable(db.Model):
     __tablename__ = 'item_table'
     id = db.Column(db.Integer, primary_key=True)
     item = db.Column(db.String(200), nullable = False)
-    total = db.Column(db.String(200), nullable = False)
+    total_cents = db.Column(db.Integer, nullable = False, default = 0)
     category = db.Column(db.String(200), nullable = False)
     receipt_id = db.Column(db.Integer, db.ForeignKey('receipt_table.id', ondelete="CASCADE"))
+    __table_args__ = (
+        db.Index('ix_item_table_receipt_id_category', 'receipt_id', 'category'),
+        db.Index('ix_item_table_category_receipt_id', 'category', 'receipt_id'),
+    )
+
+    @property
+    def total(self):
+        """
+        The price in dollars, e.g. "3.49". Assigning a dollar amount stores it in total_cents.
+        """
+        return format_cents(self.total_cents or 0)
+
+    @total.setter
+    def total(self, amount):
+        self.total_cents = to_cents(amount)
+
+class CategoryCacheTable(db.Model):
+    __tablename__ = 'category_cache'
+    id = db.Column(db.Integer, primary_key=True)
+    item_key = db.Column(db.String(200), nullable = False)
+    categories = db.Column(db.String(500), nullable = False)
+    category = db.Column(db.String(200), nullable = False)
+    source = db.Column(db.String(20), nullable = False, default = "model")
+    __table_args__ = (db.UniqueConstraint('item_key', 'categories'),)
+
+class OcrResultTable(db.Model):
+    __tablename__ = 'ocr_result'
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), nullable = False, unique = True)
+    perceptual_hash = db.Column(db.String(16), index = True)
+    text = db.Column(db.Text, nullable = False)
+    store = db.Column(db.String(200), nullable = False)
+    total = db.Column(db.String(200), nullable = False)
+    items = db.Column(db.Text, nullable = False)
+    date_created = db.Column(db.DateTime, default = datetime.utcnow)
+
+blob_store = BlobStore(app.config["UPLOAD_PATH"])
+
+# Created by setup(), once the database is ready.
+ingestion_queue = None
+_setup_lock = threading.RLock()
+_started = {"setup": False, "serving": False}
+
+def setup():
+    """
+    Gets this process ready to use the database: sets the SQLite pragmas, runs the migrations,
+    creates missing tables, sizes the caches, picks the classifier and creates the ingestion
+    queue. Runs once per process, on the first request (see start_serving) or at the start of
+    a command. Importing app.py does none of it, so the OCR worker processes, which import it
+    again as __mp_main__, and scripts like init_db.py stay cheap.
+    """
+    global ingestion_queue
+    with _setup_lock:
+        if _started["setup"]:
+            return
+
+        with app.app_context():
+            database.configure_engine(db.engine, app.config["SQLITE_PRAGMAS"])
+            connection = db.engine.raw_connection()
+            try:
+                migrate(connection.driver_connection)
+            finally:
+                connection.close()
+            db.create_all()
+            category_cache.maxsize = app.config["CATEGORY_CACHE_SIZE"]
+            category_cache.backend = SQLCategoryBackend(db.engine)
+            chart_cache.maxsize = app.config["CHART_CACHE_SIZE"]
+            metrics.enabled = app.config["METRICS_ENABLED"]
+
+            classifier_task, classifier_model = BACKENDS[app.config["CLASSIFIER_BACKEND"]]
+            classifier_registry.use(classifier_task, app.config["CLASSIFIER_MODEL"] or classifier_model)
+
+            ingestion_queue = IngestionQueue(
+                finish_receipt,
+                workers = app.config["INGEST_WORKERS"],
+                initargs = worker_initargs(),
+            )
+        _started["setup"] = True
+
+def worker_initargs():
+    """
+    The arguments ingestion._init_worker sets up every OCR worker process with.
+    """
+    return (
+        db.engine.url.render_as_string(hide_password=False),
+        app.config["CATEGORY_CACHE_SIZE"],
+        (classifier_registry.task, classifier_registry.model),
+        app.config["SQLITE_PRAGMAS"],
+    )
+
+def user_store_list(user_id):
+    """
+    The stores a user has shopped at before, plus the default store list. Used as the
+    personal store list when detecting the store on a new receipt.
+    """
+    rows = db.session.execute(db.select(ReceiptTable.content).filter_by(user_id=user_id).distinct())
+    stores = [store for store, in rows if store != "Could not determine"]
+    return STORES + sorted(set(stores) - set(STORES))
+
+def pipeline_options(user_id):
+    """
+    The settings ingestion.read_receipt uses for a receipt uploaded by this user.
+    """
+    return {
+        "store_list": user_store_list(user_id),
+        "batch_size": app.config["CLASSIFIER_BATCH_SIZE"],
+        "ocr_strips": app.config["OCR_STRIPS"],
+        "text_height": app.config["OCR_TEXT_HEIGHT"],
+        "thumbnail_width": app.config["THUMBNAIL_WIDTH"],
+    }
+
+def find_ocr_result(content_hash, data, user_id):
+    """
+    Looks for the OCR result of an earlier upload of the same image. Byte-identical uploads are
+    found by content hash, whoever uploaded them. If NEAR_DUPLICATE_DISTANCE is set, other
+    photos of the same receipt are found by perceptual hash: two hashes at most 3 bits apart
+    share at least one of their four 16-bit quarters, so only rows sharing a quarter are
+    compared. Mostly white receipts can get close hashes without being the same receipt, so
+    near duplicates are only looked for among the user's own receipts.
+
+    Inputs:
+    content_hash: str - SHA-256 of the upload
+    data: bytes - the upload, or str - path to it, only read when looking for near duplicates
+    user_id: int - the user who uploaded the image
+
+    Outputs:
+    result: OcrResultTable - the earlier result, or None
+    """
+    result = OcrResultTable.query.filter_by(content_hash = content_hash).first()
+    distance = min(app.config["NEAR_DUPLICATE_DISTANCE"], 3)
+    if result is not None or distance <= 0:
+        return result
+
+    if isinstance(data, str):
+        with open(data, "rb") as file:
+            data = file.read()
+    image_hash = perceptual_hash(data)
+    if image_hash is None:
+        return None
+
+    quarters = [db.func.substr(OcrResultTable.perceptual_hash, start + 1, 4) == image_hash[start:start + 4] for start in range(0, 16, 4)]
+    own_receipts = db.select(ReceiptTable.content_hash).filter_by(user_id = user_id)
+    for candidate in OcrResultTable.query.filter(db.or_(*quarters), OcrResultTable.content_hash.in_(own_receipts)):
+        if hamming_distance(candidate.perceptual_hash, image_hash) <= distance:
+            return candidate
+    return None
+
+def finish_receipt(receipt_id, result, error):
+    """
+    Writes the output of the ingestion pipeline to a receipt that was uploaded earlier.
+    Called by the ingestion queue once the receipt has been processed.
+
+    Inputs:
+    receipt_id: int - the receipt that was processed
+    result: dict - output of ingestion.read_receipt, None if processing failed
+    error: Exception - the reason processing failed, None if it succeeded
+    """
+    with app.app_context():
+        receipt = db.session.get(ReceiptTable, receipt_id)
+        # The user may have deleted the receipt while it was in the queue, and a receipt queued
+        # twice (e.g. by two processes resuming at once) only takes the first result.
+        if receipt is None or receipt.status != "processing":
+            return
+
+        # Reads come first: the write transaction starts with the first change sent to the
+        # database, and holds SQLite's write lock until the commit below.
+        before = rollups.snapshot(receipt)
+        save_ocr_result = error is None and receipt.content_hash and OcrResultTable.query.filter_by(content_hash = receipt.content_hash).first() is None
+        if error is not None:
+            metrics.inc("receipts_processed_total", status = "failed")
+            app.logger.error("Could not process receipt %s: %s", receipt_id, error)
+            receipt.content = "Could not determine"
+            receipt.status = "failed"
+        else:
+            metrics.merge(result.get("metrics"))
+            metrics.inc("receipts_processed_total", status = "done")
+            report = result["preprocessing"]
+            app.logger.info("Receipt %s rescaled by %.2f (text height %s px), preprocessing timings: %s", receipt_id, report["scale"], report["text_height"], {step: round(seconds, 4) for step, seconds in report["timings"].items()})
+            receipt.content = result["store"]
+            receipt.total = result["total"]
+            receipt.status = "done"
+            for item, total, category in result["items"]:
+                receipt.receipt_items.append(ItemTable(item = item, total = total, category = category))
+
+            if save_ocr_result:
+                db.session.add(OcrResultTable(
+                    content_hash = receipt.content_hash,
+                    perceptual_hash = result["perceptual_hash"],
+                    text = result["text"],
+                    store = result["store"],
+                    total = result["total"],
+                    items = json.dumps(result["items"]),
+                ))
+
+        try:
+            with metrics.timer("receipt_stage_seconds", stage = "db_commit"):
+                rollups.replace(db.session, before, rollups.snapshot(receipt))
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Could not save receipt %s", receipt_id)
+
+export_jobs = ExportJobs(app.config["EXPORT_PATH"], max_age = app.config["EXPORT_MAX_AGE_HOURS"] * 60 * 60)
+
+def resume_ingestion():
+    """
+    Queues receipts that were still processing when the server last stopped.
+    """
+    with app.app_context():
+        for receipt in ReceiptTable.query.filter_by(status = "processing").all():
+            images = receipt.images
+            ingestion_queue.submit(receipt.id, images if len(images) > 1 else images[0], **pipeline_options(receipt.user_id))
+
+@app.before_request
+def start_serving():
+    """
+    Sets the app up on the first request, then warms up the models and queues the receipts
+    left processing. With the reloader, `python app.py` runs in a watcher process and again
+    in the process that serves requests; only the second one gets here, so receipts are
+    queued once and the watcher never loads a model.
+    """
+    if _started["serving"]:
+        return
+    with _setup_lock:
+        if _started["serving"]:
+            return
+        setup()
+        if app.config["WARM_UP_MODELS"]:
+            classifier_registry.warm_up(background=True)
+        resume_ingestion()
+        _started["serving"] = True
 
 class RegisterForm(FlaskForm):
     username = StringField(validators=[InputRequired(), Length(min=4, max=20)], render_kw={"placeholder": "Username"})
@@ -115,72 +450,268 @@ def logout():
 @app.route('/home/<int:user_id>', methods=["POST", "GET"])
 @login_required
 def index(user_id):
+    require_owner(user_id)
     if request.method == "POST":
-        image = request.files.get('img')
-        file_path = os.path.join(app.config["UPLOAD_PATH"], image.filename)
-        image.save(file_path)
-
-        image = cv2.imread(file_path)
-        image = preprocessing.grayscale(image)
-        image = preprocessing.noise_removal(image)
-        image = preprocessing.thick_font(image)
-        image = preprocessing.remove_borders(image)
-        cv2.imwrite(file_path, image)
-
-        text = Receipt.get_receipt_text(file_path)
-        
+        uploads = [upload for upload in request.files.getlist('img') if upload.filename]
+        if not uploads:
+            return "Please choose an image of your receipt."
+        if len(uploads) > app.config["MAX_UPLOAD_FILES"]:
+            return "Please upload at most %d images at a time." % app.config["MAX_UPLOAD_FILES"], 413
+
+        # Each upload is copied into the blob store a chunk at a time under its content hash, and
+        # the pipeline reads it from there.
         try:
-            store = Receipt.get_store(text)
-            amount = Receipt.get_total(text)["Total"]
-            
-        except:
-            store = "Could not determine"
-            amount = "0"
+            with metrics.timer("receipt_stage_seconds", stage = "save"):
+                stored = [blob_store.put_stream(upload.stream, upload.filename, max_size = app.config["MAX_IMAGE_MB"] * 1024 * 1024)[:2] for upload in uploads]
+        except UploadTooLarge as error:
+            return str(error), 413
 
-        finally:
-            new_receipt = ReceiptTable(content = store, total = amount, user_id = user_id)
-            db.session.add(new_receipt)
-            db.session.commit()
-            items_dict = Receipt.get_items(text)
+        # The images are either the pages of one receipt or a batch of separate receipts.
+        if request.form.get('pages') == "1":
+            receipts = [stored]
+        else:
+            receipts = [[image] for image in stored]
 
-            for item in items_dict:
-                category = Receipt.get_item_category(item)
-                new_item = ItemTable(item = item, total = items_dict[item], category = category, receipt_id = new_receipt.id)
-                db.session.add(new_item)
-                db.session.commit()
-            
+        for pages in receipts:
+            try:
+                receipt_id = add_uploaded_receipt(user_id, pages)
+            except:
+                return "There was an issue adding your receipt."
+            if receipt_id is not None:
+                paths = [file_path for digest, file_path in pages]
+                ingestion_queue.submit(receipt_id, paths if len(paths) > 1 else paths[0], **pipeline_options(user_id))
+        return redirect(url_for('index', user_id = user_id))
+    else:
+        etag = listing_etag(user_id)
+        if etag in request.if_none_match:
+            return app.response_class(status=304, headers={"ETag": '"%s"' % etag})
+
+        filters = listing_filters(request.args)
         try:
-            db.session.commit()
-            return redirect(url_for('index', user_id = user_id))
-        except:
-            return "There was an issue adding your receipt."
+            receipts, next_cursor = receipt_page(db = db.session, user_id = user_id, **filters)
+        except ValueError:
+            # A stale or mangled cursor, start again from the first page.
+            filters["cursor"] = None
+            receipts, next_cursor = receipt_page(db = db.session, user_id = user_id, **filters)
+        stores = rollups.store_totals(db.session, user_id)
+        categories = rollups.category_totals(db.session, user_id)
+        receipt_total = sum(stores.values())
+
+        expenses_by_store_header = "Expenses by Store"
+        expenses_by_category_header = "Expenses by Category"
+
+        response = app.make_response(render_template("index.html", receipts=receipts, next_cursor=next_cursor, filters=filters, stores=stores, categories=categories, expenses_by_store_header=expenses_by_store_header, user_id = user_id, expenses_by_category_header=expenses_by_category_header, receipt_total=receipt_total))
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
+def add_uploaded_receipt(user_id, pages):
+    """
+    Adds an uploaded receipt. If the same image (or, for several pages, the same pages in the
+    same order) was read before, the earlier result is used and the receipt is done right away.
+
+    Inputs:
+    user_id: int - the user who uploaded the receipt
+    pages: list - (content_hash, path) of every image of the receipt, in order
+
+    Outputs:
+    receipt_id: int - the new receipt, waiting to be processed, or None if it is already done
+    """
+    if len(pages) == 1:
+        digest, file_path = pages[0]
+        cached = find_ocr_result(digest, file_path, user_id)
+        page_list = None
     else:
-        receipts = ReceiptTable.query.filter_by(user_id=user_id).order_by(ReceiptTable.date_created).all()
-        receipt_totals, unique_stores, unique_categories = index_calculations(db=receipts)
-        receipt_total = sum(receipt_totals)
+        digest = content_hash("\n".join(page_digest for page_digest, path in pages).encode())
+        file_path = pages[0][1]
+        cached = OcrResultTable.query.filter_by(content_hash = digest).first()
+        page_list = json.dumps([path for page_digest, path in pages])
 
-        unique_stores = pd.DataFrame.from_dict(unique_stores, orient='index', columns=["Total"])
-        unique_categories = pd.DataFrame.from_dict(unique_categories, orient='index', columns=["Total"])
+    if cached is not None:
+        # The same receipt was read before, reuse its result instead of running OCR again.
+        metrics.inc("ocr_result_reuses_total")
+        new_receipt = ReceiptTable(content = cached.store, total = cached.total, image = file_path, pages = page_list, content_hash = digest, user_id = user_id)
+        for item, total, category in json.loads(cached.items):
+            new_receipt.receipt_items.append(ItemTable(item = item, total = total, category = category))
+        db.session.add(new_receipt)
+        db.session.flush()
+        rollups.apply(db.session, rollups.snapshot(new_receipt))
+        db.session.commit()
+        return None
 
-        fig = px.bar(unique_stores, x=unique_stores.index, y="Total", labels={"Total": "Total Spent at Store"})
-        fig.update_layout(title_text=None)
-        fig.update_xaxes(title_text="Stores")
-        expenses_by_store = pio.to_html(fig, full_html=False)
+    new_receipt = ReceiptTable(content = "Processing", total = "0", status = "processing", image = file_path, pages = page_list, content_hash = digest, user_id = user_id)
+    db.session.add(new_receipt)
+    db.session.flush()
+    rollups.apply(db.session, rollups.snapshot(new_receipt, items = []))
+    db.session.commit()
+    return new_receipt.id
 
-        fig = px.bar(unique_categories, x=unique_categories.index, y="Total", labels={"Total": "Total Spent in Category"})
-        fig.update_layout(title_text=None)
-        expenses_by_category = pio.to_html(fig, full_html=False)
+@app.route('/thumbnail/<int:user_id>/<int:receipt_id>')
+@login_required
+def thumbnail(user_id, receipt_id):
+    """
+    The thumbnail of a receipt's (first) image. It is made when the receipt is read, or here
+    the first time it is asked for if the receipt was uploaded before thumbnails existed.
+    """
+    require_owner(user_id)
+    receipt = ReceiptTable.query.filter_by(id = receipt_id, user_id = user_id).first_or_404()
+    if not receipt.image or not os.path.exists(receipt.image):
+        abort(404)
+    path = ensure_thumbnail(receipt.image, app.config["THUMBNAIL_WIDTH"])
+    if path is None:
+        abort(404)
+    response = send_file(path, mimetype="image/jpeg")
+    response.headers["Cache-Control"] = "private, max-age=86400"
+    return response
 
-        expenses_by_store_header = "Expenses by Store"
-        expenses_by_category_header = "Expenses by Category"
+def listing_filters(args):
+    """
+    Reads the receipt listing's cursor, page size and filters from the query string.
 
-        return render_template("index.html", receipts=receipts, expenses_by_store_header=expenses_by_store_header, expenses_by_store=expenses_by_store, user_id = user_id, expenses_by_category=expenses_by_category, expenses_by_category_header=expenses_by_category_header, receipt_totals=receipt_totals, receipt_total=receipt_total)
+    Outputs:
+    filters: dict - cursor, limit, store, category, start and end, as receipt_page takes them
+    """
+    limit = args.get('limit', type=int) or app.config["PAGE_SIZE"]
+    return {
+        "cursor": args.get('cursor') or None,
+        "limit": max(1, min(limit, app.config["MAX_PAGE_SIZE"])),
+        "store": args.get('store') or None,
+        "category": args.get('category') or None,
+        "start": parse_date(args.get('start')),
+        "end": parse_date(args.get('end')),
+    }
+
+def listing_etag(user_id):
+    """
+    ETag of a page of the receipt listing. A page only changes when the user's data version
+    does (every change to a receipt's store, status or items bumps it), so the version and
+    the request's path and query string identify the page's content.
+    """
+    version = rollups.data_version(db.session, user_id)
+    return hashlib.sha1(("%s|%s|%s" % (version, request.path, request.query_string.decode())).encode()).hexdigest()
+
+@app.route('/api/receipts/<int:user_id>')
+@login_required
+def api_receipts(user_id):
+    """
+    One page of the user's receipts as JSON, newest first. Pass the returned next_cursor as
+    ?cursor= to get the following page. Accepts the same limit, store, category, start and
+    end parameters as the home page.
+    """
+    require_owner(user_id)
+    etag = listing_etag(user_id)
+    if etag in request.if_none_match:
+        return app.response_class(status=304, headers={"ETag": '"%s"' % etag})
+
+    try:
+        receipts, next_cursor = receipt_page(db = db.session, user_id = user_id, **listing_filters(request.args))
+    except ValueError as error:
+        return jsonify(error = str(error)), 400
+
+    for receipt in receipts:
+        receipt["date_created"] = receipt["date_created"].isoformat()
+    response = jsonify(receipts = receipts, next_cursor = next_cursor)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+def parse_date(value):
+    """
+    Reads a YYYY-MM-DD date from a form field, None if it is empty or not a date.
+    """
+    try:
+        return date.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+def spending_filters(args):
+    """
+    Reads the spending page's filters from the query string, falling back to monthly totals over the whole history.
+
+    Outputs:
+    filters: dict - start, end, period and by, as spending_over_time takes them
+    """
+    return {
+        "start": parse_date(args.get('start')),
+        "end": parse_date(args.get('end')),
+        "period": args.get('period') if args.get('period') in FREQUENCIES else "month",
+        "by": args.get('by') if args.get('by') in ("store", "category") else None,
+    }
+
+@app.route('/spending/<int:user_id>')
+@login_required
+def spending(user_id):
+    require_owner(user_id)
+    filters = spending_filters(request.args)
+    header = "Spending per %s" % filters["period"].capitalize()
+    chart_url = url_for('chart_data', user_id = user_id, chart = "spending", **filters)
+
+    return render_template('spending.html', chart_url=chart_url, header=header, user_id=user_id, periods=list(FREQUENCIES), **filters)
+
+def spending_chart(user_id, start, end, period, by):
+    spending = spending_over_time(db = db.session, user_id = user_id, start = start, end = end, period = period, by = by)
+    return stacked_bar_chart(spending, period.capitalize(), "Total Spent", by.capitalize() if by else None)
+
+@app.route('/chart-data/<int:user_id>/<chart>')
+@login_required
+def chart_data(user_id, chart):
+    """
+    Serves a chart's Plotly figure as JSON. Payloads are cached under the user's data version,
+    which is also the ETag, so a browser that already has the chart gets a 304 until the
+    user's receipts change.
+    """
+    require_owner(user_id)
+    version = rollups.data_version(db.session, user_id)
+
+    if chart == "stores":
+        key = (user_id, version, chart)
+        build = lambda: bar_chart(rollups.store_totals(db.session, user_id), "Stores", "Total Spent at Store")
+    elif chart == "categories":
+        key = (user_id, version, chart)
+        build = lambda: bar_chart(rollups.category_totals(db.session, user_id), "Categories", "Total Spent in Category")
+    elif chart == "receipt":
+        receipt = ReceiptTable.query.filter_by(id=request.args.get('receipt_id', type=int), user_id=user_id).first_or_404()
+        key = (user_id, version, chart, receipt.id)
+        build = lambda: pie_chart(items_calculations(db = db.session, receipt_id = receipt.id)[0])
+    elif chart == "spending":
+        filters = spending_filters(request.args)
+        key = (user_id, version, chart) + tuple(filters.values())
+        build = lambda: spending_chart(user_id, **filters)
+    else:
+        abort(404)
+
+    response = app.response_class(chart_cache.get_or_build(key, build), mimetype="application/json")
+    response.set_etag("-".join(str(part) for part in key))
+    # Browsers keep the chart but revalidate it on every view.
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
+
+@app.route('/plotly-<version>.min.js')
+def plotly_js(version):
+    """
+    Serves the Plotly bundle that ships with the plotly package. The version is part of the
+    URL, so browsers cache the bundle for a year and download it once.
+    """
+    bundle = os.path.join(os.path.dirname(plotly.__file__), "package_data", "plotly.min.js")
+    return send_file(bundle, mimetype="text/javascript", max_age=365 * 24 * 60 * 60)
+
+@app.context_processor
+def plotly_version():
+    return {"plotly_version": plotly.__version__}
+
+@app.route('/receipt-status/<int:user_id>/<int:receipt_id>')
+@login_required
+def receipt_status(user_id, receipt_id):
+    require_owner(user_id)
+    receipt = ReceiptTable.query.filter_by(id=receipt_id, user_id=user_id).first_or_404()
+    return jsonify(id = receipt.id, status = receipt.status, content = receipt.content, total = receipt.total)
 
 @app.route('/delete<int:user_id>/<int:receipt_id>')
 def delete(user_id, receipt_id):
     task_to_delete = ReceiptTable.query.filter_by(id=receipt_id, user_id=user_id).first_or_404()
 
     try:
+        rollups.apply(db.session, rollups.snapshot(task_to_delete), -1)
         db.session.delete(task_to_delete)
         db.session.commit()
         return redirect(url_for('index', user_id=user_id, receipt_id=receipt_id))
@@ -192,9 +723,11 @@ def update(user_id, receipt_id):
     task = ReceiptTable.query.filter_by(id=receipt_id, user_id=user_id).first_or_404()
 
     if request.method == 'POST':
-        task.content = request.form['content']
-        task.total = request.form['total']
         try:
+            before = rollups.snapshot(task)
+            task.content = request.form['content']
+            task.total = request.form['total']
+            rollups.replace(db.session, before, rollups.snapshot(task))
             db.session.commit()
             return redirect(url_for('index', user_id=user_id))
         except:
@@ -205,28 +738,32 @@ def update(user_id, receipt_id):
 @app.route('/items/<int:user_id>/<int:receipt_id>')
 def items(user_id, receipt_id):
     receipt = ReceiptTable.query.filter_by(id=receipt_id, user_id=user_id).first_or_404()
-    categories, receipt_total = items_calculations(db = receipt)
-    categories = pd.DataFrame.from_dict(categories, orient='index', columns=["Total"])
-
-    fig = px.pie(categories, names=categories.index, values="Total")
-    fig.update_layout(title_text=None)
-    plot_html = pio.to_html(fig, full_html=False)
+    receipt_total = items_calculations(db = db.session, receipt_id = receipt.id)[1]
 
     header = "Expenses by Category"
 
-    return render_template('items.html', receipt = receipt, plot_html=plot_html, header=header, user_id=user_id, receipt_id=receipt_id, receipt_total=receipt_total)
+    return render_template('items.html', receipt = receipt, header=header, user_id=user_id, receipt_id=receipt_id, receipt_total=receipt_total)
 
 @app.route('/update-item/<int:user_id>/<int:item_id>', methods=['GET', 'POST'])
+@login_required
 def update_item(user_id, item_id):
+    require_owner(user_id)
     item = ItemTable.query.get_or_404(item_id)
+    # The correction below is remembered for every user, so only the owner of the item may make it.
+    if item.receipt_table is None or item.receipt_table.user_id != current_user.id:
+        abort(404)
     receipt_id = item.receipt_id
 
     if request.method == 'POST':
-        item.item = request.form['content']
-        item.total = request.form['total']
-        item.category = request.form['category']
         try:
+            before = rollups.snapshot(item.receipt_table)
+            item.item = request.form['content']
+            item.total = request.form['total']
+            item.category = request.form['category']
+            rollups.replace(db.session, before, rollups.snapshot(item.receipt_table))
             db.session.commit()
+            # The user's correction is used for this item on every future receipt.
+            category_cache.put(item.item, CATEGORIES, item.category, source = "user")
             return redirect(url_for('items', receipt_id = receipt_id, user_id=user_id))
         except:
             return "There was an issue updating the item name or total."
@@ -239,7 +776,11 @@ def delete_item(user_id, item_id):
     receipt_id = item_to_delete.receipt_id
 
     try:
+        receipt = item_to_delete.receipt_table
+        before = rollups.snapshot(receipt)
+        receipt.receipt_items.remove(item_to_delete)
         db.session.delete(item_to_delete)
+        rollups.replace(db.session, before, rollups.snapshot(receipt))
         db.session.commit()
         return redirect(url_for('items', receipt_id = receipt_id, user_id=user_id))
     except:
@@ -252,12 +793,253 @@ def add_item(user_id, receipt_id):
             return "Please enter a valid number for item amount."
 
         try:
-            new_item = ItemTable(item = request.form['content'], total = float(request.form['total']), category = request.form['category'], receipt_id = receipt_id)
+            receipt = ReceiptTable.query.filter_by(id=receipt_id, user_id=user_id).first_or_404()
+            before = rollups.snapshot(receipt)
+            new_item = ItemTable(item = request.form['content'], total = request.form['total'], category = request.form['category'])
+            receipt.receipt_items.append(new_item)
             db.session.add(new_item)
+            rollups.replace(db.session, before, rollups.snapshot(receipt))
             db.session.commit()
             return redirect(url_for('items', receipt_id = receipt_id, user_id=user_id, item_id = new_item.id))
         except:
             return "There was a problem adding that item."
 
+@app.route('/export/<int:user_id>.csv')
+@login_required
+def export_csv(user_id):
+    """
+    Every receipt and item of the user as CSV, one row per item, oldest receipt first. The
+    rows are read and sent a chunk at a time, on a connection of their own.
+    """
+    require_owner(user_id)
+    engine = db.engine
+    chunk_size = app.config["EXPORT_CHUNK_SIZE"]
+
+    def generate():
+        with engine.connect() as connection:
+            yield from csv_chunks(iter_chunks(connection, user_id, chunk_size))
+
+    return app.response_class(generate(), mimetype="text/csv", headers={"Content-Disposition": "attachment; filename=receipts-%d.csv" % user_id})
+
+def export_status_json(user_id, job):
+    status = {key: job[key] for key in ("id", "format", "status", "rows", "error")}
+    status["status_url"] = url_for('export_status', user_id = user_id, job_id = job["id"])
+    if job["status"] == "done":
+        status["download_url"] = url_for('export_download', user_id = user_id, job_id = job["id"])
+    return status
+
+@app.route('/api/exports/<int:user_id>', methods=['POST'])
+@login_required
+def start_export(user_id):
+    """
+    Starts a background export of the user's receipts and items. Takes ?format=parquet (the
+    default), arrow or csv. Returns the job, follow its status_url until it is done.
+    """
+    require_owner(user_id)
+    format = request.args.get('format', 'parquet')
+    if format not in FORMATS:
+        return jsonify(error = "format must be one of %s." % ", ".join(FORMATS)), 400
+
+    job_id = export_jobs.submit(db.engine, user_id, format, app.config["EXPORT_CHUNK_SIZE"])
+    return jsonify(export_status_json(user_id, export_jobs.get(job_id))), 202
+
+@app.route('/api/exports/<int:user_id>/<job_id>')
+@login_required
+def export_status(user_id, job_id):
+    require_owner(user_id)
+    job = export_jobs.get(job_id)
+    if job is None or job["user_id"] != user_id:
+        abort(404)
+    return jsonify(export_status_json(user_id, job))
+
+@app.route('/api/exports/<int:user_id>/<job_id>/download')
+@login_required
+def export_download(user_id, job_id):
+    require_owner(user_id)
+    job = export_jobs.get(job_id)
+    if job is None or job["user_id"] != user_id or job["status"] != "done":
+        abort(404)
+    return send_file(job["path"], as_attachment=True, download_name="receipts-%d%s" % (user_id, FORMATS[job["format"]]))
+
+@app.cli.command("export-receipts")
+@click.argument("username")
+@click.argument("output")
+@click.option("--format", "format", type=click.Choice(list(FORMATS)), help="Defaults to the extension of OUTPUT, or csv.")
+@click.option("--chunk-size", type=int, default=5000, show_default=True, help="Rows read and written at a time.")
+def export_receipts_command(username, output, format, chunk_size):
+    """
+    Exports every receipt and item of USERNAME to OUTPUT as CSV, Parquet or Arrow, one row per
+    item. OUTPUT - writes to standard output.
+    """
+    setup()
+    user = User.query.filter_by(username = username).first()
+    if user is None:
+        raise click.ClickException("There is no user named %s." % username)
+
+    if format is None:
+        extensions = {extension: name for name, extension in FORMATS.items()}
+        format = extensions.get(os.path.splitext(output)[1].lower(), "csv")
+
+    started = time.perf_counter()
+    if output == "-":
+        with db.engine.connect() as connection:
+            rows = write_export(iter_chunks(connection, user.id, chunk_size), sys.stdout.buffer, format)
+    else:
+        rows = export_receipts(db.engine, user.id, output, format, chunk_size)
+    click.echo("Exported %d rows in %.1f s." % (rows, time.perf_counter() - started), err=True)
+
+@app.cli.command("rebuild-rollups")
+@click.option("--check", is_flag=True, help="Only compare the rollups with the receipts, without rebuilding them.")
+def rebuild_rollups(check):
+    """
+    Recomputes the per-user spending rollups from the receipt and item tables and reports
+    any rows that had drifted.
+    """
+    setup()
+    mismatches = rollups.rebuild(db.session, check = check)
+    for table, rows in mismatches.items():
+        for key, stored, expected in rows:
+            click.echo("%s %s: stored %s, expected %s" % (table, key, stored, expected))
+    if not check:
+        db.session.commit()
+    click.echo("%d mismatched rows%s." % (sum(len(rows) for rows in mismatches.values()), "" if check else ", rollups rebuilt"))
+    if check and mismatches:
+        raise SystemExit(1)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Every metric in the Prometheus text format, for a Prometheus server to scrape.
+    """
+    metrics.set("category_cache_entries", category_cache.stats()["size"])
+    metrics.set("chart_cache_entries", chart_cache.stats()["size"])
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.before_request
+def start_profile():
+    if app.config["PROFILE_DIR"] and request.args.get("profile") == "1":
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+@app.after_request
+def dump_profile(response):
+    """
+    Writes the profile of a request made with ?profile=1 to PROFILE_DIR, named after the time
+    and the endpoint, for `python -m pstats` or snakeviz. Work done in ingestion worker
+    processes is not included, set INGEST_WORKERS=0 to profile the whole pipeline.
+    """
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.disable()
+        os.makedirs(app.config["PROFILE_DIR"], exist_ok=True)
+        profile.dump_stats(os.path.join(app.config["PROFILE_DIR"], "%s-%s.prof" % (datetime.now().strftime("%Y%m%d-%H%M%S-%f"), request.endpoint)))
+    return response
+
+def save_imported_receipts(user_id, batch):
+    """
+    Writes a batch of imported receipts in one transaction. The receipts and their items are
+    added in a single flush, which SQLAlchemy sends as multi-row INSERTs.
+
+    Inputs:
+    user_id: int - the user the receipts are imported for
+    batch: list - (key, result) pairs, key being (name, content_hash, path, modified, cached) and result
+           the output of ingestion.read_receipt with categories filled in
+    """
+    receipts = []
+    for (name, content_hash, path, modified, cached), result in batch:
+        receipt = ReceiptTable(content = result["store"], total = result["total"], status = "done", image = path, content_hash = content_hash, date_created = modified, user_id = user_id)
+        for item, total, category in result["items"]:
+            receipt.receipt_items.append(ItemTable(item = item, total = total, category = category))
+        receipts.append(receipt)
+
+        if not cached:
+            db.session.add(OcrResultTable(
+                content_hash = content_hash,
+                perceptual_hash = result["perceptual_hash"],
+                text = result["text"],
+                store = result["store"],
+                total = result["total"],
+                items = json.dumps(result["items"]),
+            ))
+
+    with metrics.timer("receipt_stage_seconds", stage = "db_commit"):
+        db.session.add_all(receipts)
+        db.session.flush()
+        for receipt in receipts:
+            rollups.apply(db.session, rollups.snapshot(receipt))
+        db.session.commit()
+    metrics.inc("receipts_processed_total", len(receipts), status = "done")
+
+@app.cli.command("import-receipts")
+@click.argument("username")
+@click.argument("path", type=click.Path(exists=True))
+@click.option("--workers", type=int, default=os.cpu_count() or 1, show_default=True, help="Worker processes that OCR receipts, 0 runs OCR in this process.")
+@click.option("--commit-every", type=int, default=50, show_default=True, help="Receipts written per transaction.")
+def import_receipts(username, path, workers, commit_every):
+    """
+    Imports a directory or zip file of receipt images for USERNAME. Images are OCRed in a pool
+    of worker processes, the items of each batch of receipts are classified together and every
+    batch is written in one transaction. Each receipt is dated with its file's modification time.
+
+    Images already imported for the user are skipped, so an interrupted import picks up where
+    it stopped when it is run again.
+    """
+    setup()
+    user = User.query.filter_by(username = username).first()
+    if user is None:
+        raise click.ClickException("There is no user named %s." % username)
+
+    options = pipeline_options(user.id)
+    # Receipts are read in parallel, so each one is OCRed in a single pass.
+    options["ocr_strips"] = 1
+    imported = {digest for (digest,) in db.session.query(ReceiptTable.content_hash).filter_by(user_id = user.id) if digest}
+    counts = {"imported": 0, "skipped": 0, "failed": 0}
+    ready = []
+    started = time.perf_counter()
+
+    def jobs():
+        for name, data, modified in iter_images(path):
+            digest = content_hash(data)
+            if digest in imported:
+                counts["skipped"] += 1
+                continue
+            imported.add(digest)
+
+            file_path = blob_store.put(data, name)[1]
+            cached = find_ocr_result(digest, data, user.id)
+            if cached is not None:
+                metrics.inc("ocr_result_reuses_total")
+                ready.append(((name, digest, file_path, modified, True), {"store": cached.store, "total": cached.total, "items": json.loads(cached.items)}))
+                if len(ready) >= commit_every:
+                    flush()
+            else:
+                # Workers read the stored copy, and write its thumbnail next to it.
+                yield (name, digest, file_path, modified, False), file_path
+
+    def flush():
+        classify_results([result for key, result in ready], batch_size = options["batch_size"])
+        save_imported_receipts(user.id, ready)
+        counts["imported"] += len(ready)
+        ready.clear()
+        elapsed = time.perf_counter() - started
+        click.echo("%(imported)d imported, %(skipped)d skipped, %(failed)d failed" % counts + " (%.2f receipts/sec)" % (counts["imported"] / elapsed))
+
+    for key, result, error in read_receipts(jobs(), workers = workers, initargs = worker_initargs(), **options):
+        if error is not None:
+            counts["failed"] += 1
+            # Failed images are not recorded, running the import again retries them.
+            imported.discard(key[1])
+            click.echo("Could not read %s: %s" % (key[0], error), err=True)
+        else:
+            metrics.merge(result.pop("metrics", None))
+            ready.append((key, result))
+        if len(ready) >= commit_every:
+            flush()
+    if ready:
+        flush()
+
+    elapsed = time.perf_counter() - started
+    click.echo("Imported %d receipts in %.1f s (%.2f receipts/sec), skipped %d already imported, %d failed." % (counts["imported"], elapsed, counts["imported"] / elapsed if elapsed else 0, counts["skipped"], counts["failed"]))
+
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,65 @@
+"""
+Measures receipt parsing throughput over a synthetic corpus, comparing receipt_parser.parse
+with the two separate regex scans get_items and get_total used to make.
+
+Usage: python benchmarks/bench_parser.py [--receipts 5000] [--repeat 5]
+"""
+
+__author__ = "Kevin Dougherty"
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from receipt_parser import parse
+from stubs import synthetic_receipt
+
+def legacy_parse(text):
+    """
+    The old Receipt.get_items followed by Receipt.get_total (without its crash on a total line with no price).
+    """
+    items = {}
+    for line in text.split("\n"):
+        amount = re.search(r"\d+\.\d{2}$", string=line)
+        item = "".join(filter(str.isalpha, line.rsplit(" ", 1)[0]))
+        if amount and len(item) != 0:
+            items[item] = amount.group()
+    totals = {}
+    for line in text.split("\n"):
+        if "subtotal" in line.lower():
+            amount = re.search(r"\d+\.\d{2}$", string=line)
+            if amount:
+                totals["SubTotal"] = amount.group()
+        if "total" in line.lower():
+            amount = re.search(r"\d+\.\d{2}$", string=line)
+            if amount:
+                totals["Total"] = amount.group()
+    return items, totals
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--receipts", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    generator = random.Random(0)
+    corpus = [synthetic_receipt(generator) for _ in range(args.receipts)]
+    lines = sum(text.count("\n") + 1 for text in corpus)
+    print("%d receipts, %d lines" % (len(corpus), lines))
+
+    for name, function in (("get_items + get_total", legacy_parse), ("receipt_parser.parse", parse)):
+        best = float("inf")
+        for _ in range(args.repeat):
+            began = time.perf_counter()
+            for text in corpus:
+                function(text)
+            best = min(best, time.perf_counter() - began)
+        print("%-22s %8.1f ms %10.0f receipts/sec %10.0f lines/sec" % (name, best * 1000, len(corpus) / best, lines / best))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Times spending_over_time for users with one to twenty years of receipts, always asking for the
+same three-month window. The time should stay flat as the history grows, because only the rows
+in the window are fetched.
+
+Usage: python benchmarks/bench_timeseries.py [--years 1 5 10 20] [--receipts-per-day 3] [--repeat 5]
+"""
+
+__author__ = "Kevin Dougherty"
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import rollups
+from db_calculations import spending_over_time
+
+SCHEMA = [
+    """CREATE TABLE receipt_table (
+        id INTEGER PRIMARY KEY, content VARCHAR(200) NOT NULL, total_cents INTEGER NOT NULL DEFAULT 0,
+        date_created DATETIME, status VARCHAR(20) NOT NULL DEFAULT 'done', image VARCHAR(500),
+        content_hash VARCHAR(64), user_id INTEGER
+    )""",
+    """CREATE TABLE item_table (
+        id INTEGER PRIMARY KEY, item VARCHAR(200) NOT NULL, total_cents INTEGER NOT NULL DEFAULT 0,
+        category VARCHAR(200) NOT NULL, receipt_id INTEGER
+    )""",
+    "CREATE INDEX ix_receipt_table_user_id_date_created ON receipt_table (user_id, date_created)",
+    "CREATE INDEX ix_item_table_receipt_id_category ON item_table (receipt_id, category)",
+] + rollups.TABLES + [rollups.VERSIONS]
+
+STORES = ["Target", "CVS", "Trader Joe's", "Taco Bell", "Costco"]
+CATEGORIES = ["Food", "Beauty", "Clothes", "Home", "Discount"]
+
+def build(path, years, receipts_per_day, end):
+    """
+    Creates a database with one user and years of synthetic receipts ending on end.
+    """
+    engine = create_engine("sqlite:///" + path)
+    generator = random.Random(years)
+    with engine.begin() as connection:
+        for statement in SCHEMA:
+            connection.execute(text(statement))
+
+        receipts, items = [], []
+        day = end - timedelta(days=365 * years)
+        while day <= end:
+            for _ in range(receipts_per_day):
+                receipt_id = len(receipts) + 1
+                created = datetime.combine(day, datetime.min.time()) + timedelta(minutes=generator.randrange(24 * 60))
+                receipts.append({"id": receipt_id, "content": generator.choice(STORES), "date_created": created.strftime("%Y-%m-%d %H:%M:%S.%f")})
+                for _ in range(generator.randint(2, 8)):
+                    items.append({"receipt_id": receipt_id, "category": generator.choice(CATEGORIES), "cents": generator.randint(99, 4999)})
+            day += timedelta(days=1)
+
+        connection.execute(text("INSERT INTO receipt_table (id, content, date_created, user_id) VALUES (:id, :content, :date_created, 1)"), receipts)
+        connection.execute(text("INSERT INTO item_table (item, total_cents, category, receipt_id) VALUES ('item', :cents, :category, :receipt_id)"), items)
+        rollups.rebuild(connection)
+
+    return engine, len(receipts), len(items)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 5, 10, 20])
+    parser.add_argument("--receipts-per-day", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    end = date(2025, 12, 31)
+    start = end - timedelta(days=90)
+    print("%6s %9s %9s %14s %14s %14s" % ("years", "receipts", "items", "total ms", "by store ms", "by category ms"))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for years in args.years:
+            engine, receipt_count, item_count = build(os.path.join(directory, "bench_%d.db" % years), years, args.receipts_per_day, end)
+            timings = []
+            with Session(engine) as session:
+                for by in (None, "store", "category"):
+                    best = float("inf")
+                    for _ in range(args.repeat):
+                        began = time.perf_counter()
+                        spending_over_time(session, 1, start = start, end = end, period = "week", by = by)
+                        best = min(best, time.perf_counter() - began)
+                    timings.append(best * 1000)
+            engine.dispose()
+            print("%6d %9d %9d %14.1f %14.1f %14.1f" % (years, receipt_count, item_count, *timings))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Measures how often the embedding classifier (embedding_classifier.py) agrees with BART on a
+held-out set of items, with and without labeled examples, and how fast it is.
+
+The labeled items come from the category_cache table, which holds BART's category for every
+item the app has classified plus the corrections users made by hand, or from a CSV file with
+item and category columns. The items are shuffled and split: the held-out part is classified,
+the rest is given to the classifier as labeled examples, like user corrections are in the app.
+With --reference bart the held-out items are classified again by BART instead of trusting the
+stored labels (needs transformers).
+
+Usage:
+python benchmarks/eval_classifier.py --database sqlite:///instance/test.db
+python benchmarks/eval_classifier.py --labels items.csv --holdout 0.3 --output eval.json
+"""
+
+__author__ = "Kevin Dougherty"
+
+import argparse
+import csv
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from category_cache import categories_key, normalize_item
+from classifier import classify, ClassifierRegistry, DEFAULT_BATCH_SIZE, DEFAULT_EMBEDDING_MODEL
+from embedding_classifier import EmbeddingClassifier
+from receipt import CATEGORIES
+
+def read_labels(args):
+    """
+    Outputs:
+    labels: dict - keys are normalized item texts, values are their categories
+    """
+    if args.labels:
+        with open(args.labels, newline="") as file:
+            return {normalize_item(row["item"]): row["category"] for row in csv.DictReader(file) if row["category"] in CATEGORIES}
+
+    from sqlalchemy import create_engine, text
+    with create_engine(args.database).connect() as connection:
+        rows = connection.execute(text("SELECT item_key, category FROM category_cache WHERE categories = :categories"), {"categories": categories_key(CATEGORIES)})
+        return dict(rows.all())
+
+def accuracy(predicted, expected):
+    """
+    Outputs:
+    report: dict - overall accuracy and, per expected category, the number of items and the accuracy
+    """
+    per_category = {}
+    for item, category in expected.items():
+        counts = per_category.setdefault(category, [0, 0])
+        counts[0] += 1
+        counts[1] += predicted[item] == category
+    correct = sum(right for total, right in per_category.values())
+    return {
+        "accuracy": correct / len(expected) if expected else 0.0,
+        "categories": {category: {"items": total, "accuracy": right / total} for category, (total, right) in sorted(per_category.items())},
+    }
+
+def run(classifier, items, batch_size):
+    """
+    Outputs:
+    [0]: predicted: dict - the best category of every item
+    [1]: seconds: float - time taken
+    """
+    started = time.perf_counter()
+    results = classify(items, CATEGORIES, batch_size = batch_size, classifier = classifier)
+    return {item: result["labels"][0] for item, result in zip(items, results)}, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database", default="sqlite:///instance/test.db", help="database to read the category_cache table from")
+    parser.add_argument("--labels", help="CSV file with item and category columns, used instead of the database")
+    parser.add_argument("--reference", choices=["stored", "bart"], default="stored", help="labels to compare with: the stored ones or BART run now")
+    parser.add_argument("--holdout", type=float, default=0.3, help="fraction of the items held out for evaluation")
+    parser.add_argument("--model", default=DEFAULT_EMBEDDING_MODEL)
+    parser.add_argument("--threshold", type=float, default=0.8, help="example_threshold of the embedding classifier")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    labels = read_labels(args)
+    items = sorted(labels)
+    random.Random(args.seed).shuffle(items)
+    held_out = items[:max(1, int(len(items) * args.holdout))] if items else []
+    examples = {item: labels[item] for item in items[len(held_out):]}
+    if not held_out:
+        raise SystemExit("No labeled items to evaluate.")
+
+    expected = {item: labels[item] for item in held_out}
+    report = {"items": len(items), "held_out": len(held_out), "examples": len(examples), "model": args.model}
+
+    if args.reference == "bart":
+        bart = ClassifierRegistry().get()
+        run(bart, held_out[:1], args.batch_size)
+        expected, seconds = run(bart, held_out, args.batch_size)
+        report["bart"] = {"seconds": seconds, "items_per_sec": len(held_out) / seconds}
+
+    classifier = EmbeddingClassifier(args.model, example_threshold = args.threshold)
+    started = time.perf_counter()
+    classifier.get_encoder()
+    report["load_seconds"] = time.perf_counter() - started
+    # The first call also embeds the labels.
+    run(classifier, held_out[:1], args.batch_size)
+
+    predicted, seconds = run(classifier, held_out, args.batch_size)
+    report["labels_only"] = dict(accuracy(predicted, expected), seconds = seconds, items_per_sec = len(held_out) / seconds)
+
+    classifier.examples = lambda candidate_labels: examples
+    run(classifier, held_out[:1], args.batch_size)
+    predicted, seconds = run(classifier, held_out, args.batch_size)
+    report["with_examples"] = dict(accuracy(predicted, expected), seconds = seconds, items_per_sec = len(held_out) / seconds)
+
+    # Peak resident memory of this process, which holds the encoder (and BART with --reference bart).
+    report["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""
+Benchmark suite for the receipt pipeline. Runs offline: tesseract and BART are replaced with
+the stand-ins in stubs.py, receipts are generated, and the app runs against a temporary
+database and upload directory, so nothing in the working tree is touched.
+
+Sections:
+preprocessing - each Preprocessing step on generated receipt images of several sizes
+parser        - receipt_parser.parse, Receipt.get_items and Receipt.get_total on a synthetic corpus
+db            - the home page's queries (receipt_page and the store and category rollups) and
+                items_calculations for users with 10^3 to 10^6 items
+upload        - end-to-end uploads per second through the Flask test client
+
+Usage:
+python benchmarks/run.py --output results.json
+python benchmarks/run.py --sections parser db --items 1000 1000000
+python benchmarks/run.py --output new.json --compare old.json --threshold 0.2
+
+With --compare, every timing that got slower (or throughput that dropped) by more than the
+threshold is listed and the exit status is 1.
+"""
+
+__author__ = "Kevin Dougherty"
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import stubs
+
+SECTIONS = ["preprocessing", "parser", "db", "upload"]
+
+def best_of(repeat, function, *args, **kwargs):
+    """
+    Outputs:
+    seconds: float - the fastest of repeat runs of function
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(*args, **kwargs)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def bench_preprocessing(args):
+    from preprocessing import Preprocessing
+
+    preprocessing = Preprocessing()
+    generator = random.Random(args.seed)
+    results = {}
+    for items in args.receipt_items:
+        image = stubs.receipt_image(stubs.synthetic_receipt(generator, items), width = args.image_width, seed = args.seed)
+        data = stubs.encode_png(image)
+        runs = []
+        for _ in range(args.repeat):
+            report = {}
+            started = time.perf_counter()
+            preprocessing.preprocess(preprocessing.decode(data), text_height = args.text_height, report = report)
+            report["timings"]["total"] = time.perf_counter() - started
+            runs.append(report["timings"])
+        size = "%dx%d" % (image.shape[1], image.shape[0])
+        results[size] = {"seconds": {step: min(run[step] for run in runs) for step in runs[0]}}
+    return results
+
+def bench_parser(args):
+    from receipt_parser import parse
+    from receipt import Receipt
+
+    generator = random.Random(args.seed)
+    corpus = [stubs.synthetic_receipt(generator) for _ in range(args.receipts)]
+    results = {"receipts": len(corpus)}
+    for name, function in (("parse", parse), ("get_items", Receipt.get_items), ("get_total", Receipt.get_total)):
+        seconds = best_of(args.repeat, lambda: [function(text) for text in corpus])
+        results[name] = {"seconds": seconds, "receipts_per_sec": len(corpus) / seconds}
+    return results
+
+def populate(app_module, user_id, items, seed):
+    """
+    Gives a user items/10 receipts of 10 items each, spread over the last three years, and
+    rebuilds the rollups.
+    """
+    import rollups
+    from sqlalchemy import text
+
+    generator = random.Random(seed)
+    db = app_module.db
+    receipt_count = max(1, items // 10)
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    first_id = (db.session.execute(text("SELECT MAX(id) FROM receipt_table")).scalar() or 0) + 1
+
+    receipts, rows = [], []
+    for offset in range(receipt_count):
+        receipt_id = first_id + offset
+        created = now - timedelta(minutes=generator.randrange(3 * 365 * 24 * 60))
+        receipts.append({"id": receipt_id, "content": generator.choice(stubs.HEADERS), "date_created": created.strftime("%Y-%m-%d %H:%M:%S.%f"), "user_id": user_id})
+        for _ in range(10):
+            rows.append({"item": generator.choice(stubs.WORDS), "cents": generator.randint(49, 4999), "category": generator.choice(["Food", "Hygiene", "Clothes", "Health"]), "receipt_id": receipt_id})
+
+    db.session.execute(text("INSERT INTO receipt_table (id, content, total_cents, date_created, status, user_id) VALUES (:id, :content, 0, :date_created, 'done', :user_id)"), receipts)
+    db.session.execute(text("INSERT INTO item_table (item, total_cents, category, receipt_id) VALUES (:item, :cents, :category, :receipt_id)"), rows)
+    rollups.rebuild(db.session)
+    db.session.commit()
+    return first_id
+
+def bench_db(args, app_module):
+    import rollups
+    from db_calculations import receipt_page, items_calculations
+
+    db = app_module.db
+    results = {}
+    with app_module.app.app_context():
+        for items in args.items:
+            user = app_module.User(username = "bench%d" % items, password = "unused")
+            db.session.add(user)
+            db.session.commit()
+
+            started = time.perf_counter()
+            receipt_id = populate(app_module, user.id, items, args.seed)
+            populate_seconds = time.perf_counter() - started
+
+            def home_page():
+                receipt_page(db.session, user.id)
+                rollups.store_totals(db.session, user.id)
+                rollups.category_totals(db.session, user.id)
+
+            results[str(items)] = {
+                "populate_seconds": populate_seconds,
+                "seconds": {
+                    "home_page": best_of(args.repeat, home_page),
+                    "items_calculations": best_of(args.repeat, items_calculations, db.session, receipt_id),
+                },
+            }
+    return results
+
+def bench_upload(args, app_module):
+    from metrics import metrics
+
+    generator = random.Random(args.seed)
+    texts = [stubs.synthetic_receipt(generator) for _ in range(args.uploads)]
+    # Every upload is a different file, so none of them reuses an earlier OCR result.
+    uploads = [stubs.encode_png(stubs.receipt_image(text, width = args.image_width, seed = args.seed + number)) for number, text in enumerate(texts)]
+    stubs.install(ocr = stubs.StubOCR(texts, args.ocr_seconds_per_megapixel))
+
+    app = app_module.app
+    app.config["WTF_CSRF_ENABLED"] = False
+    client = app.test_client()
+    with app.app_context():
+        user = app_module.User(username = "uploader", password = app_module.bcrypt.generate_password_hash("password").decode())
+        app_module.db.session.add(user)
+        app_module.db.session.commit()
+        user_id = user.id
+    client.post("/", data = {"username": "uploader", "password": "password"})
+
+    import io
+    metrics.drain()
+    started = time.perf_counter()
+    for number, data in enumerate(uploads):
+        response = client.post("/home/%d" % user_id, data = {"img": (io.BytesIO(data), "receipt%d.png" % number)}, content_type = "multipart/form-data")
+        if response.status_code != 302:
+            raise RuntimeError("Upload %d failed with status %d." % (number, response.status_code))
+    seconds = time.perf_counter() - started
+
+    stages = {}
+    for name, labels, (counts, total, count) in metrics.drain()["histograms"]:
+        if name == "receipt_stage_seconds" and count:
+            stages[dict(labels)["stage"]] = total / count
+    return {"uploads": len(uploads), "seconds": seconds, "receipts_per_sec": len(uploads) / seconds, "mean_stage_seconds": stages}
+
+def flatten(results, prefix = ""):
+    """
+    Outputs:
+    values: dict - every number in the results, keyed by its dotted path
+    """
+    values = {}
+    for key, value in results.items():
+        path = prefix + str(key)
+        if isinstance(value, dict):
+            values.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+def compare(old, new, threshold):
+    """
+    Lists the measurements that regressed by more than threshold (0.2 is 20%). Throughputs
+    (keys ending in _per_sec) regress when they drop, everything else when it grows. Counts
+    and setup times are not compared.
+
+    Outputs:
+    regressions: list - (path, old value, new value, relative change)
+    """
+    old, new = flatten(old["results"]), flatten(new["results"])
+    regressions = []
+    for path in sorted(set(old) & set(new)):
+        if path.endswith((".receipts", ".uploads", "populate_seconds")) or not old[path]:
+            continue
+        change = (new[path] - old[path]) / old[path]
+        if path.endswith("_per_sec"):
+            change = -change
+        if change > threshold:
+            regressions.append((path, old[path], new[path], change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sections", nargs="+", choices=SECTIONS, default=SECTIONS)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown reported as a regression")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--receipt-items", type=int, nargs="+", default=[10, 40, 120], help="items on each generated receipt image")
+    parser.add_argument("--image-width", type=int, default=1200)
+    parser.add_argument("--text-height", type=int, default=30, help="OCR_TEXT_HEIGHT used by preprocessing and uploads")
+    parser.add_argument("--receipts", type=int, default=5000, help="receipts in the parser corpus")
+    parser.add_argument("--items", type=int, nargs="+", default=[1000, 10000, 100000], help="items per user in the db section")
+    parser.add_argument("--uploads", type=int, default=20)
+    parser.add_argument("--ocr-seconds-per-megapixel", type=float, default=0.0, help="time the OCR stand-in spends per image")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="receipt-bench-")
+    # The app reads these when it is imported.
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(directory, "bench.db")
+    os.environ["UPLOAD_PATH"] = os.path.join(directory, "uploads")
+    os.environ["INGEST_WORKERS"] = "0"
+    os.environ["OCR_STRIPS"] = "1"
+    os.environ["OCR_TEXT_HEIGHT"] = str(args.text_height)
+
+    stubs.install(ocr = stubs.StubOCR([stubs.synthetic_receipt(random.Random(args.seed))]), classifier = stubs.StubClassifier())
+
+    results = {}
+    try:
+        app_module = None
+        if "db" in args.sections or "upload" in args.sections:
+            import app as app_module
+            app_module.setup()
+        for section in args.sections:
+            print("Running %s..." % section, file=sys.stderr)
+            if section == "preprocessing":
+                results[section] = bench_preprocessing(args)
+            elif section == "parser":
+                results[section] = bench_parser(args)
+            elif section == "db":
+                results[section] = bench_db(args, app_module)
+            elif section == "upload":
+                results[section] = bench_upload(args, app_module)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "date": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "arguments": vars(args),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), report, args.threshold)
+        for path, old, new, change in regressions:
+            print("REGRESSION %s: %.6g -> %.6g (%+.0f%%)" % (path, old, new, 100 * change), file=sys.stderr)
+        if regressions:
+            raise SystemExit(1)
+        print("No regressions above %.0f%%." % (100 * args.threshold), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Stand-ins for tesseract and the zero-shot classifier, and generators for receipt text and
+images, so benchmarks run offline on a machine without tesseract, transformers or a GPU.
+"""
+
+__author__ = "Kevin Dougherty"
+
+import itertools
+import os
+import sys
+import threading
+import time
+import zlib
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+WORDS = ["BANANAS", "MILK", "BREAD", "EGGS", "SHAMPOO", "SOAP", "SOCKS", "CABLE", "COFFEE", "RICE", "APPLES", "TOWELS"]
+HEADERS = ["TARGET", "CVS PHARMACY", "TRADER JOE'S", "CHIPOTLE"]
+
+def synthetic_receipt(generator, items = None):
+    """
+    A receipt with a header, items, an occasional coupon, and subtotal, tax and total lines.
+
+    Inputs:
+    generator: random.Random - source of randomness, seed it for a reproducible corpus
+    items: int - number of items, 5 to 40 when None
+
+    Outputs:
+    text: str - the receipt as OCR would read it
+    """
+    lines = [generator.choice(HEADERS), "%d MAIN ST" % generator.randint(1, 999), "STORE #%04d" % generator.randint(1, 9999)]
+    subtotal = 0
+    for _ in range(items if items is not None else generator.randint(5, 40)):
+        cents = generator.randint(49, 4999)
+        subtotal += cents
+        lines.append("%s %s %d.%02d" % (generator.choice(WORDS), generator.choice(WORDS), cents // 100, cents % 100))
+    if generator.random() < 0.3:
+        lines.append("COUPON 1.00-")
+        subtotal -= 100
+    tax = subtotal * 7 // 100
+    lines += ["SUBTOTAL %d.%02d" % divmod(subtotal, 100), "TAX %d.%02d" % divmod(tax, 100), "TOTAL %d.%02d" % divmod(subtotal + tax, 100), "THANK YOU"]
+    return "\n".join(lines)
+
+def receipt_image(text, width = 1000, line_height = 48, margin = 40, seed = 0):
+    """
+    Draws receipt text as a photo-like image: dark text on a light, slightly noisy page,
+    surrounded by a dark border like the table a receipt is photographed on.
+
+    Inputs:
+    text: str - the receipt text, one line per row
+    width: int - width of the receipt in pixels
+    line_height: int - height of a line of text in pixels, the font is scaled to match
+    margin: int - width of the dark border in pixels
+    seed: int - seed of the page noise, different seeds give different files for the same text
+
+    Outputs:
+    image: numpy.ndarray - the BGR image
+    """
+    lines = text.split("\n")
+    height = line_height * (len(lines) + 2)
+    page = np.full((height, width), 235, dtype=np.uint8)
+    scale = line_height / 40
+    for number, line in enumerate(lines, start=1):
+        cv2.putText(page, line, (line_height, line_height * number + line_height // 2), cv2.FONT_HERSHEY_SIMPLEX, scale, 20, max(1, int(2 * scale)), cv2.LINE_AA)
+
+    noise = np.random.default_rng(seed).integers(0, 12, page.shape, dtype=np.uint8)
+    page = cv2.subtract(page, noise)
+    framed = cv2.copyMakeBorder(page, margin, margin, margin, margin, cv2.BORDER_CONSTANT, value=30)
+    return cv2.cvtColor(framed, cv2.COLOR_GRAY2BGR)
+
+def encode_png(image):
+    ok, encoded = cv2.imencode(".png", image)
+    if not ok:
+        raise ValueError("Could not encode the image.")
+    return encoded.tobytes()
+
+class StubOCR():
+    """
+    Stands in for receipt.image_array_to_string. Returns the given receipt texts in turn,
+    optionally waiting as long as tesseract would take for an image of the same size.
+    """
+
+    def __init__(self, texts, seconds_per_megapixel = 0.0):
+        self.seconds_per_megapixel = seconds_per_megapixel
+        self._texts = itertools.cycle(texts)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def __call__(self, image):
+        if self.seconds_per_megapixel:
+            time.sleep(self.seconds_per_megapixel * image.shape[0] * image.shape[1] / 1e6)
+        with self._lock:
+            self.calls += 1
+            return next(self._texts) + "\n\f"
+
+class StubClassifier():
+    """
+    Stands in for the zero-shot pipeline. Each text gets a label picked from a CRC of the text,
+    so results are stable between runs, with the pipeline's output format. seconds_per_pair
+    simulates the cost of a forward pass per text/label pair.
+    """
+
+    def __init__(self, seconds_per_pair = 0.0):
+        self.seconds_per_pair = seconds_per_pair
+        self.pairs = 0
+
+    def __call__(self, texts, candidate_labels, batch_size = None, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        labels = list(candidate_labels)
+        self.pairs += len(texts) * len(labels)
+        if self.seconds_per_pair:
+            time.sleep(self.seconds_per_pair * len(texts) * len(labels))
+
+        results = []
+        for text in texts:
+            first = zlib.crc32(text.encode()) % len(labels)
+            ordered = labels[first:] + labels[:first]
+            scores = [0.5 / (rank + 1) for rank in range(len(ordered))]
+            results.append({"sequence": text, "labels": ordered, "scores": scores})
+        return results[0] if single else results
+
+def install(ocr = None, classifier = None):
+    """
+    Installs stand-ins in place of tesseract and BART for this process.
+
+    Inputs:
+    ocr: callable - replaces receipt.ocr_backend, e.g. a StubOCR
+    classifier: callable - registered as the default classifier, e.g. a StubClassifier
+    """
+    import receipt
+    from classifier import classifier_registry
+
+    if ocr is not None:
+        receipt.ocr_backend = ocr
+    if classifier is not None:
+        classifier_registry.register(classifier)
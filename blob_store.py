@@ -0,0 +1,213 @@
+"""
+Content-addressed storage for uploaded receipt images and their thumbnails.
+"""
+
+__author__ = "Kevin Dougherty"
+
+import hashlib
+import os
+import tempfile
+import numpy as np
+import cv2
+
+# Uploads are copied to the store this many bytes at a time.
+CHUNK_SIZE = 1024 * 1024
+
+THUMBNAIL_WIDTH = 240
+
+class UploadTooLarge(ValueError):
+    """
+    Raised by BlobStore.put_stream when an upload is larger than the limit.
+    """
+
+def content_hash(data):
+    """
+    Returns the SHA-256 of an upload. Two uploads with the same hash are the same file.
+
+    Inputs:
+    data: bytes - the uploaded file
+
+    Outputs:
+    digest: str - the hash as 64 hex characters
+    """
+    return hashlib.sha256(data).hexdigest()
+
+def perceptual_hash(data):
+    """
+    Returns a 64-bit difference hash (dHash) of an image. Photos of the same receipt that were
+    re-encoded, resized or slightly re-exposed get hashes only a few bits apart, unlike their
+    content hashes. The image is decoded at 1/8 scale, which is all the hash needs.
+
+    Inputs:
+    data: bytes - the encoded image
+
+    Outputs:
+    digest: str - the hash as 16 hex characters, or None if the image could not be decoded
+    """
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        return None
+
+    small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return "%016x" % int("".join("1" if bit else "0" for bit in bits), 2)
+
+def thumbnail_path(path):
+    """
+    Where the thumbnail of a stored image goes: next to it, e.g. root/ab/cd/abcd....thumb.jpg.
+    """
+    return os.path.splitext(path)[0] + ".thumb.jpg"
+
+def _write_atomically(path, data):
+    # Write to a temporary file and rename it, so a reader never sees half a file.
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(descriptor, "wb") as file:
+        file.write(data)
+    os.replace(temporary_path, path)
+
+def write_thumbnail(image, path, width = THUMBNAIL_WIDTH, quality = 80):
+    """
+    Writes a small JPEG of a receipt for the home page, so the original photo is never sent
+    to the browser just to show a preview.
+
+    Inputs:
+    image: numpy.ndarray - the decoded BGR image
+    path: str - where to write the thumbnail, see thumbnail_path
+    width: int - width of the thumbnail in pixels, narrower images keep their size
+    quality: int - JPEG quality, 0 to 100
+    """
+    height, image_width = image.shape[:2]
+    if image_width > width:
+        image = cv2.resize(image, (width, max(1, round(height * width / image_width))), interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Could not encode the thumbnail.")
+    _write_atomically(path, encoded.tobytes())
+
+def ensure_thumbnail(path, width = THUMBNAIL_WIDTH):
+    """
+    Returns the thumbnail of a stored image, making it first if the image was stored before
+    thumbnails were made on upload. The image is decoded at half size, which is plenty for a
+    thumbnail.
+
+    Outputs:
+    thumbnail: str - path to the thumbnail, None if the image could not be decoded
+    """
+    thumbnail = thumbnail_path(path)
+    if os.path.exists(thumbnail):
+        return thumbnail
+
+    image = cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_REDUCED_COLOR_2)
+    if image is None:
+        return None
+    write_thumbnail(image, thumbnail, width)
+    return thumbnail
+
+# Spellings of the same file type, stored under one extension so the same bytes are kept once.
+EXTENSION_ALIASES = {".jpeg": ".jpg", ".jpe": ".jpg", ".jfif": ".jpg", ".tif": ".tiff"}
+
+def _extension(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if not extension[1:].isalnum():
+        return ""
+    return EXTENSION_ALIASES.get(extension, extension)
+
+def hamming_distance(first, second):
+    """
+    Number of bits that differ between two perceptual hashes.
+    """
+    return bin(int(first, 16) ^ int(second, 16)).count("1")
+
+class BlobStore():
+    """
+    Stores each distinct upload once, under the hash of its bytes. Files are sharded into two
+    levels of directories by the first four hex characters of the hash (root/ab/cd/abcd....jpg)
+    so no directory grows too large. Uploading the same file again, under any name, reuses
+    the stored copy.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest, extension = ""):
+        """
+        Where the blob with this hash is stored.
+
+        Inputs:
+        digest: str - the content hash
+        extension: str - file extension including the dot, e.g. ".jpg"
+
+        Outputs:
+        path: str - path to the blob
+        """
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + extension)
+
+    def put(self, data, filename = ""):
+        """
+        Stores an upload unless a blob with the same content is already stored.
+
+        Inputs:
+        data: bytes - the uploaded file
+        filename: str - the name the client gave the file, only used for its extension
+
+        Outputs:
+        [0]: digest: str - the content hash of the upload
+        [1]: path: str - path to the stored blob
+        """
+        digest = content_hash(data)
+        path = self.path(digest, _extension(filename))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_atomically(path, data)
+
+        return digest, path
+
+    def put_stream(self, stream, filename = "", max_size = None, chunk_size = CHUNK_SIZE):
+        """
+        Stores an upload read from a file-like object a chunk at a time, hashing it on the way,
+        so the upload is never held in memory whole. The file only gets its final name once it
+        is complete.
+
+        Inputs:
+        stream: file - the upload, e.g. request.files["img"].stream
+        filename: str - the name the client gave the file, only used for its extension
+        max_size: int - largest upload accepted, in bytes, None for no limit
+        chunk_size: int - bytes read at a time
+
+        Outputs:
+        [0]: digest: str - the content hash of the upload
+        [1]: path: str - path to the stored blob
+        [2]: size: int - size of the upload in bytes
+
+        Raises:
+        UploadTooLarge - if the upload is larger than max_size, nothing is stored
+        """
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.root)
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise UploadTooLarge("%s is larger than the %d MB limit." % (filename or "The upload", max_size // (1024 * 1024)))
+                    digest.update(chunk)
+                    file.write(chunk)
+
+            digest = digest.hexdigest()
+            path = self.path(digest, _extension(filename))
+            if os.path.exists(path):
+                os.remove(temporary_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temporary_path, path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+        return digest, path, size
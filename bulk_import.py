@@ -0,0 +1,120 @@
+"""
+Reads a directory or zip file of scanned receipts for the import-receipts command in app.py.
+OCR runs in a pool of worker processes, item classification is left to the caller so the
+items of many receipts can be classified in one batch by a single copy of the model.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+import multiprocessing
+import os
+import zipfile
+from ingestion import _init_worker, _read_receipt_in_worker
+from receipt import Receipt, CATEGORIES
+from classifier import DEFAULT_BATCH_SIZE
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp", ".webp"}
+
+def iter_images(path):
+    """
+    Lists the receipt images in a directory (searched recursively) or a zip file, in name order.
+
+    Inputs:
+    path: str - the directory or zip file
+
+    Outputs:
+    images: generator - (name, data, modified) for every image, name being the path inside the
+            directory or zip file, data its bytes and modified its modification time as a datetime
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in sorted(archive.infolist(), key=lambda info: info.filename):
+                if not info.is_dir() and os.path.splitext(info.filename)[1].lower() in IMAGE_EXTENSIONS:
+                    yield info.filename, archive.read(info), datetime(*info.date_time)
+        return
+
+    if not os.path.isdir(path):
+        raise ValueError("%s is neither a directory nor a zip file." % path)
+
+    for directory, directories, files in os.walk(path):
+        directories.sort()
+        for filename in sorted(files):
+            if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                file_path = os.path.join(directory, filename)
+                with open(file_path, "rb") as file:
+                    data = file.read()
+                yield os.path.relpath(file_path, path), data, datetime.fromtimestamp(os.path.getmtime(file_path), timezone.utc).replace(tzinfo=None)
+
+def read_receipts(jobs, workers = 2, initargs = (), **options):
+    """
+    Runs OCR on many receipts in a pool of worker processes. At most two receipts per worker
+    are in flight at once, so a large import never holds every image in memory.
+
+    Inputs:
+    jobs: iterable - (key, image) pairs, image being the bytes of the receipt image
+    workers: int - number of worker processes, 0 runs every receipt in this process
+    initargs: tuple - (database_url, cache_size, classifier, pragmas) for the workers, see ingestion._init_worker
+    options: keyword arguments passed on to ingestion.read_receipt
+
+    Outputs:
+    results: generator - (key, result, error) in the order the receipts finish, result being
+             None and error the exception when a receipt could not be read
+    """
+    options["classify_items"] = False
+
+    if workers == 0:
+        for key, image in jobs:
+            try:
+                yield key, _read_receipt_in_worker(image, options), None
+            except Exception as error:
+                yield key, None, error
+        return
+
+    with ProcessPoolExecutor(
+        max_workers = workers,
+        mp_context = multiprocessing.get_context("spawn"),
+        initializer = _init_worker,
+        initargs = initargs,
+    ) as executor:
+        pending = {}
+        jobs = iter(jobs)
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < 2 * workers:
+                try:
+                    key, image = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(_read_receipt_in_worker, image, options)] = key
+
+            if not pending:
+                break
+            done, _ = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                error = future.exception()
+                yield key, None if error is not None else future.result(), error
+
+def classify_results(results, categories = CATEGORIES, batch_size = DEFAULT_BATCH_SIZE):
+    """
+    Fills in the item categories of several receipts read with classify_items set to False.
+    The distinct items of every receipt are classified in one batched call (cached items are
+    not classified again, see Receipt.get_item_categories).
+
+    Inputs:
+    results: list - outputs of ingestion.read_receipt, their items are updated in place
+    categories: list - the candidate categories
+    batch_size: int - how many item/category pairs the classifier scores in one forward pass
+    """
+    items = {item: total for result in results for item, total, category in result["items"] if category is None}
+    if not items:
+        return
+
+    item_categories = Receipt.get_item_categories(items, categories, batch_size = batch_size)
+    for result in results:
+        for item in result["items"]:
+            if item[2] is None:
+                item[2] = item_categories[item[0]]
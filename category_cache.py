@@ -0,0 +1,249 @@
+"""
+Memoizes item categories so the same receipt lines are not classified over and over.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from collections import OrderedDict
+import threading
+from sqlalchemy import bindparam, text
+
+def normalize_item(item):
+    """
+    Normalizes an item's text so "Bananas", "BANANAS " and "bananas" share a cache entry.
+
+    Inputs:
+    item: str - the item text from the receipt
+
+    Outputs:
+    item_key: str - the normalized item text
+    """
+    return " ".join(item.upper().split())
+
+def categories_key(categories):
+    """
+    Turns a category list into a key that does not depend on the order of the categories.
+
+    Inputs:
+    categories: list - the candidate categories an item was classified against
+
+    Outputs:
+    key: str - the sorted categories joined by commas
+    """
+    return ",".join(sorted(categories))
+
+class CategoryCache():
+    """
+    Two-tier cache of item categories keyed on the normalized item text plus the category set.
+    The first tier is a bounded in-memory LRU. The second tier is an optional backend (the
+    category_cache table, see app.py) that survives restarts. Categories a user set by hand
+    are stored with source "user" and are never overwritten by the model.
+    """
+
+    def __init__(self, maxsize = 4096, backend = None):
+        self.maxsize = maxsize
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.backend_hits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key, category):
+        """
+        Adds an entry to the in-memory tier, evicting the least recently used entry when full.
+        Must be called with the lock held.
+        """
+        self._entries[key] = category
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get_many(self, items, categories):
+        """
+        Looks up the category of several items at once.
+
+        Inputs:
+        items: list - the item texts from the receipt
+        categories: list - the candidate categories
+
+        Outputs:
+        [0]: found: dict - keys are the items that were cached, values are their categories
+        [1]: missing: list - the items that still have to be classified
+        """
+        category_set = categories_key(categories)
+        found = {}
+        not_in_memory = {}
+
+        with self._lock:
+            for item in items:
+                key = (normalize_item(item), category_set)
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[item] = self._entries[key]
+                else:
+                    not_in_memory.setdefault(key[0], []).append(item)
+
+        if not_in_memory and self.backend is not None:
+            stored = self.backend.get_many(list(not_in_memory), category_set)
+            with self._lock:
+                for item_key, category in stored.items():
+                    self._remember((item_key, category_set), category)
+                    for item in not_in_memory.pop(item_key):
+                        found[item] = category
+                        self.backend_hits += 1
+
+        missing = [item for item_list in not_in_memory.values() for item in item_list]
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        return found, missing
+
+    def get(self, item, categories):
+        """
+        Looks up the category of a single item.
+
+        Outputs:
+        category: str - the cached category, or None on a miss
+        """
+        found, missing = self.get_many([item], categories)
+        return found.get(item)
+
+    def put(self, item, categories, category, source = "model"):
+        """
+        Stores an item's category in both tiers.
+
+        Inputs:
+        item: str - the item text from the receipt
+        categories: list - the candidate categories the item was classified against
+        category: str - the category to remember
+        source: str - "model" for classifier output, "user" for a correction made by a user
+        """
+        key = (normalize_item(item), categories_key(categories))
+        if not key[0]:
+            return
+
+        if self.backend is not None:
+            category = self.backend.set(key[0], key[1], category, source)
+
+        with self._lock:
+            self._remember(key, category)
+
+    def put_many(self, items, categories, source = "model"):
+        """
+        Stores the categories of several items in both tiers, with a single write to the backend.
+
+        Inputs:
+        items: dict - keys are item texts from the receipt, values are their categories
+        categories: list - the candidate categories the items were classified against
+        source: str - "model" for classifier output, "user" for corrections made by a user
+
+        Outputs:
+        stored: dict - keys are the items, values are the categories now cached for them, which
+                differ from the ones given where a user's correction takes precedence
+        """
+        category_set = categories_key(categories)
+        by_key = {}
+        for item, category in items.items():
+            item_key = normalize_item(item)
+            if item_key:
+                by_key[item_key] = category
+
+        if by_key and self.backend is not None:
+            by_key = self.backend.set_many(by_key, category_set, source)
+
+        with self._lock:
+            for item_key, category in by_key.items():
+                self._remember((item_key, category_set), category)
+
+        return {item: by_key.get(normalize_item(item), category) for item, category in items.items()}
+
+    def stats(self):
+        """
+        Returns the hit/miss counters and the size of the in-memory tier.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "backend_hits": self.backend_hits,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
+
+    def clear(self):
+        """
+        Empties the in-memory tier and resets the counters. The backend is left alone.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.backend_hits = 0
+
+class SQLCategoryBackend():
+    """
+    Persistent tier of the category cache, stored in the category_cache table (CategoryCacheTable
+    in app.py). It only needs an engine, so worker processes without the Flask app can use it.
+    Every write is its own short transaction and does not depend on the caller's session, set_many
+    writes all the new items of a receipt in one.
+    """
+
+    _select = text(
+        "SELECT item_key, category FROM category_cache WHERE categories = :categories AND item_key IN :item_keys"
+    ).bindparams(bindparam("item_keys", expanding=True))
+
+    # A category a user picked by hand is never replaced by the model's guess.
+    _upsert = text(
+        "INSERT INTO category_cache (item_key, categories, category, source) VALUES (:item_key, :categories, :category, :source) "
+        "ON CONFLICT (item_key, categories) DO UPDATE SET category = excluded.category, source = excluded.source "
+        "WHERE category_cache.source != 'user' OR excluded.source = 'user'"
+    )
+
+    _select_one = text("SELECT category FROM category_cache WHERE item_key = :item_key AND categories = :categories")
+
+    _select_corrections = text("SELECT item_key, category FROM category_cache WHERE categories = :categories AND source = 'user'")
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def get_many(self, item_keys, categories):
+        with self.engine.connect() as connection:
+            rows = connection.execute(self._select, {"categories": categories, "item_keys": item_keys})
+            return {item_key: category for item_key, category in rows}
+
+    def corrections(self, categories):
+        """
+        Returns the categories users picked by hand, as {item_key: category}, for a category set
+        (see categories_key).
+        """
+        with self.engine.connect() as connection:
+            return dict(connection.execute(self._select_corrections, {"categories": categories}).all())
+
+    def set(self, item_key, categories, category, source):
+        params = {"item_key": item_key, "categories": categories, "category": category, "source": source}
+        with self.engine.begin() as connection:
+            connection.execute(self._upsert, params)
+            return connection.execute(self._select_one, params).scalar_one()
+
+    def set_many(self, items, categories, source):
+        """
+        Stores the categories of several items in one transaction, so a receipt takes the write
+        lock once however many items it has.
+
+        Inputs:
+        items: dict - keys are normalized item texts, values are their categories
+        categories: str - the category set, see categories_key
+        source: str - "model" or "user"
+
+        Outputs:
+        stored: dict - the category now stored for every item
+        """
+        params = [{"item_key": item_key, "categories": categories, "category": category, "source": source} for item_key, category in items.items()]
+        with self.engine.begin() as connection:
+            connection.execute(self._upsert, params)
+            rows = connection.execute(self._select, {"categories": categories, "item_keys": list(items)})
+            return {item_key: category for item_key, category in rows}
+
+category_cache = CategoryCache()
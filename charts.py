@@ -0,0 +1,126 @@
+"""
+Chart payloads for the dashboard, item and spending pages.
+
+Charts are sent to the browser as Plotly figure JSON ({"data": [...], "layout": {...}}) and drawn
+there by static/charts.js with the Plotly bundle the app serves as a static asset. A payload only
+depends on the user's totals, so it is built once per data version (see rollups.data_version) and
+served from memory until the user's receipts change.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from collections import OrderedDict
+import json
+import threading
+
+def bar_chart(totals, x_title, y_title):
+    """
+    Inputs:
+    totals: dict - keys are the bar labels, values are the dollar amounts
+    x_title: str - title of the x axis
+    y_title: str - title of the y axis
+
+    Outputs:
+    figure: dict - Plotly figure with one bar per key
+    """
+    return {
+        "data": [{"type": "bar", "x": list(totals.keys()), "y": list(totals.values()), "hovertemplate": "%{x}<br>$%{y:.2f}<extra></extra>"}],
+        "layout": {"xaxis": {"title": {"text": x_title}}, "yaxis": {"title": {"text": y_title}}},
+    }
+
+def pie_chart(totals):
+    """
+    Inputs:
+    totals: dict - keys are the slice labels, values are the dollar amounts
+
+    Outputs:
+    figure: dict - Plotly figure with one slice per key
+    """
+    return {
+        "data": [{"type": "pie", "labels": list(totals.keys()), "values": list(totals.values())}],
+        "layout": {},
+    }
+
+def stacked_bar_chart(frame, x_title, y_title, legend_title = None):
+    """
+    Inputs:
+    frame: pandas.DataFrame - indexed by period, one column per stacked series, values in dollars
+    x_title: str - title of the x axis
+    y_title: str - title of the y axis
+    legend_title: str - title of the legend, None to hide the legend
+
+    Outputs:
+    figure: dict - Plotly figure with one bar trace per column of the frame
+    """
+    x = [period.strftime("%Y-%m-%d") for period in frame.index]
+    return {
+        "data": [
+            {"type": "bar", "name": str(column), "x": x, "y": [round(value, 2) for value in frame[column].tolist()]}
+            for column in frame.columns
+        ],
+        "layout": {
+            "barmode": "stack",
+            "showlegend": legend_title is not None,
+            "legend": {"title": {"text": legend_title or ""}},
+            "xaxis": {"title": {"text": x_title}},
+            "yaxis": {"title": {"text": y_title}},
+        },
+    }
+
+class ChartCache():
+    """
+    Bounded in-memory LRU of serialized chart payloads. Entries are keyed on the user's data
+    version, so a change to the user's receipts makes their old entries unreachable and they
+    age out; nothing has to be invalidated explicitly, and every app process can keep its own cache.
+    """
+
+    def __init__(self, maxsize = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key, build):
+        """
+        Returns the cached payload for a key, building and caching it first if needed.
+
+        Inputs:
+        key: tuple - (user_id, data_version, chart name, chart parameters...)
+        build: function - called with no arguments to build the figure dict on a miss
+
+        Outputs:
+        payload: str - the figure serialized as JSON
+        """
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return payload
+            self.misses += 1
+
+        # Built outside the lock, two requests for the same new chart may both build it.
+        payload = json.dumps(build(), separators=(",", ":"))
+        with self._lock:
+            self._entries[key] = payload
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return payload
+
+    def stats(self):
+        """
+        Outputs:
+        stats: dict - hits, misses and number of cached payloads
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+chart_cache = ChartCache()
@@ -0,0 +1,152 @@
+"""
+Process-wide registry for the transformer models used to classify receipt text.
+"""
+
+__author__ = "Kevin Dougherty"
+
+import threading
+from metrics import metrics
+
+DEFAULT_TASK = "zero-shot-classification"
+DEFAULT_MODEL = "facebook/bart-large-mnli"
+# Number of premise/hypothesis pairs sent through the model in one padded forward pass.
+DEFAULT_BATCH_SIZE = 32
+
+# Classifies by cosine similarity of sentence embeddings instead of NLI, see embedding_classifier.py.
+EMBEDDING_TASK = "embedding-similarity"
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# The classifier backends the CLASSIFIER_BACKEND setting picks from, as (task, model).
+BACKENDS = {
+    "zero-shot": (DEFAULT_TASK, DEFAULT_MODEL),
+    "embedding": (EMBEDDING_TASK, DEFAULT_EMBEDDING_MODEL),
+}
+
+class ClassifierRegistry():
+    """
+    Holds one instance of every model the app uses. A model is only built the first
+    time something asks for it, so importing the app (or serving pages that never
+    classify anything) does not pay for loading BART. Every request and worker thread
+    in the process shares the same instance afterwards.
+
+    Methods called without a task and model use the default pair, BART zero-shot unless
+    use() picked another backend.
+    """
+
+    def __init__(self):
+        self.task = DEFAULT_TASK
+        self.model = DEFAULT_MODEL
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def use(self, task, model):
+        """
+        Makes a task/model pair the default, e.g. (EMBEDDING_TASK, DEFAULT_EMBEDDING_MODEL).
+        """
+        self.task = task
+        self.model = model
+
+    def get(self, task = None, model = None):
+        """
+        Returns the pipeline for a task/model pair, building it on first use.
+
+        Inputs:
+        task: str - the transformers pipeline task, or EMBEDDING_TASK
+        model: str - the name of the model on the Hugging Face hub
+
+        Outputs:
+        classifier: pipeline - the shared pipeline for the task/model pair
+        """
+        key = (task or self.task, model or self.model)
+        classifier = self._models.get(key)
+        if classifier is None:
+            with self._lock:
+                # Another thread may have finished loading while we waited on the lock.
+                classifier = self._models.get(key)
+                if classifier is None:
+                    with metrics.timer("model_load_seconds", model = key[1]):
+                        classifier = _build(*key)
+                    self._models[key] = classifier
+        return classifier
+
+    def register(self, classifier, task = None, model = None):
+        """
+        Installs an already built classifier for a task/model pair, e.g. a stand-in that runs
+        without transformers for tests and benchmarks (see benchmarks/stubs.py).
+
+        Inputs:
+        classifier: callable - takes (texts, candidate_labels, batch_size) like a zero-shot pipeline
+        task: str - the transformers pipeline task
+        model: str - the name of the model on the Hugging Face hub
+        """
+        with self._lock:
+            self._models[(task or self.task, model or self.model)] = classifier
+
+    def is_loaded(self, task = None, model = None):
+        """
+        Returns True if the task/model pair has already been built.
+        """
+        return (task or self.task, model or self.model) in self._models
+
+    def warm_up(self, task = None, model = None, background = False):
+        """
+        Loads a model ahead of the first request that needs it.
+
+        Inputs:
+        task: str - the transformers pipeline task
+        model: str - the name of the model on the Hugging Face hub
+        background: bool - load the model on a daemon thread so the server can start taking traffic right away
+
+        Outputs:
+        thread: threading.Thread - the loading thread when background is True, otherwise None
+        """
+        if not background:
+            self.get(task, model)
+            return None
+
+        thread = threading.Thread(target=self.get, args=(task, model), name="classifier-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+def _build(task, model):
+    """
+    Loads the classifier for a task/model pair.
+    """
+    if task == EMBEDDING_TASK:
+        from embedding_classifier import EmbeddingClassifier, user_corrections
+        classifier = EmbeddingClassifier(model, examples = user_corrections)
+        # Load the encoder now, like pipeline() does, so the time is counted in model_load_seconds.
+        classifier.get_encoder()
+        return classifier
+
+    from transformers import pipeline
+    return pipeline(task, model=model)
+
+classifier_registry = ClassifierRegistry()
+
+def classify(texts, candidate_labels, batch_size = DEFAULT_BATCH_SIZE, classifier = None):
+    """
+    Scores many texts against the same labels in one call so the pipeline can pad them
+    into batches, rather than running one forward pass per text.
+
+    Inputs:
+    texts: list - the strings to classify, e.g. every item on a receipt
+    candidate_labels: list - the labels each text is scored against
+    batch_size: int - how many premise/hypothesis pairs go through the model at once
+    classifier: pipeline - defaults to the registry's default classifier, BART unless configured otherwise
+
+    Outputs:
+    results: list - one dict per text with "sequence", "labels" and "scores", labels sorted best first
+    """
+    texts = list(texts)
+    if not texts:
+        return []
+
+    if classifier is None:
+        classifier = classifier_registry.get()
+
+    results = classifier(texts, candidate_labels = candidate_labels, batch_size = batch_size)
+    # The pipeline unwraps the list when it is given a single text.
+    if isinstance(results, dict):
+        results = [results]
+    return results
@@ -0,0 +1,98 @@
+"""
+SQLite connection settings for the web app, the OCR workers and the scripts.
+
+Every connection is opened in WAL mode, so pages like the dashboard keep reading while an
+upload is being written: readers see the last committed data instead of waiting for the
+writer. A writer that finds another write in progress waits up to busy_timeout instead of
+failing with "database is locked".
+"""
+
+__author__ = "Kevin Dougherty"
+
+import sqlalchemy
+from sqlalchemy import event
+
+# Applied to every new connection, in this order. journal_mode=WAL is stored in the database file,
+# the others only last as long as the connection.
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    # With WAL, NORMAL only syncs at checkpoints. A power cut can lose the last commits but never corrupts the database.
+    "synchronous": "NORMAL",
+    # Negative sizes are in KiB: 20 MB of page cache per connection.
+    "cache_size": -20000,
+    # Read the database through a 256 MB memory map instead of read() calls.
+    "mmap_size": 256 * 1024 * 1024,
+    # Milliseconds a connection waits for another connection's write to finish.
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+}
+
+def is_sqlite(database_url):
+    return sqlalchemy.make_url(database_url).get_backend_name() == "sqlite"
+
+def apply_pragmas(dbapi_connection, pragmas = DEFAULT_PRAGMAS):
+    """
+    Sets the pragmas on a new DB-API connection.
+
+    Inputs:
+    dbapi_connection: sqlite3.Connection - the connection
+    pragmas: dict - pragma names and values
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+    finally:
+        cursor.close()
+
+def engine_options(database_url, pool_size = 5, max_overflow = 10, pool_timeout = 30, busy_timeout = DEFAULT_PRAGMAS["busy_timeout"]):
+    """
+    Keyword arguments for create_engine (SQLALCHEMY_ENGINE_OPTIONS in app.py).
+
+    Inputs:
+    database_url: str - the database
+    pool_size: int - connections kept open, about the number of threads that use the database at once
+    max_overflow: int - extra connections opened when all of them are in use
+    pool_timeout: int - seconds to wait for a connection when pool_size + max_overflow are in use
+    busy_timeout: int - milliseconds the sqlite3 module waits for a lock, matching the pragma
+
+    Outputs:
+    options: dict - the create_engine arguments
+    """
+    if not is_sqlite(database_url):
+        return {"pool_size": pool_size, "max_overflow": max_overflow, "pool_timeout": pool_timeout, "pool_pre_ping": True}
+
+    database = sqlalchemy.make_url(database_url).database
+    if not database or database == ":memory:":
+        # An in-memory database only exists on its own connection, there is nothing to pool.
+        return {}
+    return {"pool_size": pool_size, "max_overflow": max_overflow, "pool_timeout": pool_timeout, "connect_args": {"timeout": busy_timeout / 1000}}
+
+def configure_engine(engine, pragmas = DEFAULT_PRAGMAS):
+    """
+    Makes every connection the engine opens from now on apply the pragmas. Call it before the
+    engine's first connection. Engines of other databases are left alone.
+    """
+    if engine.dialect.name != "sqlite":
+        return engine
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, pragmas)
+
+    return engine
+
+def create_engine(database_url, pragmas = DEFAULT_PRAGMAS, **options):
+    """
+    Creates an engine with the settings the web app uses, for the OCR workers and scripts.
+
+    Inputs:
+    database_url: str - the database
+    pragmas: dict - pragmas applied to every connection
+    options: keyword arguments passed on to engine_options
+
+    Outputs:
+    engine: sqlalchemy.Engine - the configured engine
+    """
+    options.setdefault("busy_timeout", pragmas.get("busy_timeout", DEFAULT_PRAGMAS["busy_timeout"]))
+    return configure_engine(sqlalchemy.create_engine(database_url, **engine_options(database_url, **options)), pragmas)
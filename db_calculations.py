@@ -4,70 +4,204 @@ Calculations performed after querying a database.
 
 __author__ = "Kevin Dougherty"
 
-def index_calculations(db):
+import base64
+import binascii
+import json
+from datetime import datetime, timedelta
+from sqlalchemy import text
+import pandas as pd
+
+# Offset aliases pandas resamples to for each period a user can pick. Periods are closed and labelled
+# on the left, so weeks run Monday to Sunday and are labelled with their Monday.
+FREQUENCIES = {"day": "D", "week": "W-MON", "month": "MS"}
+
+# Items categorized as Total (the receipt's own subtotal/total lines) are never counted as spending,
+# nor are receipts still processing, like in the rollups (see rollups.snapshot). Amounts are summed
+# in integer cents and only converted to dollars at the end.
+RECEIPT_CATEGORY_TOTALS = text("""
+    SELECT category, SUM(total_cents) / 100.0
+    FROM item_table
+    WHERE receipt_id = :receipt_id AND category != 'Total'
+    GROUP BY category
+    ORDER BY MIN(id)
+""")
+
+def encode_cursor(date_created, receipt_id):
     """
-    Calculates the receipt totals, and determines the unique stores,
-    and unique categories from the Receipts datatable.
+    Turns the sort key of the last receipt on a page into an opaque cursor for the next page.
 
     Inputs:
-    db: SQL DB - database to get the information from
+    date_created: str - the receipt's date_created exactly as stored
+    receipt_id: int - the receipt's id
 
     Outputs:
-    [0]: receipt_totals: list - totals from each of the receipts in the order they appear in the DB
-    [1]: unique_stores: dict - keys are the stores, values are the totals calculated by adding all the items that are not categorized as Total
-    [2]: unique_categories: dict - keys are the categories, values are the totals calculated by adding all the items that are not categorized as Total
+    cursor: str - URL-safe cursor
     """
+    return base64.urlsafe_b64encode(json.dumps([date_created, receipt_id]).encode()).decode().rstrip("=")
 
-    receipt_totals = []
-    unique_stores = {}
-    unique_categories = {}
-
-    for receipt in db:
-        item_sum = 0
-
-        for item in receipt.receipt_items:
-            if item.category != "Total":
-                item_sum += float(item.total)
-
-                if item.category in unique_categories:
-                    unique_categories[item.category] += float(item.total)
+def decode_cursor(cursor):
+    """
+    Inputs:
+    cursor: str - a cursor made by encode_cursor
 
-                else:
-                    unique_categories[item.category] = float(item.total)
+    Outputs:
+    key: tuple - (date_created, receipt_id)
 
-        if receipt.content in unique_stores:
-            unique_stores[receipt.content] += item_sum
+    Raises:
+    ValueError - if the cursor was not made by encode_cursor
+    """
+    try:
+        date_created, receipt_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError("%r is not a page cursor." % (cursor,))
+    if not isinstance(date_created, str) or not isinstance(receipt_id, int):
+        raise ValueError("%r is not a page cursor." % (cursor,))
+    return date_created, receipt_id
+
+def receipt_page(db, user_id, cursor = None, limit = 50, store = None, category = None, start = None, end = None):
+    """
+    Gets one page of a user's receipts, newest first, with the total of each receipt.
 
-        else:
-            unique_stores[receipt.content] = item_sum
+    Pages are found by keyset on (date_created, id) instead of OFFSET, so SQLite walks the
+    (user_id, date_created) index from the cursor and reads only the rows on the page, however
+    many receipts the user has.
 
-        receipt_totals.append(item_sum)
+    Inputs:
+    db: SQLAlchemy session - database to get the information from
+    user_id: int - the user whose receipts are listed
+    cursor: str - next_cursor of the previous page, None for the first page
+    limit: int - number of receipts on the page
+    store: str - only list receipts from this store
+    category: str - only list receipts with an item in this category
+    start: datetime.date - only list receipts from this day on
+    end: datetime.date - only list receipts up to and including this day
 
-    return receipt_totals, unique_stores, unique_categories
+    Outputs:
+    [0]: receipts: list - dicts with the id, store, date_created (datetime), status, has_image and total (dollars) of each receipt
+    [1]: next_cursor: str - cursor for the next page, None if this is the last page
 
-def items_calculations(db):
+    Raises:
+    ValueError - if the cursor is not valid
+    """
+    query = """
+        SELECT receipt_table.id, receipt_table.content, receipt_table.date_created, receipt_table.status,
+               receipt_table.image IS NOT NULL,
+               CASE WHEN receipt_table.status = 'processing' THEN 0 ELSE
+                   COALESCE((SELECT SUM(item_table.total_cents) FROM item_table
+                             WHERE item_table.receipt_id = receipt_table.id AND item_table.category != 'Total'), 0) / 100.0
+               END
+        FROM receipt_table
+        WHERE receipt_table.user_id = :user_id
+    """
+    params = {"user_id": user_id, "limit": limit + 1}
+    if cursor is not None:
+        query += " AND (receipt_table.date_created, receipt_table.id) < (:cursor_date, :cursor_id)"
+        params["cursor_date"], params["cursor_id"] = decode_cursor(cursor)
+    if store is not None:
+        query += " AND receipt_table.content = :store"
+        params["store"] = store
+    if category is not None:
+        query += " AND EXISTS (SELECT 1 FROM item_table WHERE item_table.receipt_id = receipt_table.id AND item_table.category = :category)"
+        params["category"] = category
+    if start is not None:
+        query += " AND receipt_table.date_created >= :start"
+        params["start"] = start.isoformat()
+    if end is not None:
+        query += " AND receipt_table.date_created < :end"
+        params["end"] = (end + timedelta(days=1)).isoformat()
+    query += " ORDER BY receipt_table.date_created DESC, receipt_table.id DESC LIMIT :limit"
+
+    rows = db.execute(text(query), params).all()
+    # One row more than the page holds is fetched to know whether there is a next page.
+    next_cursor = encode_cursor(rows[limit - 1][2], rows[limit - 1][0]) if len(rows) > limit else None
+    receipts = [
+        {"id": receipt_id, "store": store_name, "date_created": datetime.fromisoformat(date_created), "status": status, "has_image": bool(has_image), "total": total}
+        for receipt_id, store_name, date_created, status, has_image, total in rows[:limit]
+    ]
+
+    return receipts, next_cursor
+
+def items_calculations(db, receipt_id):
     """
     Calculates the totals from the unique categories on a receipt.
 
     Inputs:
-    db: SQL DB - database to get the information from
+    db: SQLAlchemy session - database to get the information from
+    receipt_id: int - the receipt to total
 
     Outputs:
     [0]: categories: dict - keys are the categories, values are the totals
     [1]: receipt_total: float - represents the total amount of a receipt
     """
-     
-    categories = {}
-    receipt_total = 0
 
-    for item in db.receipt_items:
-        if item.category != "Total":
-            receipt_total += float(item.total)
+    categories = dict(db.execute(RECEIPT_CATEGORY_TOTALS, {"receipt_id": receipt_id}).all())
+    receipt_total = sum(categories.values())
 
-            if item.category in categories:
-                categories[item.category] += float(item.total)
+    return categories, receipt_total
 
-            else:
-                categories[item.category] = float(item.total)
+def spending_over_time(db, user_id, start = None, end = None, period = "month", by = None):
+    """
+    Calculates how much a user spent per day, week or month, optionally split by store or category.
 
-    return categories, receipt_total
\ No newline at end of file
+    Spending by store or category is fetched as one set of (date_created, store, category, total_cents)
+    columns limited to the date range, which the (user_id, date_created) index serves directly, and then
+    bucketed with a single pandas resample. Total spending comes straight from the day and month
+    rollups, so it costs the same however long the user's history is.
+
+    Inputs:
+    db: SQLAlchemy session - database to get the information from
+    user_id: int - the user whose spending is calculated
+    start: datetime.date - first day to include, None for the start of the user's history
+    end: datetime.date - last day to include, None for today and everything before it
+    period: str - "day", "week" or "month"
+    by: str - "store", "category" or None for total spending
+
+    Outputs:
+    spending: pandas.DataFrame - one row per period (indexed by the period's first day), one column per
+              store or category (a single "Total" column when by is None), values in dollars
+    """
+    frequency = FREQUENCIES[period]
+
+    if by is None:
+        # Weeks are built from days, months are read as they are.
+        table, column = ("user_month_total", "month") if period == "month" else ("user_day_total", "day")
+        query = "SELECT %s, total_cents FROM %s WHERE user_id = :user_id" % (column, table)
+        params = {"user_id": user_id}
+        if start is not None:
+            query += " AND %s >= :start" % column
+            params["start"] = start.isoformat()[:len("YYYY-MM") if column == "month" else None]
+        if end is not None:
+            query += " AND %s <= :end" % column
+            params["end"] = end.isoformat()[:len("YYYY-MM") if column == "month" else None]
+
+        frame = pd.DataFrame(db.execute(text(query), params).all(), columns=["date_created", "total_cents"])
+        frame["date_created"] = pd.to_datetime(frame["date_created"])
+        spending = frame.set_index("date_created")["total_cents"].resample(frequency, closed="left", label="left").sum().to_frame("Total")
+        return spending / 100
+
+    if by not in ("store", "category"):
+        raise ValueError("Spending can only be split by store or category.")
+
+    query = """
+        SELECT receipt_table.date_created, receipt_table.content AS store, item_table.category, item_table.total_cents
+        FROM receipt_table
+        JOIN item_table ON item_table.receipt_id = receipt_table.id
+        WHERE receipt_table.user_id = :user_id AND receipt_table.status != 'processing' AND item_table.category != 'Total'
+    """
+    params = {"user_id": user_id}
+    if start is not None:
+        query += " AND receipt_table.date_created >= :start"
+        params["start"] = start.isoformat()
+    if end is not None:
+        query += " AND receipt_table.date_created < :end"
+        params["end"] = (end + timedelta(days=1)).isoformat()
+
+    frame = pd.DataFrame(db.execute(text(query), params).all(), columns=["date_created", "store", "category", "total_cents"])
+    frame["date_created"] = pd.to_datetime(frame["date_created"], format="mixed")
+    spending = (
+        frame.groupby([pd.Grouper(key="date_created", freq=frequency, closed="left", label="left"), by])["total_cents"]
+        .sum()
+        .unstack(fill_value=0)
+    )
+    spending.columns.name = None
+    return spending / 100
@@ -0,0 +1,163 @@
+"""
+A lighter alternative to BART zero-shot classification. Items and labels are embedded with a
+small sentence encoder and every item gets the label it is most similar to. The label
+embeddings are computed once, so classifying a batch of items is one encoder pass over the
+items and one matrix product, where zero-shot NLI runs BART once per item and label.
+
+Items users re-categorized by hand are used as labeled examples: an item very similar to a
+corrected item gets the category the user picked.
+
+Picked with CLASSIFIER_BACKEND=embedding, see app.py. Needs the sentence-transformers package.
+"""
+
+__author__ = "Kevin Dougherty"
+
+import threading
+import numpy as np
+from category_cache import category_cache, categories_key
+from classifier import DEFAULT_BATCH_SIZE, DEFAULT_EMBEDDING_MODEL
+
+def user_corrections(candidate_labels):
+    """
+    The items users re-categorized by hand, read from the persistent tier of the category cache.
+
+    Inputs:
+    candidate_labels: list - the categories being classified against
+
+    Outputs:
+    examples: dict - keys are normalized item texts, values are the categories users picked
+    """
+    if category_cache.backend is None:
+        return {}
+    return category_cache.backend.corrections(categories_key(candidate_labels))
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+class EmbeddingClassifier():
+    """
+    Classifies texts by the cosine similarity of their embeddings to the labels' embeddings.
+    It is called like the zero-shot pipeline and returns results in the same format, so
+    classifier.classify and the category cache work with either. The scores are cosine
+    similarities, not probabilities.
+
+    model: str - the sentence-transformers model, loaded on first use
+    encoder: object - anything with encode(texts, batch_size=...) returning one vector per text,
+             replaces the sentence-transformers model, e.g. in tests
+    examples: callable - takes the candidate labels and returns {text: label} of labeled
+              examples, e.g. user_corrections. Called on every classification so new
+              corrections are picked up.
+    label_template: str - how a label is phrased before it is embedded, "{}" is the bare label
+    example_threshold: float - how similar an item must be to an example to take its label
+    """
+
+    def __init__(self, model = DEFAULT_EMBEDDING_MODEL, encoder = None, examples = None, label_template = "{}", example_threshold = 0.8):
+        self.model = model
+        self.encoder = encoder
+        self.examples = examples
+        self.label_template = label_template
+        self.example_threshold = example_threshold
+        self._label_vectors = {}
+        self._example_vectors = {}
+        self._lock = threading.Lock()
+
+    def get_encoder(self):
+        """
+        Returns the sentence encoder, loading it on first use.
+        """
+        with self._lock:
+            if self.encoder is None:
+                from sentence_transformers import SentenceTransformer
+                self.encoder = SentenceTransformer(self.model, device="cpu")
+            return self.encoder
+
+    def encode(self, texts, batch_size = DEFAULT_BATCH_SIZE):
+        """
+        Outputs:
+        vectors: numpy.ndarray - one unit-length embedding per text
+        """
+        return _normalize(self.get_encoder().encode(list(texts), batch_size=batch_size))
+
+    def label_vectors(self, labels, batch_size = DEFAULT_BATCH_SIZE):
+        """
+        The embeddings of a label list, computed once per list.
+        """
+        key = tuple(labels)
+        vectors = self._label_vectors.get(key)
+        if vectors is None:
+            vectors = self.encode([self.label_template.format(label) for label in labels], batch_size)
+            with self._lock:
+                self._label_vectors[key] = vectors
+        return vectors
+
+    def example_vectors(self, labels, batch_size = DEFAULT_BATCH_SIZE):
+        """
+        The embeddings of the labeled examples whose label is one of labels. Each example is
+        embedded once and kept.
+
+        Outputs:
+        [0]: vectors: numpy.ndarray - one row per example
+        [1]: columns: numpy.ndarray - the index in labels of each example's label
+        """
+        examples = self.examples(labels) if self.examples is not None else {}
+        columns = {label: column for column, label in enumerate(labels)}
+        examples = {text: columns[label] for text, label in examples.items() if label in columns}
+        if not examples:
+            return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.intp)
+
+        new = [text for text in examples if text not in self._example_vectors]
+        if new:
+            vectors = self.encode(new, batch_size)
+            with self._lock:
+                self._example_vectors.update(zip(new, vectors))
+        return np.stack([self._example_vectors[text] for text in examples]), np.fromiter(examples.values(), dtype=np.intp, count=len(examples))
+
+    def scores(self, texts, labels, batch_size = DEFAULT_BATCH_SIZE):
+        """
+        Scores every text against every label.
+
+        Inputs:
+        texts: list - the strings to classify
+        labels: list - the candidate labels
+        batch_size: int - how many texts the encoder embeds at once
+
+        Outputs:
+        scores: numpy.ndarray - texts x labels. A text's score for a label is its similarity to
+                the label, or to the nearest example of that label when that is higher and at
+                least example_threshold.
+        """
+        vectors = self.encode(texts, batch_size)
+        scores = vectors @ self.label_vectors(labels, batch_size).T
+
+        example_vectors, columns = self.example_vectors(labels, batch_size)
+        if len(columns):
+            similarity = vectors @ example_vectors.T
+            for column in np.unique(columns):
+                nearest = similarity[:, columns == column].max(axis=1)
+                close = nearest >= self.example_threshold
+                scores[close, column] = np.maximum(scores[close, column], nearest[close])
+        return scores
+
+    def __call__(self, texts, candidate_labels, batch_size = DEFAULT_BATCH_SIZE, **kwargs):
+        """
+        Classifies one text or a list of texts.
+
+        Outputs:
+        results: dict - "sequence", "labels" and "scores", labels sorted best first, for a
+                 single text, or a list of them for a list of texts
+        """
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        labels = list(candidate_labels)
+        if not texts:
+            return []
+
+        scores = self.scores(texts, labels, batch_size)
+        order = np.argsort(-scores, axis=1, kind="stable")
+        results = [
+            {"sequence": text, "labels": [labels[column] for column in row], "scores": [float(score) for score in text_scores[row]]}
+            for text, row, text_scores in zip(texts, order, scores)
+        ]
+        return results[0] if single else results
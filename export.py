@@ -0,0 +1,269 @@
+"""
+Exports a user's receipts and items as CSV, Parquet or Arrow, for the export endpoints and
+the export-receipts command in app.py.
+
+Rows are read in fixed-size chunks from one streaming query and every chunk is written out
+before the next one is read, so an export uses the same memory for ten receipts or ten years
+of them. CSV is streamed straight into the response. Parquet and Arrow files are written by
+a background job (ExportJobs) and downloaded when they are ready. They need pyarrow.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from datetime import datetime
+from decimal import Decimal
+import io
+import os
+import threading
+import time
+import uuid
+from sqlalchemy import text
+from money import format_cents
+
+# One row per item, receipts without items get a single row with empty item columns.
+COLUMNS = ["receipt_id", "store", "date_created", "status", "receipt_total", "item_id", "item", "item_total", "category"]
+
+FORMATS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+
+DEFAULT_CHUNK_SIZE = 5000
+
+# Oldest receipt first, items in the order they were added. The receipts come in the order of
+# ix_receipt_table_user_id_date_created (user_id, date_created, id), so SQLite only sorts the
+# items of one receipt at a time, never the user's whole history.
+EXPORT_QUERY = text(
+    "SELECT r.id, r.content, r.date_created, r.status, r.total_cents, i.id, i.item, i.total_cents, i.category "
+    "FROM receipt_table r LEFT JOIN item_table i ON i.receipt_id = r.id "
+    "WHERE r.user_id = :user_id "
+    "ORDER BY r.date_created, r.id, i.id"
+)
+
+def iter_chunks(connection, user_id, chunk_size = DEFAULT_CHUNK_SIZE):
+    """
+    Reads the user's receipts and items in chunks.
+
+    Inputs:
+    connection: sqlalchemy.Connection - a connection of its own, not a request's session
+    user_id: int - the user whose receipts are exported
+    chunk_size: int - rows per chunk
+
+    Outputs:
+    chunks: generator - lists of at most chunk_size rows, with the columns in COLUMNS and amounts in cents
+    """
+    result = connection.execution_options(stream_results = True, yield_per = chunk_size).execute(EXPORT_QUERY, {"user_id": user_id})
+    for chunk in result.partitions(chunk_size):
+        yield chunk
+
+def _timestamp(value):
+    # SQLite returns text for raw SQL, a datetime for rows written through the ORM.
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+def csv_chunks(chunks):
+    """
+    Formats chunks of rows as CSV, with amounts in dollars and dates in ISO format.
+
+    Outputs:
+    text: generator - the header, then one string per chunk
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    yield buffer.getvalue()
+
+    for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(
+            (receipt_id, store, _timestamp(created).isoformat() if created else "", status, format_cents(receipt_total),
+             item_id if item_id is not None else "", item or "", format_cents(item_total) if item_total is not None else "", category or "")
+            for receipt_id, store, created, status, receipt_total, item_id, item, item_total, category in chunk
+        )
+        yield buffer.getvalue()
+
+def _dollars(cents):
+    return None if cents is None else Decimal(cents).scaleb(-2)
+
+def arrow_schema():
+    import pyarrow as pa
+
+    money = pa.decimal128(18, 2)
+    return pa.schema([
+        ("receipt_id", pa.int64()), ("store", pa.string()), ("date_created", pa.timestamp("us")), ("status", pa.string()),
+        ("receipt_total", money), ("item_id", pa.int64()), ("item", pa.string()), ("item_total", money), ("category", pa.string()),
+    ])
+
+def arrow_batch(chunk, schema):
+    """
+    Turns a chunk of rows into an Arrow record batch, amounts as exact decimals.
+    """
+    import pyarrow as pa
+
+    columns = list(zip(*chunk)) if chunk else [()] * len(COLUMNS)
+    columns[2] = [_timestamp(value) for value in columns[2]]
+    columns[4] = [_dollars(value) for value in columns[4]]
+    columns[7] = [_dollars(value) for value in columns[7]]
+    return pa.RecordBatch.from_arrays([pa.array(column, type = field.type) for column, field in zip(columns, schema)], schema = schema)
+
+def _counted(chunks, counts):
+    for chunk in chunks:
+        counts[0] += len(chunk)
+        yield chunk
+
+def write_export(chunks, file, format):
+    """
+    Writes chunks of rows to a binary file. Each chunk of a Parquet export is one row group,
+    each chunk of an Arrow export is one record batch of an Arrow IPC stream.
+
+    Inputs:
+    chunks: iterable - chunks of rows from iter_chunks
+    file: file - opened in binary mode
+    format: str - "csv", "parquet" or "arrow"
+
+    Outputs:
+    rows: int - the number of rows written
+    """
+    counts = [0]
+    chunks = _counted(chunks, counts)
+    if format == "csv":
+        for part in csv_chunks(chunks):
+            file.write(part.encode("utf-8"))
+        return counts[0]
+
+    schema = arrow_schema()
+    if format == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(file, schema)
+    elif format == "arrow":
+        import pyarrow as pa
+        writer = pa.ipc.new_stream(file, schema)
+    else:
+        raise ValueError("Unknown export format %r." % format)
+
+    with writer:
+        for chunk in chunks:
+            writer.write_batch(arrow_batch(chunk, schema))
+    return counts[0]
+
+def export_receipts(engine, user_id, path, format, chunk_size = DEFAULT_CHUNK_SIZE):
+    """
+    Exports a user's receipts and items to a file. The file only appears under its name once
+    it is complete.
+
+    Inputs:
+    engine: sqlalchemy.Engine - the app's database
+    user_id: int - the user whose receipts are exported
+    path: str - the file to write
+    format: str - "csv", "parquet" or "arrow"
+    chunk_size: int - rows read and written at a time
+
+    Outputs:
+    rows: int - the number of rows written
+    """
+    partial = path + ".part"
+    try:
+        with engine.connect() as connection, open(partial, "wb") as file:
+            rows = write_export(iter_chunks(connection, user_id, chunk_size), file, format)
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return rows
+
+class ExportJobs():
+    """
+    Runs file exports on a background thread so the request that asks for one returns right
+    away. Jobs are kept in memory. A finished job and its file are deleted max_age seconds
+    after it finished, and export files left behind by a server that has since restarted once
+    they are that old, whenever a job is started or looked up.
+    """
+
+    def __init__(self, directory, workers = 1, max_age = 24 * 60 * 60):
+        self.directory = directory
+        self.workers = workers
+        self.max_age = max_age
+        self._jobs = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def expire(self, now = None):
+        """
+        Forgets finished jobs older than max_age and deletes their files, along with any other
+        export file in the directory that has not been modified for max_age.
+
+        Outputs:
+        removed: int - the number of files deleted
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items() if job["finished"] is not None and now - job["finished"] > self.max_age]
+            for job_id in expired:
+                del self._jobs[job_id]
+            kept = {job["path"] for job in self._jobs.values()}
+
+        removed = 0
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return removed
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if not name.startswith("receipts-") or path.removesuffix(".part") in kept:
+                continue
+            try:
+                if now - os.path.getmtime(path) > self.max_age:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def submit(self, engine, user_id, format, chunk_size = DEFAULT_CHUNK_SIZE):
+        """
+        Starts exporting a user's receipts.
+
+        Outputs:
+        job_id: str - pass it to get() to follow the job
+        """
+        if format not in FORMATS:
+            raise ValueError("Unknown export format %r." % format)
+
+        self.expire()
+        os.makedirs(self.directory, exist_ok = True)
+        job_id = uuid.uuid4().hex
+        job = {"id": job_id, "user_id": user_id, "format": format, "status": "running", "rows": None, "error": None, "finished": None,
+               "path": os.path.join(self.directory, "receipts-%d-%s%s" % (user_id, job_id, FORMATS[format]))}
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "export")
+            self._jobs[job_id] = job
+            self._executor.submit(self._run, job, engine, chunk_size)
+        return job_id
+
+    def _run(self, job, engine, chunk_size):
+        try:
+            rows = export_receipts(engine, job["user_id"], job["path"], job["format"], chunk_size)
+        except Exception as error:
+            job.update(status = "failed", error = "%s: %s" % (type(error).__name__, error), finished = time.time())
+        else:
+            job.update(status = "done", rows = rows, finished = time.time())
+
+    def get(self, job_id):
+        """
+        Outputs:
+        job: dict - id, user_id, format, status ("running", "done" or "failed"), rows, error,
+             path and finished (a time.time() timestamp) of the job, None if there is no such
+             job or it has expired
+        """
+        self.expire()
+        job = self._jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    def shutdown(self, wait = True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait = wait)
+                self._executor = None
@@ -0,0 +1,195 @@
+"""
+Runs OCR and classification for uploaded receipts in a pool of worker processes, so an
+upload returns right away instead of holding a web worker for the whole pipeline.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import multiprocessing
+import threading
+from preprocessing import Preprocessing
+from receipt import Receipt, STORES, KIND_CATEGORIES
+from receipt_parser import parse, ITEM
+from classifier import classifier_registry, DEFAULT_BATCH_SIZE
+from category_cache import category_cache, SQLCategoryBackend
+from blob_store import perceptual_hash, thumbnail_path, write_thumbnail
+from metrics import metrics
+
+preprocessing = Preprocessing()
+
+def read_receipt(image, store_list = STORES, batch_size = DEFAULT_BATCH_SIZE, ocr_strips = 1, text_height = None, classify_items = True, thumbnail_width = None):
+    """
+    Runs the whole receipt pipeline on an uploaded image: preprocessing, OCR, store and total
+    detection, item extraction and item classification. It does not touch the database, so
+    it can run in a worker process. The image is decoded from memory and never written back
+    to disk, the original upload is left as it was.
+
+    A receipt photographed in several pages is read page by page, one page in memory at a
+    time, and its text is parsed as a whole.
+
+    Inputs:
+    image: bytes - the uploaded image, str - path to the uploaded image, or list - the pages of one receipt, in order
+    store_list: list - the user's personal store list, see Receipt.get_store
+    batch_size: int - how many pairs the classifier scores in one forward pass
+    ocr_strips: int - how many strips tall receipts are split into for OCR, see Receipt.get_receipt_text
+    text_height: int - character height to rescale the image to before OCR, see Preprocessing.normalize_resolution
+    classify_items: bool - False leaves every category None, for callers that classify the items of many receipts in one batch
+    thumbnail_width: int - if given, a thumbnail of every page given as a path is written next to it, see blob_store.write_thumbnail
+
+    Outputs:
+    result: dict - "text", "store", "total", "items", a list of [item, total, category], "perceptual_hash" of the
+            (first) upload, and "preprocessing", the rescale factor and step timings from Preprocessing.preprocess
+            for the first page
+    """
+    pages = image if isinstance(image, list) else [image]
+    texts = []
+    for number, page in enumerate(pages):
+        path = None
+        if isinstance(page, str):
+            path = page
+            with open(path, "rb") as file:
+                page = file.read()
+
+        if number == 0:
+            with metrics.timer("receipt_stage_seconds", stage = "perceptual_hash"):
+                image_hash = perceptual_hash(page)
+
+        page_report = {}
+        with metrics.timer("receipt_stage_seconds", stage = "decode"):
+            decoded = preprocessing.decode(page)
+        if path is not None and thumbnail_width:
+            with metrics.timer("receipt_stage_seconds", stage = "thumbnail"):
+                write_thumbnail(decoded, thumbnail_path(path), thumbnail_width)
+        decoded = preprocessing.preprocess(decoded, text_height = text_height, report = page_report)
+        with metrics.timer("receipt_stage_seconds", stage = "ocr"):
+            texts.append(Receipt.get_receipt_text(decoded, strips = ocr_strips))
+        if number == 0:
+            report = page_report
+
+    # tesseract ends every page with a form feed; keep one, at the very end, like a single page.
+    text = texts[0] if len(texts) == 1 else "\n\n".join(page_text.rstrip("\n\f") for page_text in texts) + "\n\f"
+
+    try:
+        with metrics.timer("receipt_stage_seconds", stage = "get_store"):
+            store = Receipt.get_store(text, store_list_personal = store_list, batch_size = batch_size)
+    except Exception:
+        store = None
+    if store is None:
+        store = "Could not determine"
+
+    with metrics.timer("receipt_stage_seconds", stage = "parse"):
+        parsed = parse(text)
+    total = parsed.total or parsed.subtotal
+    amount = total.amount if total is not None else "0"
+
+    # Every priced line is kept, in order, including repeated items. Subtotals, totals, tax and
+    # discounts take their category from the parser, only purchases go to the classifier.
+    names = dict.fromkeys(line.name for line in parsed.lines if line.kind == ITEM)
+    if classify_items and names:
+        with metrics.timer("receipt_stage_seconds", stage = "classify"):
+            item_categories = Receipt.get_item_categories(names, batch_size = batch_size)
+    else:
+        item_categories = names
+    items = [[line.name, line.amount, item_categories[line.name] if line.kind == ITEM else KIND_CATEGORIES[line.kind]] for line in parsed.lines]
+
+    return {"text": text, "store": store, "total": amount, "items": items, "perceptual_hash": image_hash, "preprocessing": report}
+
+def _read_receipt_in_worker(image, options):
+    """
+    read_receipt for the worker processes. Some library exceptions, pytesseract's among them,
+    cannot be unpickled in the parent and would break the whole pool, so errors are sent back
+    as a plain RuntimeError. The metrics the worker recorded are returned in result["metrics"],
+    see metrics.Metrics.drain.
+    """
+    try:
+        result = read_receipt(image, **options)
+    except Exception as error:
+        raise RuntimeError("%s: %s" % (type(error).__name__, error)) from None
+
+    # What the worker recorded goes back with the result, the parent adds it to its own metrics.
+    result["metrics"] = metrics.drain()
+    return result
+
+def _init_worker(database_url, cache_size, classifier = None, pragmas = None):
+    """
+    Runs once in every worker process. Workers share the persistent tier of the category cache
+    with the web app through the database, and classify with the same backend as the web app.
+
+    Inputs:
+    database_url: str - the app's database
+    cache_size: int - size of the in-memory tier of the category cache
+    classifier: tuple - the (task, model) pair the web app classifies with, see ClassifierRegistry.use
+    pragmas: dict - the SQLite pragmas the web app uses, see database.py
+    """
+    import database
+
+    category_cache.maxsize = cache_size
+    # A worker handles one receipt at a time, it never needs more than one connection.
+    category_cache.backend = SQLCategoryBackend(database.create_engine(database_url, pragmas or database.DEFAULT_PRAGMAS, pool_size = 1, max_overflow = 1))
+    if classifier is not None:
+        classifier_registry.use(*classifier)
+
+class IngestionQueue():
+    """
+    Queue of receipts waiting for OCR. Jobs go to a pool of worker processes and, once a job
+    finishes, on_complete(receipt_id, result, error) is called in this process so the web app
+    can write the result to the database in one short transaction.
+
+    With workers set to 0 the pipeline runs inline, inside the request, as it used to.
+    """
+
+    def __init__(self, on_complete, workers = 2, initargs = ()):
+        self.on_complete = on_complete
+        self.workers = workers
+        self.initargs = initargs
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Spawned workers do not inherit the web server's threads, sockets or database connections.
+                self._executor = ProcessPoolExecutor(
+                    max_workers = self.workers,
+                    mp_context = multiprocessing.get_context("spawn"),
+                    initializer = _init_worker,
+                    initargs = self.initargs,
+                )
+            return self._executor
+
+    def submit(self, receipt_id, image, **options):
+        """
+        Queues a receipt for processing.
+
+        Inputs:
+        receipt_id: int - id of the receipt row that will receive the result
+        image: bytes - the uploaded image, str - path to the uploaded image, or list - the pages of one receipt
+        options: keyword arguments passed on to read_receipt
+        """
+        if self.workers == 0:
+            try:
+                result = read_receipt(image, **options)
+            except Exception as error:
+                self.on_complete(receipt_id, None, error)
+            else:
+                self.on_complete(receipt_id, result, None)
+            return
+
+        future = self._get_executor().submit(_read_receipt_in_worker, image, options)
+        future.add_done_callback(partial(self._finished, receipt_id))
+
+    def _finished(self, receipt_id, future):
+        error = future.exception()
+        result = None if error is not None else future.result()
+        self.on_complete(receipt_id, result, error)
+
+    def shutdown(self, wait = True):
+        """
+        Stops the worker processes, by default after the queued receipts are done.
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait = wait)
+                self._executor = None
@@ -0,0 +1,205 @@
+"""
+Counters, gauges and latency histograms for the receipt pipeline, exposed in the Prometheus
+text format by the /metrics endpoint in app.py.
+
+Worker processes record into their own copy of the registry. ingestion hands what a worker
+recorded for a receipt back with the result (drain) and the web app adds it to its own
+registry (merge), so /metrics covers every process.
+"""
+
+__author__ = "Kevin Dougherty"
+
+import math
+import threading
+import time
+
+# Upper bounds, in seconds, of the histogram buckets. Pipeline stages range from a few milliseconds
+# (parsing) to tens of seconds (loading BART).
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Type and help text of every metric, in the order /metrics lists them.
+DESCRIPTIONS = {
+    "receipt_stage_seconds": ("histogram", "Time spent in each stage of reading and saving a receipt."),
+    "model_load_seconds": ("histogram", "Time taken to load a classifier model."),
+    "receipts_processed_total": ("counter", "Receipts that finished processing, by status."),
+    "items_classified_total": ("counter", "Items sent to the classifier."),
+    "category_cache_lookups_total": ("counter", "Item category lookups, by result (hit or miss)."),
+    "ocr_result_reuses_total": ("counter", "Uploads that reused the OCR result of an earlier upload."),
+    "category_cache_entries": ("gauge", "Item categories held in memory by the web process."),
+    "chart_cache_entries": ("gauge", "Chart payloads held in memory by the web process."),
+}
+
+class _Timer():
+    """
+    Context manager that adds the time spent in its block to a histogram.
+    """
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+class _NullTimer():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+class Metrics():
+    """
+    Thread-safe registry of counters, gauges and histograms. Every metric is identified by
+    its name and its labels. When enabled is False, recording does nothing.
+    """
+
+    def __init__(self, buckets = BUCKETS):
+        self.enabled = True
+        self.buckets = buckets
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount = 1, **labels):
+        """
+        Adds to a counter.
+        """
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """
+        Sets a gauge.
+        """
+        key = _key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Adds a value, in seconds, to a histogram.
+        """
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def timer(self, name, **labels):
+        """
+        Times a block into a histogram:
+
+            with metrics.timer("receipt_stage_seconds", stage="ocr"):
+                ...
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def drain(self):
+        """
+        Takes everything recorded since the last drain and clears it. Gauges are kept, they
+        describe the process they were set in.
+
+        Outputs:
+        recorded: dict - "counters" and "histograms", in the form merge takes
+        """
+        with self._lock:
+            recorded = {
+                "counters": [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, list(labels), histogram] for (name, labels), histogram in self._histograms.items()],
+            }
+            self._counters = {}
+            self._histograms = {}
+        return recorded
+
+    def merge(self, recorded):
+        """
+        Adds counters and histograms drained from another registry, e.g. a worker process's.
+        """
+        if not recorded or not self.enabled:
+            return
+        with self._lock:
+            for name, labels, value in recorded["counters"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                self._counters[key] = self._counters.get(key, 0) + value
+            for name, labels, (counts, total, count) in recorded["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+                histogram[0] = [mine + theirs for mine, theirs in zip(histogram[0], counts)]
+                histogram[1] += total
+                histogram[2] += count
+
+    def render(self):
+        """
+        Outputs:
+        text: str - every metric in the Prometheus text exposition format
+        """
+        with self._lock:
+            series = {}
+            for (name, labels), value in self._counters.items():
+                series.setdefault(name, []).append((labels, value))
+            for (name, labels), value in self._gauges.items():
+                series.setdefault(name, []).append((labels, value))
+            for (name, labels), histogram in self._histograms.items():
+                series.setdefault(name, []).append((labels, [list(histogram[0]), histogram[1], histogram[2]]))
+
+        lines = []
+        for name in sorted(series, key=lambda name: (list(DESCRIPTIONS).index(name) if name in DESCRIPTIONS else len(DESCRIPTIONS), name)):
+            kind, description = DESCRIPTIONS.get(name, ("untyped", ""))
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in sorted(series[name]):
+                if kind != "histogram":
+                    lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(value)))
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append("%s_bucket%s %d" % (name, _format_labels(labels + (("le", repr(bound)),)), cumulative))
+                lines.append("%s_bucket%s %d" % (name, _format_labels(labels + (("le", "+Inf"),)), count))
+                lines.append("%s_sum%s %s" % (name, _format_labels(labels), _format_value(total)))
+                lines.append("%s_count%s %d" % (name, _format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for name, value in labels)
+    return "{%s}" % ",".join('%s="%s"' % (name, value) for (name, _), value in zip(labels, escaped))
+
+def _format_value(value):
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+metrics = Metrics()
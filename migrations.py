@@ -0,0 +1,206 @@
+"""
+Schema migrations for databases created before a column or table existed.
+
+Each migration runs once, in order, and the number of migrations applied is stored in
+SQLite's user_version. Migrations skip tables that do not exist yet, because a fresh
+database gets the current schema from db.create_all() in app.py.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from money import to_cents
+import rollups
+
+def _has_table(connection, table):
+    row = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    return row is not None
+
+def _columns(connection, table):
+    return {row[1] for row in connection.execute("PRAGMA table_info(%s)" % table)}
+
+def add_receipt_status(connection):
+    """
+    Adds the processing status and the uploaded image path to receipts. Receipts that
+    already exist were processed inside the upload request, so they are marked done.
+    """
+    if not _has_table(connection, "receipt_table"):
+        return
+
+    columns = _columns(connection, "receipt_table")
+    if "status" not in columns:
+        connection.execute("ALTER TABLE receipt_table ADD COLUMN status VARCHAR(20) NOT NULL DEFAULT 'done'")
+    if "image" not in columns:
+        connection.execute("ALTER TABLE receipt_table ADD COLUMN image VARCHAR(500)")
+
+def add_receipt_content_hash(connection):
+    """
+    Adds the hash of the uploaded image to receipts, used to find earlier OCR results for the same image.
+    """
+    if not _has_table(connection, "receipt_table"):
+        return
+
+    if "content_hash" not in _columns(connection, "receipt_table"):
+        connection.execute("ALTER TABLE receipt_table ADD COLUMN content_hash VARCHAR(64)")
+
+def _check_amounts(connection, table):
+    """
+    Stops the migration before anything changes if a text total cannot be read as money, e.g.
+    one typed in by hand as "about 5", listing every such row so they can be fixed first.
+    """
+    invalid = []
+    for row_id, total in connection.execute("SELECT id, total FROM %s" % table):
+        try:
+            to_cents(total)
+        except ValueError:
+            invalid.append("id %s: %r" % (row_id, total))
+    if invalid:
+        raise ValueError("Cannot convert the totals of %s to cents, fix these rows and start the app again: %s" % (table, ", ".join(invalid)))
+
+def money_columns_and_indexes(connection):
+    """
+    Replaces the text totals of receipts and items with integer cents, so SQLite can sum and
+    compare them without parsing strings, and adds indexes for the per-user, per-date and
+    per-category queries. SQLite cannot change a column's type, so both tables are rebuilt
+    and their rows copied over.
+    """
+    if not _has_table(connection, "receipt_table") or "total_cents" in _columns(connection, "receipt_table"):
+        return
+
+    # Totals are converted by money.to_cents, like amounts entered in the app, so "$5" and
+    # "1,200.00" become 500 and 120000 cents.
+    _check_amounts(connection, "receipt_table")
+    _check_amounts(connection, "item_table")
+    connection.create_function("to_cents", 1, to_cents, deterministic=True)
+
+    connection.execute("BEGIN")
+    connection.execute("""
+        CREATE TABLE receipt_table_new (
+            id INTEGER NOT NULL,
+            content VARCHAR(200) NOT NULL,
+            total_cents INTEGER NOT NULL DEFAULT 0,
+            date_created DATETIME,
+            status VARCHAR(20) NOT NULL DEFAULT 'done',
+            image VARCHAR(500),
+            content_hash VARCHAR(64),
+            user_id INTEGER,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES user (id) ON DELETE CASCADE
+        )
+    """)
+    connection.execute(
+        "INSERT INTO receipt_table_new (id, content, total_cents, date_created, status, image, content_hash, user_id) "
+        "SELECT id, content, to_cents(total), date_created, status, image, content_hash, user_id FROM receipt_table"
+    )
+    connection.execute("DROP TABLE receipt_table")
+    connection.execute("ALTER TABLE receipt_table_new RENAME TO receipt_table")
+
+    connection.execute("""
+        CREATE TABLE item_table_new (
+            id INTEGER NOT NULL,
+            item VARCHAR(200) NOT NULL,
+            total_cents INTEGER NOT NULL DEFAULT 0,
+            category VARCHAR(200) NOT NULL,
+            receipt_id INTEGER,
+            PRIMARY KEY (id),
+            FOREIGN KEY(receipt_id) REFERENCES receipt_table (id) ON DELETE CASCADE
+        )
+    """)
+    connection.execute(
+        "INSERT INTO item_table_new (id, item, total_cents, category, receipt_id) "
+        "SELECT id, item, to_cents(total), category, receipt_id FROM item_table"
+    )
+    connection.execute("DROP TABLE item_table")
+    connection.execute("ALTER TABLE item_table_new RENAME TO item_table")
+
+    connection.execute("CREATE INDEX ix_receipt_table_user_id_date_created ON receipt_table (user_id, date_created)")
+    connection.execute("CREATE INDEX ix_receipt_table_user_id_content ON receipt_table (user_id, content)")
+    connection.execute("CREATE INDEX ix_item_table_receipt_id_category ON item_table (receipt_id, category)")
+    connection.execute("CREATE INDEX ix_item_table_category_receipt_id ON item_table (category, receipt_id)")
+
+def spending_rollups(connection):
+    """
+    Creates the per-user spending rollup tables (see rollups.py) and fills them from the
+    receipts and items already in the database.
+    """
+    for statement in rollups.TABLES:
+        connection.execute(statement)
+
+    if not _has_table(connection, "receipt_table") or not _has_table(connection, "item_table"):
+        return
+
+    connection.execute("BEGIN")
+    for table, query in rollups.REBUILD.items():
+        connection.execute("DELETE FROM %s" % table)
+        connection.execute("INSERT INTO %s %s" % (table, query))
+
+def user_data_versions(connection):
+    """
+    Creates the table of per-user data versions that cached charts are keyed on (see rollups.py).
+    """
+    connection.execute(rollups.VERSIONS)
+
+def add_receipt_pages(connection):
+    """
+    Adds the image paths of receipts uploaded as several pages.
+    """
+    if not _has_table(connection, "receipt_table"):
+        return
+
+    if "pages" not in _columns(connection, "receipt_table"):
+        connection.execute("ALTER TABLE receipt_table ADD COLUMN pages TEXT")
+
+def _rebuild_rollups(connection):
+    """
+    Refills the rollups from the receipts and items and bumps every user's data version so
+    cached charts are rebuilt.
+    """
+    if not _has_table(connection, "receipt_table") or not _has_table(connection, "item_table"):
+        return
+
+    connection.execute("BEGIN")
+    for table, query in rollups.REBUILD.items():
+        connection.execute("DELETE FROM %s" % table)
+        connection.execute("INSERT INTO %s %s" % (table, query))
+    connection.execute("UPDATE user_data_version SET version = version + 1")
+
+def rollups_without_pending_receipts(connection):
+    """
+    Rebuilds the rollups, which used to count receipts still processing under their placeholder store.
+    """
+    _rebuild_rollups(connection)
+
+def rollups_with_failed_receipts(connection):
+    """
+    Rebuilds the rollups once more for databases the previous migration left without the
+    receipts whose OCR failed, which count once a user fills them in by hand.
+    """
+    _rebuild_rollups(connection)
+
+MIGRATIONS = [
+    add_receipt_status,
+    add_receipt_content_hash,
+    money_columns_and_indexes,
+    spending_rollups,
+    user_data_versions,
+    add_receipt_pages,
+    rollups_without_pending_receipts,
+    rollups_with_failed_receipts,
+]
+
+def migrate(connection):
+    """
+    Applies every migration the database has not seen yet.
+
+    Inputs:
+    connection: sqlite3.Connection - connection to the database to migrate
+
+    Outputs:
+    version: int - the schema version the database is at afterwards
+    """
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(connection)
+        connection.execute("PRAGMA user_version = %d" % number)
+        connection.commit()
+
+    return len(MIGRATIONS)
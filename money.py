@@ -0,0 +1,43 @@
+"""
+Conversions between the dollar amounts users and receipts show and the integer cents we store.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+def to_cents(amount):
+    """
+    Converts an amount of dollars to whole cents.
+
+    Inputs:
+    amount: str, int, float or Decimal - e.g. "12.99", "$1,200", 3.5
+
+    Outputs:
+    cents: int - the amount in cents, rounded half up
+
+    Raises:
+    ValueError - if the amount is not a number
+    """
+    if isinstance(amount, str):
+        amount = amount.strip().replace("$", "").replace(",", "")
+    try:
+        dollars = Decimal(str(amount))
+    except InvalidOperation:
+        raise ValueError("%r is not an amount of money." % (amount,))
+    if not dollars.is_finite():
+        raise ValueError("%r is not an amount of money." % (amount,))
+    return int((dollars * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+def format_cents(cents):
+    """
+    Formats whole cents as a dollar amount with two decimals, e.g. 1299 as "12.99".
+
+    Inputs:
+    cents: int - the amount in cents
+
+    Outputs:
+    amount: str - the amount in dollars
+    """
+    sign = "-" if cents < 0 else ""
+    return "%s%d.%02d" % (sign, abs(cents) // 100, abs(cents) % 100)
@@ -6,53 +6,183 @@ __author__ = "Kevin Dougherty"
 
 from PIL import Image
 import pytesseract
-from transformers import pipeline
-import re
-from preprocessing import Preprocessing
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from classifier import classifier_registry, classify, DEFAULT_BATCH_SIZE
+from category_cache import category_cache, normalize_item
+from store_matcher import get_matcher, get_brand_matcher
+from receipt_parser import parse, SUBTOTAL, TOTAL, TAX, DISCOUNT, SAVINGS
+from metrics import metrics
 
-preprocessing = Preprocessing()
+# Seconds a tesseract process may run before it is killed, so a hung OCR call cannot hold a worker forever.
+OCR_TIMEOUT = float(os.environ.get("OCR_TIMEOUT", "120"))
+
+# Number of non-empty lines at the top of a receipt searched for a store from the general brand list.
+HEADER_LINES = 6
+
+STORES = ["Target", "CVS", "Trader Joe's", "Chipotle"]
+
+CATEGORIES = ["Health", "Food", "Clothes", "Miscellaneous", "Electronics", "Hygiene", "Tax", "Discount", "Total"]
+
+# Categories of the lines receipt_parser.parse recognizes by their wording. They are never sent to the classifier.
+# Total savings repeat the discounts above them, so like the totals they are not counted as spending.
+KIND_CATEGORIES = {SUBTOTAL: "Total", TOTAL: "Total", TAX: "Tax", DISCOUNT: "Discount", SAVINGS: "Total"}
+
+def image_array_to_string(image, timeout = None):
+    """
+    Runs tesseract on an image that is already in memory. The image is piped to tesseract on
+    stdin as a PNM stream and the text is read back from stdout, so unlike
+    pytesseract.image_to_string no temporary image or text files are written.
+
+    Inputs:
+    image: numpy.ndarray - a grayscale or BGR image, e.g. the output of Preprocessing.preprocess
+    timeout: float - seconds before tesseract is killed, defaults to OCR_TIMEOUT
+
+    Outputs:
+    text: str - the text tesseract read from the image
+    """
+    ok, encoded = cv2.imencode(".pgm" if image.ndim == 2 else ".ppm", image)
+    if not ok:
+        raise ValueError("Could not encode the image for tesseract.")
+
+    # Strips are OCRed side by side, so each tesseract process sticks to one core.
+    environment = dict(os.environ, OMP_THREAD_LIMIT="1")
+    try:
+        process = subprocess.run([pytesseract.pytesseract.tesseract_cmd, "stdin", "stdout"], input=encoded.tobytes(), capture_output=True, env=environment, timeout=OCR_TIMEOUT if timeout is None else timeout)
+    except FileNotFoundError:
+        raise pytesseract.TesseractNotFoundError()
+    except subprocess.TimeoutExpired:
+        # pytesseract reports its own timeouts the same way.
+        raise RuntimeError("Tesseract process timeout")
+
+    if process.returncode != 0:
+        raise pytesseract.TesseractError(process.returncode, process.stderr.decode("utf-8", "ignore"))
+    return process.stdout.decode("utf-8")
+
+# Turns a preprocessed image array into text. Benchmarks and tests that run without tesseract
+# replace it with a stand-in, see benchmarks/stubs.py.
+ocr_backend = image_array_to_string
+
+def split_into_strips(image, strips, min_strip_height = 600):
+    """
+    Splits a receipt into horizontal strips that can be read separately. Cuts are only made in
+    rows without ink, found from the horizontal projection of the binarized image, so no line
+    of text is cut in half.
+
+    Inputs:
+    image: numpy.ndarray - a binarized image with dark text on a white background, e.g. the output of Preprocessing.remove_borders
+    strips: int - how many strips to aim for
+    min_strip_height: int - strips are never shorter than this, short receipts stay in one piece
+
+    Outputs:
+    bounds: list - (top, bottom) row ranges, in order, covering the whole image
+    """
+    height = image.shape[0]
+    strips = min(strips, height // min_strip_height)
+    if strips <= 1:
+        return [(0, height)]
+
+    dark = image < 128
+    # Columns that are mostly dark are the table or shadow around the receipt, not text.
+    columns = dark.mean(axis=0) <= 0.5
+    ink = np.count_nonzero(dark[:, columns], axis=1)
+    # Allow a few specks of noise in a blank row.
+    blank = np.flatnonzero(ink <= max(1, int(0.005 * np.count_nonzero(columns))))
+    if blank.size == 0:
+        return [(0, height)]
+
+    # Cut in the middle of every run of blank rows.
+    runs = np.split(blank, np.flatnonzero(np.diff(blank) != 1) + 1)
+    cuts = np.array([(run[0] + run[-1]) // 2 for run in runs])
+
+    bounds = []
+    top = 0
+    for strip in range(1, strips):
+        target = height * strip // strips
+        cut = int(cuts[np.abs(cuts - target).argmin()])
+        if cut - top >= min_strip_height and height - cut >= min_strip_height:
+            bounds.append((top, cut))
+            top = cut
+    bounds.append((top, height))
+    return bounds
 
 class Receipt():
 
-    def get_receipt_text(receipt_img):
+    def get_receipt_text(receipt_img, strips = 1):
         """
         Extract text from receipt using OCR
 
         Inputs:
-        receipt_img: str - path to the receipt (lies in the static/image_uploads folder)
+        receipt_img: str - path to the receipt (lies in the static/image_uploads folder), or numpy.ndarray - the
+                     preprocessed image itself, which is sent to tesseract without going through a file
+        strips: int - for an in-memory image, split tall receipts into up to this many line-aligned strips (see
+                split_into_strips) and OCR them at the same time. Each strip is read by its own tesseract process,
+                so a thread per strip is enough to keep several cores busy
 
         Outputs:
         text: str - the text from the receipt as outputted by pytesseract, used after functions in preprocessing class
         """
+        if isinstance(receipt_img, np.ndarray):
+            bounds = split_into_strips(receipt_img, strips)
+            if len(bounds) == 1:
+                return ocr_backend(receipt_img)
+
+            with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+                texts = list(executor.map(ocr_backend, [receipt_img[top:bottom] for top, bottom in bounds]))
+            # tesseract ends every page with a form feed; keep one, at the very end, like a single pass.
+            return "\n\n".join(text.rstrip("\n\f") for text in texts) + "\n\f"
+
         img = Image.open(receipt_img)
-        text = pytesseract.image_to_string(img)
+        text = pytesseract.image_to_string(img, timeout=OCR_TIMEOUT)
         return text
 
-    def get_store(text, store_list_personal = ["Target", "CVS", "Trader Joe's", "Chipotle"], store_list_general = preprocessing.file_to_list("brands.txt")):
+    def get_store(text, store_list_personal = STORES, store_list_general = None, batch_size = DEFAULT_BATCH_SIZE):
         """
         We have two sets of stores. One set is extremely general that contains thousands of stores.
         The other set is personalized to each user of the platform. It is a small set of stores that user has shopped at
-        recently/frequently. We will search through the personalized store list so the program runs faster. If I were to
-        make a modification it would be to allow users to add their own stores to the platform to be used here.
+        recently/frequently.
 
-        The general store list takes too long to parse and reduces the runtime of the app significantly.
+        Both lists are compiled once into store matchers (see store_matcher.py), which find every name in a single pass
+        over the receipt, so searching the general list no longer slows the app down. The personal list is searched
+        first: exact names anywhere on the receipt, names OCR got slightly wrong only in the first few lines, where
+        receipts print the store. The general list is only searched in those lines, skipping lines with a price, since
+        it also contains product brands that show up as items. BART is only used when neither list matches.
 
         Parameters:
         text: str - string output we get from out get_receipt_text function
-        store_list: list - list of stores that a person may shop at, stored in our stores.txt file
+        store_list_personal: list - list of stores this user shops at
+        store_list_general: list - list of stores anyone may shop at, defaults to the brands in brands.txt
+        batch_size: int - how many word/store pairs the classifier scores in one forward pass when falling back to BART
         """
+        store = get_matcher(tuple(store_list_personal)).find(text, fuzzy_header_lines = HEADER_LINES)
+        if store is not None:
+            return store
 
-        classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli")
-        text = text.split(" ")
-            
-        for item in text:
-            category = classifier(item, candidate_labels = store_list_personal)
-            if category:
-                return category["labels"][0]
+        if store_list_general is None:
+            general_matcher = get_brand_matcher()
+        else:
+            general_matcher = get_matcher(tuple(store_list_general))
+        store = general_matcher.find(text, header_lines = HEADER_LINES, skip_priced_lines = True)
+        if store is not None:
+            return store
+
+        # Every word on the receipt is scored against the personal store list in one batched call
+        # and the store with the single most confident score wins.
+        candidates = list(dict.fromkeys(word for word in text.split() if any(char.isalpha() for char in word)))
+        results = classify(candidates, store_list_personal, batch_size = batch_size)
+        if not results:
+            return None
+
+        best = max(results, key=lambda result: result["scores"][0])
+        return best["labels"][0]
 
     def get_items(text):
         """
-        Determines the items on a receipt by matching a regex pattern
+        Determines the items on a receipt, every line that ends with a price (see receipt_parser.parse).
+        Lines with the same name are collapsed to the last one, use receipt_parser.parse to keep them all.
 
         Inputs:
         text: str - the text from the receipt
@@ -60,14 +190,7 @@ class Receipt():
         Outputs:
         items: dict - returns the items and prices as a dictionary
         """
-        text = text.split("\n")
-        items = {}
-        for line in text:
-            amount = re.search(r"\d+\.\d{2}$", string=line)
-            item = "".join(filter(str.isalpha, line.rsplit(" ", 1)[0]))
-            if amount and len(item) != 0:
-                items[item] = amount.group()
-        return items
+        return {line.name: line.amount for line in parse(text).lines}
 
     def get_total(text):
         """
@@ -77,47 +200,69 @@ class Receipt():
         text: str - the text from the receipt
          
         Outputs:
-        totals: dict - returns a dictionary with the keys being Total and Subtotal and the values being the amounts for both
+        totals: dict - returns a dictionary with the keys being Total and Subtotal and the values being the amounts for both,
+                a key is left out when the receipt does not show that amount. Total falls back to the subtotal.
         """
-        text = text.split("\n")
+        parsed = parse(text)
         totals = {}
-        for line in text:
-            if "subtotal" in line.lower():
-                amount = re.search(r"\d+\.\d{2}$", string=line)
-                totals["SubTotal"] = amount.group()
-            if "total" in line.lower():
-                amount = re.search(r"\d+\.\d{2}$", string=line)
-                totals["Total"] = amount.group()
+        if parsed.subtotal is not None:
+            totals["SubTotal"] = parsed.subtotal.amount
+        total = parsed.total or parsed.subtotal
+        if total is not None:
+            totals["Total"] = total.amount
         return totals
     
-    def get_item_categories(items, categories = ["Health", "Food", "Clothes", "Miscellaneous", "Electronics", "Hygiene", "Tax", "Discount", "Total"]):
+    def get_item_categories(items, categories = CATEGORIES, batch_size = DEFAULT_BATCH_SIZE):
         """
-        Function to categorize items on a receipt.
+        Function to categorize items on a receipt. Items already in the category cache are not
+        classified again, the rest are classified in one batched call, once per cache key, and
+        added to the cache in one write.
 
         Parameters:
         items: dict - items from the receipt
         categories: list - pre-specified categories, can be changed
-        classifier: pipeline - model that we will use to classify the items, defaulted to BART
+        batch_size: int - how many item/category pairs the classifier scores in one forward pass
         """
-        classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli")
+        cached, missing = category_cache.get_many(list(items.keys()), categories)
+        metrics.inc("category_cache_lookups_total", len(cached), result = "hit")
+        metrics.inc("category_cache_lookups_total", len(missing), result = "miss")
+        # "Bananas" and "BANANAS " share a cache entry, the first of them is classified for both.
+        to_classify = {}
+        for item in missing:
+            to_classify.setdefault(normalize_item(item), item)
+        metrics.inc("items_classified_total", len(to_classify))
+        results = classify(list(to_classify.values()), categories, batch_size = batch_size)
+
+        stored = category_cache.put_many({item: result["labels"][0] for item, result in zip(to_classify.values(), results)}, categories)
+        for item in missing:
+            cached[item] = stored[to_classify[normalize_item(item)]]
+
         categorized_items_dict = {}
-        items = items.keys()
         for item in items:
-            category = classifier(item, candidate_labels = categories)
-            categorized_items_dict[item] = category["labels"][0]
+            categorized_items_dict[item] = cached[item]
 
         return categorized_items_dict
     
-    def get_item_category(item, categories = ["Health", "Food", "Clothes", "Miscellaneous", "Electronics", "Hygiene", "Tax", "Discount", "Total"], classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli")):
+    def get_item_category(item, categories = CATEGORIES, classifier = None):
         """
         Retrieves the category of a single item
 
         Inputs:
         item: str - an item from the receipt
         categories: list - a predefined list of categories, future iterations of this project may allow users to input their own categories
-        classifier: pipeline - a transformers pipeline that connects to BART to identify what category a receipt item is most likely a part of
+        classifier: pipeline - a transformers pipeline that connects to BART to identify what category a receipt item is most likely a part of,
+                    defaults to the shared BART pipeline from the classifier registry
         """
+        cached = category_cache.get(item, categories)
+        metrics.inc("category_cache_lookups_total", result = "miss" if cached is None else "hit")
+        if cached is not None:
+            return cached
+        metrics.inc("items_classified_total")
+
+        if classifier is None:
+            classifier = classifier_registry.get()
         category = classifier(item, candidate_labels = categories)
+        category_cache.put(item, categories, category["labels"][0])
         return category["labels"][0]
 
     def __repr__(self):
@@ -0,0 +1,122 @@
+"""
+Parses the OCR text of a receipt into its priced lines in one pass.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from dataclasses import dataclass, field
+import re
+
+ITEM = "item"
+SUBTOTAL = "subtotal"
+TAX = "tax"
+TOTAL = "total"
+DISCOUNT = "discount"
+# "TOTAL SAVINGS 2.00": the sum of the discounts printed above it, not a discount of its own.
+SAVINGS = "savings"
+
+# A line that ends with a price: "12.99", "$12.99", "-1.00" or "1.00-", maybe followed by a tax flag letter.
+# The greedy prefix runs to the end of the line and backs up to the price, so a line is matched in one go.
+PRICED_LINE = re.compile(r"(.*[^\d])?(\d+\.\d\d)(-)?(?:[ \t]+[A-Z])?[ \t\r]*$")
+
+NON_LETTERS = re.compile(r"[\W\d_]+")
+
+# Any of the words KINDS looks for, case-insensitive. Most lines are items and are ruled out by this one search.
+KEYWORD = re.compile(r"[Dd][Ii][Ss][Cc][Oo][Uu][Nn][Tt]|[Cc][Oo][Uu][Pp][Oo][Nn]|[Ss][Aa][Vv][Ii][Nn][Gg]|[Pp][Rr][Oo][Mm][Oo]|[Tt][Oo][Tt][Aa][Ll]|[Tt][Aa][Xx]")
+
+# Checked in this order, so "TOTAL SAVINGS" is not the total and "SUBTOTAL" is not the total either.
+KINDS = [
+    (SAVINGS, re.compile(r"\btotal\s*(?:savings?|discounts?)\b", re.IGNORECASE)),
+    (DISCOUNT, re.compile(r"\b(?:discount|coupon|savings?|promo)\b", re.IGNORECASE)),
+    (SUBTOTAL, re.compile(r"\bsub\s*-?\s*total\b", re.IGNORECASE)),
+    (TOTAL, re.compile(r"\btotal\b", re.IGNORECASE)),
+    (TAX, re.compile(r"\btax\b", re.IGNORECASE)),
+]
+
+@dataclass(slots=True)
+class PricedLine:
+    """
+    A line of the receipt that ends with a price.
+
+    name: str - the letters of the line before the price, the key items are categorized and stored under
+    amount: str - the price, e.g. "12.99", negative for discounts and for lines printed with a minus sign
+    line: int - the line's number in the OCR text, starting at 1
+    kind: str - ITEM, SUBTOTAL, TAX, TOTAL, DISCOUNT or SAVINGS
+    """
+    name: str
+    amount: str
+    line: int
+    kind: str = ITEM
+
+@dataclass
+class ParsedReceipt:
+    """
+    Everything parse() found on a receipt.
+
+    lines: list - every priced line, in order, duplicates included
+    subtotal: PricedLine - the last subtotal line, None if there is none
+    tax: PricedLine - the last tax line, None if there is none
+    total: PricedLine - the last total line, None if there is none
+    """
+    lines: list = field(default_factory=list)
+    subtotal: PricedLine = None
+    tax: PricedLine = None
+    total: PricedLine = None
+
+    @property
+    def items(self):
+        """
+        The priced lines that are purchases, not totals, tax or discounts.
+        """
+        return [line for line in self.lines if line.kind == ITEM]
+
+    @property
+    def discounts(self):
+        return [line for line in self.lines if line.kind == DISCOUNT]
+
+def parse(text):
+    """
+    Walks the receipt's lines once and sorts every line that ends with a price into items,
+    subtotal, tax, total and discounts. Lines without a price, or without any letters
+    before it, are skipped.
+
+    Inputs:
+    text: str - the text from the receipt
+
+    Outputs:
+    receipt: ParsedReceipt - the priced lines of the receipt
+    """
+    receipt = ParsedReceipt()
+    append = receipt.lines.append
+    match_line = PRICED_LINE.match
+    for number, line in enumerate(text.split("\n"), start=1):
+        match = match_line(line)
+        if match is None:
+            continue
+        prefix, amount, minus = match.groups("")
+        name = prefix.replace(" ", "")
+        if not name.isalpha():
+            name = NON_LETTERS.sub("", prefix)
+            if not name:
+                continue
+
+        kind = ITEM
+        if KEYWORD.search(prefix):
+            for candidate, pattern in KINDS:
+                if pattern.search(prefix):
+                    kind = candidate
+                    break
+
+        # Receipts print savings both ways ("COUPON 2.00-", "COUPON 2.00"); a discount is always negative.
+        if minus or kind == DISCOUNT or kind == SAVINGS or ("-" in prefix and prefix.rstrip("$").endswith("-")):
+            amount = "-" + amount
+        priced = PricedLine(name, amount, number, kind)
+        append(priced)
+        if kind == SUBTOTAL:
+            receipt.subtotal = priced
+        elif kind == TAX:
+            receipt.tax = priced
+        elif kind == TOTAL:
+            receipt.total = priced
+
+    return receipt
@@ -0,0 +1,238 @@
+"""
+Per-user spending totals by store, category, day and month, kept up to date as receipts
+and items change so the dashboard never has to add up a user's whole history.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from sqlalchemy import text
+
+TABLES = [
+    """CREATE TABLE IF NOT EXISTS user_store_total (
+        user_id INTEGER NOT NULL,
+        store VARCHAR(200) NOT NULL,
+        total_cents INTEGER NOT NULL DEFAULT 0,
+        receipts INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, store)
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_category_total (
+        user_id INTEGER NOT NULL,
+        category VARCHAR(200) NOT NULL,
+        total_cents INTEGER NOT NULL DEFAULT 0,
+        items INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, category)
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_day_total (
+        user_id INTEGER NOT NULL,
+        day VARCHAR(10) NOT NULL,
+        total_cents INTEGER NOT NULL DEFAULT 0,
+        items INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_month_total (
+        user_id INTEGER NOT NULL,
+        month VARCHAR(7) NOT NULL,
+        total_cents INTEGER NOT NULL DEFAULT 0,
+        items INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, month)
+    )""",
+]
+
+# Bumped whenever any of a user's totals change, so anything derived from them (see charts.py)
+# can be cached under the version it was built from.
+VERSIONS = """CREATE TABLE IF NOT EXISTS user_data_version (
+    user_id INTEGER NOT NULL PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+)"""
+
+# The same totals index_calculations used to add up item by item. Items categorized as Total are
+# the receipt's own subtotal/total lines and are never counted as spending, and receipts still
+# processing are not counted yet, see snapshot().
+REBUILD = {
+    "user_store_total": """
+        SELECT receipt_table.user_id, receipt_table.content,
+               COALESCE(SUM(CASE WHEN item_table.category != 'Total' THEN item_table.total_cents END), 0),
+               COUNT(DISTINCT receipt_table.id)
+        FROM receipt_table
+        LEFT JOIN item_table ON item_table.receipt_id = receipt_table.id
+        WHERE receipt_table.user_id IS NOT NULL AND receipt_table.status != 'processing'
+        GROUP BY receipt_table.user_id, receipt_table.content
+    """,
+    "user_category_total": """
+        SELECT receipt_table.user_id, item_table.category, SUM(item_table.total_cents), COUNT(*)
+        FROM item_table
+        JOIN receipt_table ON receipt_table.id = item_table.receipt_id
+        WHERE receipt_table.user_id IS NOT NULL AND receipt_table.status != 'processing' AND item_table.category != 'Total'
+        GROUP BY receipt_table.user_id, item_table.category
+    """,
+    "user_day_total": """
+        SELECT receipt_table.user_id, date(receipt_table.date_created), SUM(item_table.total_cents), COUNT(*)
+        FROM item_table
+        JOIN receipt_table ON receipt_table.id = item_table.receipt_id
+        WHERE receipt_table.user_id IS NOT NULL AND receipt_table.status != 'processing' AND item_table.category != 'Total'
+        GROUP BY receipt_table.user_id, date(receipt_table.date_created)
+    """,
+    "user_month_total": """
+        SELECT receipt_table.user_id, strftime('%Y-%m', receipt_table.date_created), SUM(item_table.total_cents), COUNT(*)
+        FROM item_table
+        JOIN receipt_table ON receipt_table.id = item_table.receipt_id
+        WHERE receipt_table.user_id IS NOT NULL AND receipt_table.status != 'processing' AND item_table.category != 'Total'
+        GROUP BY receipt_table.user_id, strftime('%Y-%m', receipt_table.date_created)
+    """,
+}
+
+_ADD_STORE = text("""
+    INSERT INTO user_store_total (user_id, store, total_cents, receipts) VALUES (:user_id, :key, :cents, :count)
+    ON CONFLICT (user_id, store) DO UPDATE SET total_cents = total_cents + excluded.total_cents, receipts = receipts + excluded.receipts
+""")
+
+def _add_counted(table, column):
+    return text("""
+        INSERT INTO %(table)s (user_id, %(column)s, total_cents, items) VALUES (:user_id, :key, :cents, :count)
+        ON CONFLICT (user_id, %(column)s) DO UPDATE SET total_cents = total_cents + excluded.total_cents, items = items + excluded.items
+    """ % {"table": table, "column": column})
+
+_ADD_CATEGORY = _add_counted("user_category_total", "category")
+_ADD_DAY = _add_counted("user_day_total", "day")
+_ADD_MONTH = _add_counted("user_month_total", "month")
+
+_PRUNE = [
+    text("DELETE FROM user_store_total WHERE user_id = :user_id AND receipts <= 0"),
+    text("DELETE FROM user_category_total WHERE user_id = :user_id AND items <= 0"),
+    text("DELETE FROM user_day_total WHERE user_id = :user_id AND items <= 0"),
+    text("DELETE FROM user_month_total WHERE user_id = :user_id AND items <= 0"),
+]
+
+_BUMP_VERSION = text("""
+    INSERT INTO user_data_version (user_id, version) VALUES (:user_id, 1)
+    ON CONFLICT (user_id) DO UPDATE SET version = version + 1
+""")
+
+def snapshot(receipt, items = None):
+    """
+    Captures everything a receipt contributes to its user's totals. Take one before and one
+    after changing a receipt or its items and pass both to replace().
+
+    Inputs:
+    receipt: ReceiptTable - the receipt, its date_created must be set (flush a new receipt first)
+    items: list - (category, cents) pairs to use instead of receipt.receipt_items
+
+    Outputs:
+    snapshot: tuple - (user_id, store, day, month, items, pending), items being (category, cents) pairs that count
+              as spending. A receipt that is still processing counts for nothing: its store is None and pending is
+              its (status, content), so replace() still sees it change. A failed receipt counts like any other, the
+              user may have filled in its store and items by hand
+    """
+    # Until a receipt is read its store is a placeholder like "Processing", which is not a store the user shopped at.
+    if receipt.status == "processing":
+        return (receipt.user_id, None, None, None, (), (receipt.status, receipt.content))
+    if items is None:
+        items = [(item.category, item.total_cents) for item in receipt.receipt_items]
+    items = tuple((category, cents) for category, cents in items if category != "Total")
+    created = receipt.date_created
+    return (receipt.user_id, receipt.content, created.strftime("%Y-%m-%d"), created.strftime("%Y-%m"), items, None)
+
+def apply(db, snapshot, sign = 1):
+    """
+    Adds (sign 1) or removes (sign -1) a receipt's contribution to its user's totals.
+
+    Inputs:
+    db: SQLAlchemy session - the session the receipt change is made in, so both commit together
+    snapshot: tuple - the output of snapshot()
+    sign: int - 1 when the receipt is added, -1 when it is removed
+    """
+    user_id, store, day, month, items, pending = snapshot
+    if user_id is None:
+        return
+
+    cents = sum(item_cents for category, item_cents in items)
+    if store is not None:
+        db.execute(_ADD_STORE, {"user_id": user_id, "key": store, "cents": sign * cents, "count": sign})
+
+    if items:
+        db.execute(_ADD_DAY, {"user_id": user_id, "key": day, "cents": sign * cents, "count": sign * len(items)})
+        db.execute(_ADD_MONTH, {"user_id": user_id, "key": month, "cents": sign * cents, "count": sign * len(items)})
+
+        by_category = {}
+        for category, item_cents in items:
+            total, count = by_category.get(category, (0, 0))
+            by_category[category] = (total + item_cents, count + 1)
+        for category, (total, count) in by_category.items():
+            db.execute(_ADD_CATEGORY, {"user_id": user_id, "key": category, "cents": sign * total, "count": sign * count})
+
+    if sign < 0:
+        for statement in _PRUNE:
+            db.execute(statement, {"user_id": user_id})
+
+    db.execute(_BUMP_VERSION, {"user_id": user_id})
+
+def replace(db, before, after):
+    """
+    Swaps a receipt's old contribution to its user's totals for its new one.
+
+    Inputs:
+    db: SQLAlchemy session - the session the receipt change is made in
+    before: tuple - snapshot() taken before the change
+    after: tuple - snapshot() taken after the change
+    """
+    if before == after:
+        return
+    apply(db, before, -1)
+    apply(db, after, 1)
+
+def data_version(db, user_id):
+    """
+    Outputs:
+    version: int - changes every time the user's totals change, 0 if they never have
+    """
+    version = db.execute(text("SELECT version FROM user_data_version WHERE user_id = :user_id"), {"user_id": user_id}).scalar()
+    return version or 0
+
+def store_totals(db, user_id):
+    """
+    Outputs:
+    totals: dict - keys are the user's stores, values are the dollars spent there
+    """
+    rows = db.execute(text("SELECT store, total_cents / 100.0 FROM user_store_total WHERE user_id = :user_id ORDER BY store"), {"user_id": user_id})
+    return dict(rows.all())
+
+def category_totals(db, user_id):
+    """
+    Outputs:
+    totals: dict - keys are the user's categories, values are the dollars spent in them
+    """
+    rows = db.execute(text("SELECT category, total_cents / 100.0 FROM user_category_total WHERE user_id = :user_id ORDER BY category"), {"user_id": user_id})
+    return dict(rows.all())
+
+def rebuild(db, check = False):
+    """
+    Recomputes every rollup table from receipt_table and item_table. Every user's data
+    version is bumped, because any of their totals may have changed.
+
+    Inputs:
+    db: SQLAlchemy session or connection
+    check: bool - only compare the stored totals with the recomputed ones, without changing anything
+
+    Outputs:
+    mismatches: dict - for each table, the rows that were missing, stale or left over before the rebuild
+    """
+    mismatches = {}
+    for table, query in REBUILD.items():
+        expected = {tuple(row[:2]): tuple(row[2:]) for row in db.execute(text(query))}
+        stored = {tuple(row[:2]): tuple(row[2:]) for row in db.execute(text("SELECT * FROM %s" % table))}
+        differences = sorted(
+            (key, stored.get(key), expected.get(key))
+            for key in set(expected) | set(stored)
+            if stored.get(key) != expected.get(key)
+        )
+        if differences:
+            mismatches[table] = differences
+
+        if not check:
+            db.execute(text("DELETE FROM %s" % table))
+            db.execute(text("INSERT INTO %s %s" % (table, query)))
+
+    if not check:
+        db.execute(text("UPDATE user_data_version SET version = version + 1"))
+
+    return mismatches
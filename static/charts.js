@@ -0,0 +1,13 @@
+// Draws every element with a data-chart-url attribute as a Plotly chart from the figure JSON at that URL.
+document.querySelectorAll("[data-chart-url]").forEach(async (element) => {
+    const response = await fetch(element.dataset.chartUrl);
+    if (!response.ok) {
+        return;
+    }
+    const figure = await response.json();
+    if (figure.data.every((trace) => (trace.x || trace.values).length === 0)) {
+        element.textContent = element.dataset.emptyText || "";
+        return;
+    }
+    Plotly.newPlot(element, figure.data, figure.layout, {responsive: true});
+});
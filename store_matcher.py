@@ -0,0 +1,276 @@
+"""
+Finds store names in receipt text without running a model.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from collections import deque
+from functools import lru_cache
+import re
+from receipt_parser import PRICED_LINE
+
+_NON_ALPHANUMERIC = re.compile(r"[^a-z0-9]+")
+
+# Brands in brands.txt that are ordinary receipt vocabulary or payment networks. These show up on
+# almost every receipt, so they would be picked over the real store if we matched them.
+RECEIPT_WORDS = {"all", "total", "visa", "mastercard", "discover", "american express", "cash", "change", "tax", "sale", "store", "one"}
+
+# Brands in brands.txt that are ordinary words, mostly groceries, colors and adjectives a receipt
+# may print anywhere. Like brands shorter than MIN_BRAND_LENGTH, they only count as the store
+# when a header line says nothing else, see get_brand_matcher.
+GENERIC_BRANDS = {
+    "always", "anchor", "apple", "bonds", "bright", "budget", "candy", "champion", "cheer", "clinic", "coach",
+    "complete", "crest", "crown", "daisy", "degree", "delta", "eclipse", "ensure", "equal", "escape", "excellence",
+    "expedition", "explorer", "export", "extra", "farmers", "focus", "forte", "frontline", "fusion", "genius", "giant",
+    "goldfish", "grand", "guess", "health", "innocent", "inspiration", "inter", "intuition", "ivory", "jumbo", "kisses",
+    "liberty", "light", "limited", "lucky", "magic", "mango", "marks", "metro", "night", "ocean", "orange", "pearl",
+    "pilot", "pledge", "polar", "premier", "president", "progressive", "promise", "puffs", "quest", "range", "ranger",
+    "rebel", "regent", "reload", "scotch", "scott", "secret", "seven", "sharp", "shout", "singles", "smart", "sonic",
+    "spectra", "sprint", "state", "stride", "thins", "titan", "track", "tribute", "trident", "ultra", "voyage", "yellow",
+}
+
+# Brands shorter than this, not counting spaces, are too likely to be part of another word or an abbreviation.
+MIN_BRAND_LENGTH = 5
+
+def normalize_text(text):
+    """
+    Lowercases text, drops apostrophes and turns every other run of punctuation or whitespace
+    into a single space, so "TRADER JOE'S" and "Trader Joe's" both become "trader joes".
+
+    Inputs:
+    text: str - any text, a store name or a full receipt
+
+    Outputs:
+    text: str - the normalized text
+    """
+    text = text.lower().replace("'", "").replace("’", "")
+    return _NON_ALPHANUMERIC.sub(" ", text).strip()
+
+def trigrams(text):
+    """
+    Returns the set of character trigrams of a normalized string, padded so short names still
+    have a few trigrams.
+    """
+    padded = "  " + text + " "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class AhoCorasick():
+    """
+    A small Aho-Corasick automaton. All patterns are found in one pass over the text, so the
+    cost of a search depends on the length of the receipt and not on how many stores we know.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state].append(index)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._fail[next_state] == next_state:
+                    self._fail[next_state] = 0
+                self._output[next_state].extend(self._output[self._fail[next_state]])
+
+    def search(self, text):
+        """
+        Yields every occurrence of every pattern in the text.
+
+        Inputs:
+        text: str - the text to search
+
+        Outputs:
+        (start, end, index): tuple - the slice text[start:end] equals self.patterns[index]
+        """
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for index in self._output[state]:
+                yield position + 1 - len(self.patterns[index]), position + 1, index
+
+class StoreMatcher():
+    """
+    Matches a list of store names against receipt text. Exact matches come from an
+    Aho-Corasick automaton over the normalized names and must fall on word boundaries.
+    Near matches, for names OCR got slightly wrong, come from a trigram index.
+    """
+
+    def __init__(self, stores, fuzzy_threshold = 0.75, min_fuzzy_length = 5, line_only = ()):
+        self.names = {}
+        for store in stores:
+            store = store.strip()
+            key = normalize_text(store)
+            if key and key not in self.names:
+                self.names[key] = store
+
+        # Names that only match a line of their own, kept out of the automaton and the trigram index.
+        self.line_names = {}
+        for store in line_only:
+            store = store.strip()
+            key = normalize_text(store)
+            if key and key not in self.names and key not in self.line_names:
+                self.line_names[key] = store
+
+        self.keys = list(self.names)
+        self.fuzzy_threshold = fuzzy_threshold
+        self.min_fuzzy_length = min_fuzzy_length
+        self.automaton = AhoCorasick(self.keys)
+        self.max_words = max((len(key.split()) for key in self.keys), default=0)
+
+        self.trigram_index = {}
+        self.trigram_counts = []
+        for index, key in enumerate(self.keys):
+            grams = trigrams(key)
+            self.trigram_counts.append(len(grams))
+            if len(key) >= min_fuzzy_length:
+                for gram in grams:
+                    self.trigram_index.setdefault(gram, []).append(index)
+
+    def find_exact(self, text):
+        """
+        Finds the first store name that appears in the text on word boundaries. When several
+        names start at the same place the longest one wins, so "Trader Joes" beats "Trader".
+
+        Inputs:
+        text: str - normalized receipt text
+
+        Outputs:
+        store: str - the store name as it appears in the store list, or None
+        """
+        best = None
+        for start, end, index in self.automaton.search(text):
+            if start > 0 and text[start - 1] != " ":
+                continue
+            if end < len(text) and text[end] != " ":
+                continue
+            if best is None or start < best[0] or (start == best[0] and end > best[1]):
+                best = (start, end, index)
+
+        if best is None:
+            return None
+        return self.names[self.keys[best[2]]]
+
+    def find_fuzzy(self, text):
+        """
+        Finds the store name closest to any run of words in the text, using the Dice
+        coefficient over character trigrams. Only names at least min_fuzzy_length long are
+        considered, since short names match too much by accident.
+
+        Inputs:
+        text: str - normalized receipt text
+
+        Outputs:
+        store: str - the store name as it appears in the store list, or None
+        """
+        words = text.split()
+        best_score, best_index = 0, None
+
+        for start in range(len(words)):
+            for length in range(1, self.max_words + 1):
+                if start + length > len(words):
+                    break
+                window = " ".join(words[start:start + length])
+                if len(window) < self.min_fuzzy_length:
+                    continue
+
+                grams = trigrams(window)
+                shared = {}
+                for gram in grams:
+                    for index in self.trigram_index.get(gram, ()):
+                        shared[index] = shared.get(index, 0) + 1
+
+                for index, count in shared.items():
+                    score = 2 * count / (len(grams) + self.trigram_counts[index])
+                    if score > best_score:
+                        best_score, best_index = score, index
+
+        if best_index is None or best_score < self.fuzzy_threshold:
+            return None
+        return self.names[self.keys[best_index]]
+
+    def find(self, text, header_lines = None, fuzzy = True, fuzzy_header_lines = None, skip_priced_lines = False):
+        """
+        Finds the store on a receipt: a line that is nothing but a store name, then an exact
+        match anywhere in the searched lines, then a fuzzy one.
+
+        Inputs:
+        text: str - the raw text from the receipt
+        header_lines: int - only search the first few non-empty lines, where receipts print the store. None searches everything
+        fuzzy: bool - whether to fall back to the trigram index when there is no exact match
+        fuzzy_header_lines: int - only fuzzy match in the first few non-empty lines, so an item line that looks a bit like
+                            a store name is not taken for the store. None fuzzy matches wherever exact matches are searched
+        skip_priced_lines: bool - leave out lines that end with a price (see receipt_parser.PRICED_LINE), they are
+                           items like "APPLE JUICE 2.99", not the store. Header lines are counted before they are left out
+
+        Outputs:
+        store: str - the store name as it appears in the store list, or None
+        """
+        lines = [line for line in text.split("\n") if line.strip()]
+        if header_lines is not None:
+            lines = lines[:header_lines]
+        normalized = [(number, normalize_text(line)) for number, line in enumerate(lines) if not (skip_priced_lines and PRICED_LINE.match(line))]
+
+        for number, line in normalized:
+            if line in self.line_names:
+                return self.line_names[line]
+
+        store = self.find_exact(" ".join(line for number, line in normalized))
+        if store is None and fuzzy:
+            if fuzzy_header_lines is not None:
+                normalized = [(number, line) for number, line in normalized if number < fuzzy_header_lines]
+            store = self.find_fuzzy(" ".join(line for number, line in normalized))
+        return store
+
+@lru_cache(maxsize=256)
+def get_matcher(stores):
+    """
+    Builds a matcher once per store list and reuses it for every later receipt.
+
+    Inputs:
+    stores: tuple - the store names, a tuple so it can be used as a cache key
+
+    Outputs:
+    matcher: StoreMatcher - the compiled matcher
+    """
+    return StoreMatcher(stores)
+
+@lru_cache(maxsize=None)
+def get_brand_matcher(filename = "brands.txt"):
+    """
+    Builds the matcher over the general brand list, leaving out brands that are ordinary
+    receipt vocabulary and brands that are only digits. Short brands and brands that are
+    ordinary words ("apple", "orange") only match a header line that is nothing but the brand.
+
+    Inputs:
+    filename: str - the brand file, one brand per line
+
+    Outputs:
+    matcher: StoreMatcher - the compiled matcher
+    """
+    with open(filename, "r") as file:
+        brands = [line.strip() for line in file]
+
+    brands = [brand for brand in brands if normalize_text(brand) not in RECEIPT_WORDS and not normalize_text(brand).replace(" ", "").isdigit()]
+    line_only = [brand for brand in brands if normalize_text(brand) in GENERIC_BRANDS or len(normalize_text(brand).replace(" ", "")) < MIN_BRAND_LENGTH]
+    brands = [brand for brand in brands if brand not in line_only]
+    return StoreMatcher(brands, line_only = line_only)
@@ -0,0 +1,47 @@
+"""
+Tests for storing uploads a chunk at a time and for receipt thumbnails.
+"""
+
+__author__ = "Kevin Dougherty"
+
+import io
+import os
+import numpy as np
+import pytest
+from blob_store import BlobStore, UploadTooLarge, content_hash, thumbnail_path, ensure_thumbnail
+import cv2
+
+# Run `python -m pytest`
+
+def test_put_stream_matches_put(tmp_path):
+    store = BlobStore(str(tmp_path))
+    data = os.urandom(10000)
+
+    digest, path, size = store.put_stream(io.BytesIO(data), "receipt.JPG", chunk_size = 1024)
+    assert (digest, path, size) == (content_hash(data), store.path(content_hash(data), ".jpg"), len(data))
+    with open(path, "rb") as file:
+        assert file.read() == data
+    # Storing the same upload again keeps the one copy and leaves no temporary file behind.
+    assert store.put_stream(io.BytesIO(data), "again.jpg")[1] == path
+    assert store.put(data, "receipt.jpg") == (digest, path)
+    assert [name for name in os.listdir(tmp_path) if os.path.isfile(tmp_path / name)] == []
+
+def test_put_stream_rejects_large_uploads(tmp_path):
+    store = BlobStore(str(tmp_path))
+    with pytest.raises(UploadTooLarge):
+        store.put_stream(io.BytesIO(b"x" * 5000), "receipt.jpg", max_size = 4096, chunk_size = 1024)
+    assert os.listdir(tmp_path) == []
+
+def test_ensure_thumbnail(tmp_path):
+    store = BlobStore(str(tmp_path))
+    image = np.full((2000, 800, 3), 255, dtype=np.uint8)
+    path = store.put(cv2.imencode(".png", image)[1].tobytes(), "receipt.png")[1]
+
+    thumbnail = ensure_thumbnail(path, width = 100)
+    assert thumbnail == thumbnail_path(path)
+    assert cv2.imread(thumbnail).shape[1] == 100
+
+def test_same_bytes_are_stored_once_under_any_spelling_of_the_extension(tmp_path):
+    store = BlobStore(str(tmp_path))
+    data = os.urandom(1000)
+    assert store.put(data, "receipt.jpeg")[1] == store.put(data, "scan.JPG")[1] == store.put_stream(io.BytesIO(data), "photo.jpe")[1]
@@ -0,0 +1,38 @@
+"""
+Tests for the category cache. They run on a temporary SQLite database with just the
+category_cache table, and a stand-in classifier.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from sqlalchemy import create_engine, event, text
+import category_cache
+import receipt
+from receipt import Receipt, CATEGORIES
+
+# Run `python -m pytest`
+
+def test_new_items_are_classified_once_and_written_in_one_transaction(tmp_path, monkeypatch):
+    engine = create_engine("sqlite:///%s" % (tmp_path / "test.db"))
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE category_cache (id INTEGER PRIMARY KEY, item_key VARCHAR(200) NOT NULL, categories VARCHAR(500) NOT NULL, category VARCHAR(200) NOT NULL, source VARCHAR(20) NOT NULL DEFAULT 'model', UNIQUE (item_key, categories))"))
+    backend = category_cache.SQLCategoryBackend(engine)
+    backend.set("SHAMPOO", category_cache.categories_key(CATEGORIES), "Hygiene", "user")
+    monkeypatch.setattr(receipt, "category_cache", category_cache.CategoryCache(backend = backend))
+
+    classified = []
+    def classify(items, categories, batch_size = None):
+        classified.extend(items)
+        return [{"labels": ["Food"]} for item in items]
+    monkeypatch.setattr(receipt, "classify", classify)
+
+    transactions = []
+    event.listen(engine, "begin", lambda connection: transactions.append(connection))
+    categories = Receipt.get_item_categories({"Bananas": "1.99", "BANANAS ": "1.99", "Milk": "3.49", "Shampoo": "5.00"})
+
+    assert classified == ["Bananas", "Milk"]
+    assert categories == {"Bananas": "Food", "BANANAS ": "Food", "Milk": "Food", "Shampoo": "Hygiene"}
+    # One transaction reads the backend, one writes both new items.
+    assert len(transactions) == 2
+    with engine.connect() as connection:
+        assert dict(connection.execute(text("SELECT item_key, category FROM category_cache")).all()) == {"SHAMPOO": "Hygiene", "BANANAS": "Food", "MILK": "Food"}
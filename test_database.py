@@ -0,0 +1,79 @@
+"""
+Tests for the SQLite connection settings. They run on a temporary database file with the
+sqlite3 module, no app or models needed.
+"""
+
+__author__ = "Kevin Dougherty"
+
+import threading
+import time
+from sqlalchemy import text
+import database
+
+# Run `python -m pytest`
+
+def make_engine(tmp_path, **pragmas):
+    engine = database.create_engine("sqlite:///%s" % (tmp_path / "test.db"), dict(database.DEFAULT_PRAGMAS, **pragmas))
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE receipt_table (id INTEGER PRIMARY KEY, content TEXT)"))
+        connection.execute(text("INSERT INTO receipt_table (content) VALUES ('Target')"))
+    return engine
+
+def test_pragmas_are_applied(tmp_path):
+    engine = make_engine(tmp_path)
+    with engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert connection.execute(text("PRAGMA synchronous")).scalar() == 1
+        assert connection.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+        assert connection.execute(text("PRAGMA cache_size")).scalar() == -20000
+
+def test_readers_do_not_wait_for_an_upload_in_progress(tmp_path):
+    engine = make_engine(tmp_path)
+    written, release = threading.Event(), threading.Event()
+
+    def upload():
+        with engine.begin() as connection:
+            connection.execute(text("INSERT INTO receipt_table (content) VALUES ('Processing')"))
+            connection.execute(text("UPDATE receipt_table SET content = 'CVS' WHERE id = 1"))
+            written.set()
+            # The upload's write transaction stays open while the reader runs.
+            release.wait(5)
+
+    writer = threading.Thread(target=upload)
+    writer.start()
+    try:
+        assert written.wait(5)
+        started = time.perf_counter()
+        with engine.connect() as connection:
+            rows = connection.execute(text("SELECT content FROM receipt_table ORDER BY id")).scalars().all()
+        elapsed = time.perf_counter() - started
+    finally:
+        release.set()
+        writer.join()
+
+    # The reader sees the last committed state right away instead of blocking on the writer.
+    assert rows == ["Target"]
+    assert elapsed < 0.5
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT content FROM receipt_table ORDER BY id")).scalars().all() == ["CVS", "Processing"]
+
+def test_second_writer_waits_instead_of_failing(tmp_path):
+    engine = make_engine(tmp_path)
+    written = threading.Event()
+
+    def upload():
+        with engine.begin() as connection:
+            connection.execute(text("INSERT INTO receipt_table (content) VALUES ('first')"))
+            written.set()
+            time.sleep(0.3)
+
+    writer = threading.Thread(target=upload)
+    writer.start()
+    assert written.wait(5)
+    # The lock is busy for another 0.3 s, well under busy_timeout.
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO receipt_table (content) VALUES ('second')"))
+    writer.join()
+
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT content FROM receipt_table ORDER BY id")).scalars().all() == ["Target", "first", "second"]
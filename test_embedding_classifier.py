@@ -0,0 +1,51 @@
+"""
+Tests for the embedding classifier backend. A tiny hand-made encoder stands in for the
+sentence-transformers model, so they run without it.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from embedding_classifier import EmbeddingClassifier
+
+# Run `python -m pytest`
+
+# Axes: food, hygiene, health.
+VECTORS = {
+    "food": [1, 0, 0],
+    "hygiene": [0, 1, 0],
+    "health": [0, 0, 1],
+    "bananas": [0.9, 0.1, 0],
+    "soap": [0.1, 0.9, 0.1],
+    "lotion": [0, 0.7, 0.5],
+    "body lotion": [0, 0.6, 0.6],
+}
+
+class Encoder():
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, texts, batch_size = None):
+        self.calls.append(list(texts))
+        return [VECTORS[text.lower()] for text in texts]
+
+def test_classifies_by_similarity_to_labels():
+    encoder = Encoder()
+    classifier = EmbeddingClassifier(encoder = encoder)
+
+    results = classifier(["BANANAS", "SOAP"], candidate_labels = ["Food", "Hygiene", "Health"])
+    assert [result["labels"][0] for result in results] == ["Food", "Hygiene"]
+    assert results[0]["sequence"] == "BANANAS"
+    assert results[0]["scores"] == sorted(results[0]["scores"], reverse=True)
+
+    # A single text gives a single result, and the labels are only embedded the first time.
+    assert classifier("LOTION", candidate_labels = ["Food", "Hygiene", "Health"])["labels"][0] == "Hygiene"
+    assert encoder.calls.count(["Food", "Hygiene", "Health"]) == 1
+
+def test_user_corrections_are_nearest_neighbor_examples():
+    corrections = {"BODY LOTION": "Health", "BANANAS": "Clothes"}
+    classifier = EmbeddingClassifier(encoder = Encoder(), examples = lambda labels: corrections)
+
+    result = classifier("LOTION", candidate_labels = ["Food", "Hygiene", "Health"])
+    assert result["labels"][0] == "Health"
+    # Examples of a label that is not a candidate are ignored.
+    assert classifier("BANANAS", candidate_labels = ["Food", "Hygiene", "Health"])["labels"][0] == "Food"
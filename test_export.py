@@ -0,0 +1,66 @@
+"""
+Tests for the receipt export. They run on a temporary SQLite database with just the two
+tables the export reads.
+"""
+
+__author__ = "Kevin Dougherty"
+
+import csv
+import io
+import os
+import pytest
+from sqlalchemy import create_engine, text
+from export import COLUMNS, ExportJobs, export_receipts, iter_chunks, write_export
+
+# Run `python -m pytest`
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine("sqlite:///%s" % (tmp_path / "test.db"))
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE receipt_table (id INTEGER PRIMARY KEY, content VARCHAR(200), total_cents INTEGER, date_created DATETIME, status VARCHAR(20), user_id INTEGER)"))
+        connection.execute(text("CREATE TABLE item_table (id INTEGER PRIMARY KEY, item VARCHAR(200), total_cents INTEGER, category VARCHAR(200), receipt_id INTEGER)"))
+        connection.execute(text("INSERT INTO receipt_table VALUES (1, 'Target', 1948, '2025-02-01 10:00:00.000000', 'done', 1), (2, 'CVS', 0, '2025-01-01 09:00:00.000000', 'processing', 1), (3, 'Other', 500, '2025-01-01 09:00:00.000000', 'done', 2)"))
+        connection.execute(text("INSERT INTO item_table VALUES (1, 'BANANAS', 199, 'Food', 1), (2, 'SHAMPOO', 1298, 'Hygiene', 1), (3, 'COUPON', -100, 'Discount', 1), (4, 'MILK', 349, 'Food', 3)"))
+    return engine
+
+def test_csv_has_one_row_per_item_oldest_receipt_first(engine):
+    file = io.BytesIO()
+    with engine.connect() as connection:
+        rows = write_export(iter_chunks(connection, 1, chunk_size = 2), file, "csv")
+
+    lines = list(csv.reader(io.StringIO(file.getvalue().decode())))
+    assert rows == 4
+    assert lines[0] == COLUMNS
+    # The receipt still processing has no items, it gets one row with empty item columns.
+    assert lines[1] == ["2", "CVS", "2025-01-01T09:00:00", "processing", "0.00", "", "", "", ""]
+    assert [line[6:8] for line in lines[2:]] == [["BANANAS", "1.99"], ["SHAMPOO", "12.98"], ["COUPON", "-1.00"]]
+
+def test_chunks_are_bounded(engine):
+    with engine.connect() as connection:
+        assert [len(chunk) for chunk in iter_chunks(connection, 1, chunk_size = 3)] == [3, 1]
+
+def test_parquet_row_groups(engine, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "receipts.parquet")
+
+    assert export_receipts(engine, 1, path, "parquet", chunk_size = 2) == 4
+    file = pq.ParquetFile(path)
+    assert file.metadata.num_row_groups == 2
+    table = file.read()
+    assert table.column_names == COLUMNS
+    assert [str(total) for total in table.column("item_total").to_pylist()] == ["None", "1.99", "12.98", "-1.00"]
+
+def test_finished_jobs_expire_with_their_files(engine, tmp_path):
+    jobs = ExportJobs(str(tmp_path / "exports"), max_age = 60)
+    job_id = jobs.submit(engine, 1, "csv", chunk_size = 2)
+    jobs.shutdown()
+    path = jobs.get(job_id)["path"]
+    # A file left behind by an earlier server process.
+    stale = tmp_path / "exports" / "receipts-1-old.csv"
+    stale.write_text("")
+
+    assert jobs.expire(now = jobs.get(job_id)["finished"] + 30) == 0
+    assert jobs.expire(now = jobs.get(job_id)["finished"] + 3600) == 2
+    assert jobs.get(job_id) is None
+    assert not os.path.exists(path) and not stale.exists()
@@ -0,0 +1,42 @@
+"""
+Tests for the metrics registry behind /metrics.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from metrics import Metrics
+
+# Run `python -m pytest`
+
+def test_render_histogram_and_counter():
+    registry = Metrics(buckets = (0.1, 1.0))
+    registry.observe("receipt_stage_seconds", 0.05, stage = "ocr")
+    registry.observe("receipt_stage_seconds", 0.5, stage = "ocr")
+    registry.observe("receipt_stage_seconds", 5.0, stage = "ocr")
+    registry.inc("receipts_processed_total", status = "done")
+
+    text = registry.render()
+    assert 'receipt_stage_seconds_bucket{stage="ocr",le="0.1"} 1' in text
+    assert 'receipt_stage_seconds_bucket{stage="ocr",le="1.0"} 2' in text
+    assert 'receipt_stage_seconds_bucket{stage="ocr",le="+Inf"} 3' in text
+    assert 'receipt_stage_seconds_count{stage="ocr"} 3' in text
+    assert 'receipts_processed_total{status="done"} 1' in text
+
+def test_drain_and_merge():
+    worker, parent = Metrics(), Metrics()
+    worker.inc("items_classified_total", 3)
+    with worker.timer("receipt_stage_seconds", stage = "parse"):
+        pass
+
+    parent.merge(worker.drain())
+    parent.merge(worker.drain())
+    assert "items_classified_total 3" in parent.render()
+    assert 'receipt_stage_seconds_count{stage="parse"} 1' in parent.render()
+
+def test_disabled_records_nothing():
+    registry = Metrics()
+    registry.enabled = False
+    registry.inc("items_classified_total")
+    with registry.timer("receipt_stage_seconds", stage = "ocr"):
+        pass
+    assert registry.render() == "\n"
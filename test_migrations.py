@@ -0,0 +1,34 @@
+"""
+Tests for the schema migrations. They run on an in-memory SQLite database with the tables
+as the first version of the app created them.
+"""
+
+__author__ = "Kevin Dougherty"
+
+import sqlite3
+import pytest
+from migrations import migrate
+
+# Run `python -m pytest`
+
+def legacy_database(totals):
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE receipt_table (id INTEGER PRIMARY KEY, content VARCHAR(200), total VARCHAR(200), date_created DATETIME, user_id INTEGER)")
+    connection.execute("CREATE TABLE item_table (id INTEGER PRIMARY KEY, item VARCHAR(200), total VARCHAR(200), category VARCHAR(200), receipt_id INTEGER)")
+    connection.executemany("INSERT INTO receipt_table (content, total, date_created, user_id) VALUES ('Target', ?, '2024-01-01 10:00:00', 1)", [(total,) for total in totals])
+    connection.execute("INSERT INTO item_table (item, total, category, receipt_id) VALUES ('MILK', 3.5, 'Food', 1)")
+    connection.commit()
+    return connection
+
+def test_totals_typed_by_hand_become_cents():
+    connection = legacy_database(["$5", "1,200.00", "19.48"])
+    migrate(connection)
+    assert connection.execute("SELECT total_cents FROM receipt_table ORDER BY id").fetchall() == [(500,), (120000,), (1948,)]
+    assert connection.execute("SELECT total_cents FROM item_table").fetchall() == [(350,)]
+
+def test_totals_that_are_not_money_stop_the_migration():
+    connection = legacy_database(["5.00", "about 5"])
+    with pytest.raises(ValueError, match="id 2: 'about 5'"):
+        migrate(connection)
+    # Nothing was rebuilt, the old column is still there.
+    assert "total" in {row[1] for row in connection.execute("PRAGMA table_info(receipt_table)")}
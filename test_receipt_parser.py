@@ -0,0 +1,71 @@
+"""
+Tests for the receipt text parser. They only need the OCR text, so they run without tesseract or BART.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from receipt_parser import parse, ITEM, SUBTOTAL, TAX, TOTAL, DISCOUNT, SAVINGS
+from receipt import Receipt
+
+# Run `python -m pytest`
+
+text = """TARGET
+123 Main St
+BANANAS 1.99
+MILK 3.49
+BANANAS 1.99
+DOVE SHAMPOO $12.98 A
+COUPON 2.00-
+SUBTOTAL 18.45
+TAX 1.02
+TOTAL 19.47
+TOTAL SAVINGS 2.00
+"""
+
+def test_parse_keeps_duplicates_and_line_numbers():
+    items = parse(text).items
+    assert [(item.name, item.amount, item.line) for item in items] == [
+        ("BANANAS", "1.99", 3),
+        ("MILK", "3.49", 4),
+        ("BANANAS", "1.99", 5),
+        ("DOVESHAMPOO", "12.98", 6),
+    ]
+
+def test_parse_totals_and_discounts():
+    parsed = parse(text)
+    assert (parsed.subtotal.amount, parsed.tax.amount, parsed.total.amount) == ("18.45", "1.02", "19.47")
+    assert [(line.name, line.amount) for line in parsed.discounts] == [("COUPON", "-2.00")]
+    assert [line.kind for line in parsed.lines] == [ITEM, ITEM, ITEM, ITEM, DISCOUNT, SUBTOTAL, TAX, TOTAL, SAVINGS]
+    # Savings are negative whether or not the receipt prints a minus sign.
+    assert [line.amount for line in parse("COUPON 2.00\nPROMO DISCOUNT -1.50\nTOTAL SAVINGS 3.50\n").lines] == ["-2.00", "-1.50", "-3.50"]
+
+def test_get_total_without_amount():
+    totals = Receipt.get_total("TOTAL\nSUBTOTAL 4.00\nTOTAL DUE\n")
+    assert totals == {"SubTotal": "4.00", "Total": "4.00"}
+    assert Receipt.get_total("no prices here") == {}
+
+def test_get_items_collapses_duplicates():
+    assert Receipt.get_items(text)["BANANAS"] == "1.99"
+    assert len(Receipt.get_items(text)) == 8
+
+def test_read_receipt_only_classifies_purchases(monkeypatch):
+    import ingestion
+
+    classified = []
+    def get_item_categories(items, **options):
+        classified.extend(items)
+        # A classifier that gets every line wrong.
+        return {item: "Food" for item in items}
+    monkeypatch.setattr(Receipt, "get_item_categories", get_item_categories)
+    monkeypatch.setattr(Receipt, "get_receipt_text", lambda image, strips = 1: text)
+    monkeypatch.setattr(Receipt, "get_store", lambda text, **options: "Target")
+    monkeypatch.setattr(ingestion.preprocessing, "decode", lambda data: data)
+    monkeypatch.setattr(ingestion.preprocessing, "preprocess", lambda image, **options: image)
+    monkeypatch.setattr(ingestion, "perceptual_hash", lambda data: None)
+
+    result = ingestion.read_receipt(b"image")
+    assert classified == ["BANANAS", "MILK", "DOVESHAMPOO"]
+    assert [category for item, total, category in result["items"]] == ["Food", "Food", "Food", "Food", "Discount", "Total", "Tax", "Total", "Total"]
+    # What is counted as spending adds up to the receipt's total.
+    spending = sum(float(total) for item, total, category in result["items"] if category != "Total")
+    assert round(spending, 2) == float(result["total"]) == 19.47
@@ -0,0 +1,26 @@
+"""
+Tests for finding the store on a receipt. They only need the OCR text, so they run without tesseract or BART.
+"""
+
+__author__ = "Kevin Dougherty"
+
+from store_matcher import StoreMatcher, get_brand_matcher
+
+# Run `python -m pytest`
+
+def test_store_names_are_only_fuzzy_matched_in_the_header():
+    matcher = StoreMatcher(["Target", "Walgreens"])
+    items = "".join("ITEM %d 1.99\n" % number for number in range(10))
+    assert matcher.find("WALGRENS\n123 Main St\n" + items, fuzzy_header_lines = 6) == "Walgreens"
+    # An item far down the receipt that looks like a store name is not taken for the store.
+    assert matcher.find("CORNER SHOP\n" + items + "WALGRENS VITAMINS 8.99\n", fuzzy_header_lines = 6) is None
+    assert matcher.find("CORNER SHOP\n" + items + "WALGREENS VITAMINS 8.99\n", fuzzy_header_lines = 6) == "Walgreens"
+
+def test_brands_on_item_lines_or_inside_words_are_not_the_store():
+    matcher = get_brand_matcher()
+    header = "THANK YOU FOR SHOPPING\nRECEIPT\nSTORE 123\nCASHIER AMY\n"
+    assert matcher.find(header + "MILK 3.49\nAPPLE JUICE 2.99\n", header_lines = 6, skip_priced_lines = True) is None
+    assert matcher.find(header + "ORANGE 2.99\n", header_lines = 6, skip_priced_lines = True) is None
+    # Short and generic brands still count when they are all a header line says.
+    assert matcher.find("ALDI\n" + header + "ORANGE 2.99\n", header_lines = 6, skip_priced_lines = True) == "Aldi"
+    assert matcher.find("WALGREENS #1234\n" + header, header_lines = 6, skip_priced_lines = True) == "Walgreens"